@@ -0,0 +1,100 @@
+import io
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Union
+from telegram import Bot, InputFile, Message
+from metrics import UPLOAD_BYTES, cache_result
+
+
+class AdminPhotoCache:
+    """
+    Кэш фото профиля администратора для приветственного сообщения.
+    Фото скачивается один раз, после первой отправки используется file_id из ответа Telegram.
+    Фото перепроверяется раз в ttl секунд (обычно фоновой задачей) и перезагружается,
+    только если изменился file_unique_id фото профиля.
+    Первая загрузка файла выполняется одна за раз (upload_lock): остальные приветствия ждут file_id.
+    """
+
+    def __init__(self, admin_id: str, ttl: float = 3600.0) -> None:
+        self.admin_id = admin_id
+        self.ttl = ttl
+        self.file_id: Optional[str] = None
+        self.file_unique_id: Optional[str] = None
+        self.photo_bytes: Optional[bytes] = None
+        self.checked_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self.upload_lock = asyncio.Lock()
+
+    async def refresh(self, bot: Bot) -> None:
+        """Проверяет фото профиля админа и скачивает его заново, если оно изменилось."""
+        async with self._lock:
+            try:
+                admin_chat = await bot.get_chat(self.admin_id)
+            except Exception as e:
+                logging.error(f"Ошибка получения чата админа {self.admin_id}: {e}")
+                return
+            self.checked_at = time.monotonic()
+
+            if not admin_chat.photo:
+                self.file_id = self.file_unique_id = self.photo_bytes = None
+                return
+            if admin_chat.photo.big_file_unique_id == self.file_unique_id:
+                return
+
+            try:
+                logging.info(f"Загрузка фото профиля администратора {self.admin_id}")
+                photo = await bot.get_file(admin_chat.photo.big_file_id)
+                photo_bytes = await photo.download_as_bytearray()
+            except Exception as e:
+                logging.error(f"Ошибка при работе с фото профиля: {e}")
+                return
+            if not photo_bytes:
+                logging.warning("Не удалось загрузить фото: photo_bytes пуст")
+                return
+            logging.info(f"Размер загруженного фото: {len(photo_bytes)} байт")
+            self.photo_bytes = bytes(photo_bytes)
+            self.file_unique_id = admin_chat.photo.big_file_unique_id
+            self.file_id = None
+
+    async def get(self, bot: Bot) -> Optional[Union[str, InputFile]]:
+        """Фото для send_photo: file_id, если уже известен, иначе файл для первой загрузки."""
+        if self.checked_at is None or time.monotonic() - self.checked_at > self.ttl * 2:
+            # Первый вызов или фоновое обновление давно не выполнялось
+            await self.refresh(bot)
+        cache_result('admin_photo', bool(self.file_id))
+        if self.file_id:
+            return self.file_id
+        if self.photo_bytes:
+            return InputFile(io.BytesIO(self.photo_bytes), filename='admin_photo.jpg')
+        return None
+
+    async def send(self, photo: Optional[Union[str, InputFile]],
+                   send_photo: Callable[[Union[str, InputFile]], Awaitable[Optional[Message]]]) -> Optional[Message]:
+        """Отправляет фото из get через send_photo; файл загружается в Telegram только один раз."""
+        if not photo:
+            return None
+        if isinstance(photo, str):
+            return await send_photo(photo)
+        async with self.upload_lock:
+            # Пока ждали блокировку, фото мог загрузить другой пользователь
+            if self.file_id:
+                return await send_photo(self.file_id)
+            if not self.photo_bytes:
+                return None
+            UPLOAD_BYTES.inc(len(self.photo_bytes), kind='admin_photo')
+            message = await send_photo(InputFile(io.BytesIO(self.photo_bytes), filename='admin_photo.jpg'))
+            self.remember(message)
+            return message
+
+    def remember(self, message: Optional[Message]) -> None:
+        """Сохраняет file_id из ответа send_photo, чтобы следующие отправки не загружали файл."""
+        if self.file_id is None and message and message.photo:
+            self.file_id = message.photo[-1].file_id
+            self.photo_bytes = None
+
+    def invalidate_file_id(self) -> None:
+        """Сбрасывает file_id, который Telegram перестал принимать (следующий get скачает фото заново)."""
+        self.file_id = None
+        self.file_unique_id = None
+        self.checked_at = None
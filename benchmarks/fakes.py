@@ -0,0 +1,182 @@
+"""
+Заглушки внешних сервисов для нагрузочных стендов: Telegram Bot API и YooKassa (aiohttp).
+Бот подключается к ним через TELEGRAM_API_BASE_URL и YOOKASSA_API_URL.
+"""
+import asyncio
+import json
+import socket
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Optional
+from aiohttp import web
+
+BOT_ID = 1000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def start_app(app: web.Application, port: Optional[int] = None) -> tuple[web.AppRunner, str]:
+    """Запускает aiohttp приложение на 127.0.0.1; возвращает runner и базовый URL."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = port or free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def _decode(value: Any) -> Any:
+    # PTB передает сложные параметры (reply_markup) строкой JSON
+    if isinstance(value, str) and value[:1] in '{[':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+class FakeBotApi:
+    """
+    Минимальный Bot API. Вызовы бота (sendMessage, sendVideo, editMessageText и т.д.)
+    складываются в очередь чата (outbox) как (метод, параметры, результат),
+    update для long polling — в общую очередь (getUpdates).
+    latency — задержка каждого ответа, имитирующая сеть до серверов Telegram.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+        self.upload_bytes = 0
+        self._message_id = 0
+        self._update_id = 0
+        self._updates: asyncio.Queue[dict] = asyncio.Queue()
+        self._outbox: dict[int, asyncio.Queue[tuple[str, dict, Any]]] = defaultdict(asyncio.Queue)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    def outbox(self, chat_id: int) -> asyncio.Queue[tuple[str, dict, Any]]:
+        return self._outbox[chat_id]
+
+    def _next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def push_update(self, payload: dict) -> int:
+        """Добавляет update для getUpdates; payload — поля update без update_id."""
+        self._update_id += 1
+        self._updates.put_nowait({'update_id': self._update_id, **payload})
+        return self._update_id
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, web.FileField):
+                data = value.file.read()
+                self.upload_bytes += len(data)
+                params[key] = value
+            else:
+                params[key] = _decode(value)
+        return params
+
+    def _message(self, chat_id: int, **fields: Any) -> dict:
+        return {'message_id': self._next_message_id(), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **fields}
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        timeout = float(params.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        limit = int(params.get('limit') or 100)
+        while len(updates) < limit and not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if method == 'getMe':
+            result: Any = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'getChat':
+            result = {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}',
+                      'accent_color_id': 0, 'max_reaction_count': 11}
+        elif method == 'getUserProfilePhotos':
+            result = {'total_count': 0, 'photos': []}
+        elif method == 'sendMessage':
+            result = self._message(chat_id, text=str(params.get('text', '')))
+        elif method == 'sendVideo':
+            video = params.get('video')
+            file_id = video if isinstance(video, str) else f'video-{uuid.uuid4().hex}'
+            result = self._message(chat_id, caption=params.get('caption'), video={
+                'file_id': file_id, 'file_unique_id': file_id[-16:],
+                'width': int(params.get('width') or 720), 'height': int(params.get('height') or 1280),
+                'duration': int(params.get('duration') or 0),
+            })
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, photo=[{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}])
+        elif method in ('editMessageText', 'editMessageReplyMarkup'):
+            result = self._message(chat_id, text=str(params.get('text', ''))) if chat_id is not None else True
+        else:
+            result = True
+        if chat_id is not None:
+            self._outbox[chat_id].put_nowait((method, params, result))
+        return web.json_response({'ok': True, 'result': result})
+
+
+class FakeYooKassa:
+    """
+    Платежи YooKassa: POST /v3/payments создает платеж, GET /v3/payments/{id} возвращает его.
+    Платеж считается оплаченным сразу после создания (пользователь "перешел по ссылке").
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.payments: dict[str, dict] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v3/payments', self.create)
+        app.router.add_get('/v3/payments/{payment_id}', self.find)
+        return app
+
+    async def create(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        payment_id = str(uuid.uuid4())
+        payment = {
+            'id': payment_id, 'status': 'pending', 'paid': False, 'test': True,
+            'amount': params['amount'], 'description': params.get('description', ''),
+            'metadata': params.get('metadata', {}),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'confirmation': {'type': 'redirect', 'confirmation_url': f'https://yookassa.test/pay/{payment_id}'},
+            'recipient': {'account_id': '1', 'gateway_id': '1'}, 'refundable': False,
+        }
+        self.payments[payment_id] = payment
+        return web.json_response(payment)
+
+    async def find(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        payment = self.payments.get(request.match_info['payment_id'])
+        if payment is None:
+            return web.json_response({'type': 'error', 'code': 'not_found'}, status=404)
+        payment = dict(payment, status='succeeded', paid=True)
+        return web.json_response(payment)
@@ -0,0 +1,352 @@
+"""
+Нагрузочный тест bot.py от начала до конца.
+
+Бот запускается отдельным процессом в режиме polling против фейкового Bot API (getUpdates,
+sendMessage, sendVideo, editMessageText, ...) и фейковой YooKassa (benchmarks/fakes.py)
+с временной БД и синтетическими уроками. N виртуальных пользователей одновременно проходят
+сценарий /start → согласие → регистрация → оплата → все уроки курса; для каждого шага
+измеряется время от отправки update до ответа бота.
+
+Отчет: пропускная способность (update/с), p50/p95/p99 по шагам, объем загруженных видео
+и время БД (по /metrics бота). Для проверки регрессий в CI:
+    python benchmarks/load_test.py --users 200 --output result.json
+    python benchmarks/load_test.py --users 200 --baseline benchmarks/baseline.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Callable, Optional
+import aiohttp
+from fakes import FakeBotApi, FakeYooKassa, free_port, start_app
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from migrations import migrate  # noqa: E402
+
+TOKEN = '123456:loadtest'
+ADMIN_ID = 1
+FIRST_CHAT_ID = 100_000
+
+# Проверка вызова бота: (метод, параметры) -> это ожидаемый ответ на шаг
+Expect = Callable[[str, dict], bool]
+
+
+def _markup_has(params: dict, callback_data: str) -> bool:
+    return callback_data in json.dumps(params.get('reply_markup') or {})
+
+
+def _next_lesson(params: dict) -> Optional[str]:
+    for row in (params.get('reply_markup') or {}).get('inline_keyboard', []):
+        for button in row:
+            if button.get('callback_data', '').isdigit():
+                return button['callback_data']
+    return None
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Перцентиль методом ближайшего ранга (values отсортированы)."""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def prepare_workdir(workdir: Path, lessons: int, video_bytes: int, seed: int) -> None:
+    """Временная БД с уроками и видео файлы уроков (случайные данные фиксированного размера)."""
+    with closing(sqlite3.connect(workdir / 'sales_in_stories.db')) as conn:
+        migrate(conn)
+        with conn:
+            conn.executemany(
+                "INSERT INTO tasks (task_id, task_name, task_content, task_link) VALUES (?, ?, ?, ?)",
+                [(task_id, f'Урок {task_id}', f'Задание урока {task_id}. ' * 10, None)
+                 for task_id in range(1, lessons + 1)]
+            )
+    videos = workdir / 'videos'
+    videos.mkdir()
+    rng = random.Random(seed)
+    for task_id in range(1, lessons + 1):
+        (videos / f'task_{task_id}.mp4').write_bytes(rng.randbytes(video_bytes))
+
+
+def start_bot(workdir: Path, api_url: str, yookassa_url: str, metrics_port: int,
+              concurrent_updates: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        ADMIN_ID=str(ADMIN_ID),
+        BOT_RUN_MODE='polling',
+        TELEGRAM_API_BASE_URL=api_url,
+        YOOKASSA_API_URL=yookassa_url + '/v3',
+        YOOKASSA_SHOP_ID='1',
+        YOOKASSA_SECRET_KEY='test',
+        WEB_SERVER_HOST='127.0.0.1',
+        WEB_SERVER_PORT=str(metrics_port),
+        CONCURRENT_UPDATES=str(concurrent_updates),
+        LESSON_DRIP='0',
+        PAYMENT_RECONCILE_INTERVAL='3600',
+        VIDEO_DOWNLOAD_WORKERS='1',
+    )
+    log = open(workdir / 'bot.log', 'w')
+    return subprocess.Popen([sys.executable, str(ROOT / 'bot.py')], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+class VirtualUser:
+    """Пользователь бота: отправляет update и ждет ответ бота в своем чате."""
+
+    def __init__(self, api: FakeBotApi, chat_id: int, timeout: float) -> None:
+        self.api = api
+        self.chat_id = chat_id
+        self.timeout = timeout
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'user{chat_id}'}
+        self.chat = {'id': chat_id, 'type': 'private', 'first_name': 'Load'}
+        self.message_id = 0  # Сообщение бота, к которому относится следующая кнопка
+        self._client_message_id = 0
+        self.outbox = api.outbox(chat_id)
+
+    def send_text(self, text: str) -> None:
+        self._client_message_id += 1
+        message: dict[str, Any] = {'message_id': self._client_message_id, 'date': int(time.time()),
+                                   'chat': self.chat, 'from': self.user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.api.push_update({'message': message})
+
+    def press(self, data: str) -> None:
+        self.api.push_update({'callback_query': {
+            'id': uuid.uuid4().hex, 'from': self.user, 'chat_instance': str(self.chat_id), 'data': data,
+            'message': {'message_id': self.message_id, 'date': int(time.time()), 'chat': self.chat, 'text': '.'},
+        }})
+
+    async def expect(self, check: Expect) -> dict:
+        """Ждет вызов бота, удовлетворяющий check (остальные вызовы пропускаются)."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            method, params, result = await asyncio.wait_for(self.outbox.get(), deadline - time.monotonic())
+            if check(method, params):
+                if isinstance(result, dict) and 'message_id' in result:
+                    self.message_id = result['message_id']
+                return params
+
+
+class LoadTest:
+    def __init__(self, api: FakeBotApi, users: int, lessons: int, timeout: float, ramp: float) -> None:
+        self.api = api
+        self.users = users
+        self.lessons = lessons
+        self.timeout = timeout
+        self.ramp = ramp
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.updates = 0
+        self.completed = 0
+        self.errors: dict[str, int] = defaultdict(int)
+
+    async def step(self, user: VirtualUser, name: str, send: Callable[[], None], check: Expect) -> dict:
+        started = time.perf_counter()
+        send()
+        self.updates += 1
+        try:
+            params = await user.expect(check)
+        except asyncio.TimeoutError:
+            self.errors[name] += 1
+            raise
+        self.latencies[name].append(time.perf_counter() - started)
+        return params
+
+    async def scenario(self, index: int) -> None:
+        if self.ramp:
+            await asyncio.sleep(self.ramp * index / self.users)
+        user = VirtualUser(self.api, FIRST_CHAT_ID + index, self.timeout)
+        chat_id = user.chat_id
+        sent = lambda method: (lambda m, p: m == method)  # noqa: E731
+        try:
+            await self.step(user, 'start', lambda: user.send_text('/start'),
+                            lambda m, p: m == 'sendMessage' and _markup_has(p, 'consent_yes'))
+            await self.step(user, 'consent', lambda: user.press('consent_yes'), sent('editMessageText'))
+            for value in ('Иван', 'Петров', f'user{chat_id}@example.com', f'+7 (999) {chat_id % 10 ** 7:07d}'):
+                await self.step(user, 'registration', lambda: user.send_text(value), sent('sendMessage'))
+            await self.step(user, 'registration', lambda: user.send_text(f'user{chat_id}'),
+                            lambda m, p: m == 'sendMessage' and _markup_has(p, 'has_promo_no'))
+            await self.step(user, 'registration', lambda: user.press('has_promo_no'), sent('editMessageText'))
+            await self.step(user, 'start', lambda: user.send_text('/start'),
+                            lambda m, p: m == 'sendMessage' and _markup_has(p, 'buy_course'))
+            await self.step(user, 'payment', lambda: user.press('buy_course'),
+                            lambda m, p: m == 'sendMessage' and _markup_has(p, 'check_pay'))
+            await self.step(user, 'payment', lambda: user.press('check_pay'),
+                            lambda m, p: m == 'sendMessage' and _markup_has(p, 'start_course'))
+            data: Optional[str] = 'start_course'
+            for _ in range(self.lessons):
+                params = await self.step(user, 'lesson', lambda: user.press(data), sent('sendVideo'))
+                data = _next_lesson(params)
+                if data is None:
+                    break
+            self.completed += 1
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(self.scenario(index) for index in range(self.users)))
+        return time.perf_counter() - started
+
+
+async def scrape_metrics(url: str) -> dict[str, float]:
+    """Суммы метрик бота по имени (без учета меток)."""
+    totals: dict[str, float] = defaultdict(float)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            text = await response.text()
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        totals[name.split('{', 1)[0]] += float(value)
+    return totals
+
+
+async def wait_ready(api: FakeBotApi, metrics_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError('Бот завершился при запуске (см. bot.log)')
+            try:
+                async with session.get(metrics_url) as response:
+                    if response.status == 200 and api.calls['getUpdates']:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError('Бот не запустился')
+            await asyncio.sleep(0.2)
+
+
+def summarize(test: LoadTest, elapsed: float, metrics: dict[str, float], api: FakeBotApi) -> dict:
+    steps = {}
+    all_latencies: list[float] = []
+    for name, values in test.latencies.items():
+        values.sort()
+        all_latencies.extend(values)
+        steps[name] = {'count': len(values), **{f'p{q}': percentile(values, q) for q in (50, 95, 99)}}
+    all_latencies.sort()
+    steps['all'] = {'count': len(all_latencies), **{f'p{q}': percentile(all_latencies, q) for q in (50, 95, 99)}}
+    return {
+        'users': test.users,
+        'completed': test.completed,
+        'errors': dict(test.errors),
+        'elapsed_seconds': elapsed,
+        'updates_per_second': test.updates / elapsed if elapsed else 0.0,
+        'steps': steps,
+        'upload_bytes': metrics.get('bot_upload_bytes_total', 0.0),
+        'upload_bytes_received': api.upload_bytes,
+        'db_seconds': metrics.get('db_query_seconds_sum', 0.0),
+        'db_calls': metrics.get('db_query_seconds_count', 0.0),
+        'handler_seconds': metrics.get('bot_handler_seconds_sum', 0.0),
+        'bot_api_calls': dict(api.calls),
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"Пользователей: {result['users']}, завершили сценарий: {result['completed']}, ошибки: {result['errors'] or 'нет'}")
+    print(f"Время: {result['elapsed_seconds']:.1f} с, пропускная способность: {result['updates_per_second']:.1f} update/с")
+    print(f"{'шаг':<14}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, stats in result['steps'].items():
+        print(f"{name:<14}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+    print(f"Загружено видео: {result['upload_bytes'] / 1024 ** 2:.1f} МБ, "
+          f"БД: {result['db_seconds']:.2f} с за {int(result['db_calls'])} вызовов, "
+          f"обработчики: {result['handler_seconds']:.2f} с")
+
+
+def compare(result: dict, baseline: dict, tolerance: float, latency_floor: float) -> list[str]:
+    """Регрессии относительно baseline: падение пропускной способности или рост p95 больше tolerance."""
+    problems = []
+    if result['errors']:
+        problems.append(f"ошибки сценария: {result['errors']}")
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - tolerance):
+        problems.append(f"пропускная способность {result['updates_per_second']:.1f} < "
+                        f"{baseline['updates_per_second']:.1f} update/с")
+    for name, stats in baseline['steps'].items():
+        current = result['steps'].get(name)
+        if current is None:
+            continue
+        # Небольшие абсолютные колебания (latency_floor) не считаются регрессией
+        limit = max(stats['p95'] * (1 + tolerance), stats['p95'] + latency_floor)
+        if current['p95'] > limit:
+            problems.append(f"{name}: p95 {current['p95'] * 1000:.1f} мс > {limit * 1000:.1f} мс")
+    if result['db_seconds'] > baseline['db_seconds'] * (1 + tolerance) + latency_floor:
+        problems.append(f"время БД {result['db_seconds']:.2f} с > {baseline['db_seconds']:.2f} с")
+    return problems
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с фейковыми Telegram и YooKassa')
+    parser.add_argument('--users', type=int, default=100, help='число виртуальных пользователей')
+    parser.add_argument('--lessons', type=int, default=12)
+    parser.add_argument('--video-kb', type=int, default=256, help='размер видео урока, КБ')
+    parser.add_argument('--ramp', type=float, default=0.0, help='запуск пользователей равномерно за N секунд')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='задержка ответа Bot API, с')
+    parser.add_argument('--yookassa-latency', type=float, default=0.05, help='задержка ответа YooKassa, с')
+    parser.add_argument('--concurrent-updates', type=int, default=32, help='CONCURRENT_UPDATES бота')
+    parser.add_argument('--timeout', type=float, default=60.0, help='ожидание ответа на шаг, с')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='сохранить результат в JSON')
+    parser.add_argument('--workdir', help='каталог для БД, видео и bot.log (по умолчанию временный, удаляется)')
+    parser.add_argument('--baseline', help='сравнить с результатом из JSON и завершиться с кодом 1 при регрессии')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимое ухудшение относительно baseline')
+    parser.add_argument('--latency-floor', type=float, default=0.01, help='допустимый абсолютный рост p95, с')
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.api_latency)
+    yookassa = FakeYooKassa(args.yookassa_latency)
+    api_runner, api_url = await start_app(api.app())
+    yookassa_runner, yookassa_url = await start_app(yookassa.app())
+    metrics_port = free_port()
+    metrics_url = f'http://127.0.0.1:{metrics_port}/metrics'
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir or tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        prepare_workdir(workdir, args.lessons, args.video_kb * 1024, args.seed)
+        process = start_bot(workdir, api_url, yookassa_url, metrics_port, args.concurrent_updates)
+        try:
+            await wait_ready(api, metrics_url, process)
+            test = LoadTest(api, args.users, args.lessons, args.timeout, args.ramp)
+            elapsed = await test.run()
+            result = summarize(test, elapsed, await scrape_metrics(metrics_url), api)
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            await api_runner.cleanup()
+            await yookassa_runner.cleanup()
+        if result['errors']:
+            # Лог бота удаляется вместе с временным каталогом
+            log_tail = (workdir / 'bot.log').read_text(errors='replace').splitlines()[-40:]
+            print('\n'.join(log_tail), file=sys.stderr)
+
+    print_report(result)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.baseline:
+        problems = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance, args.latency_floor)
+        for problem in problems:
+            print(f'РЕГРЕССИЯ: {problem}', file=sys.stderr)
+        return 1 if problems else 0
+    return 0 if not result['errors'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
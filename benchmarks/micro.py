@@ -0,0 +1,371 @@
+"""
+Микробенчмарки функций, которые выполняются на каждом update.
+
+Каждый бенчмарк запускается на синтетических БД с 1k, 100k и 1M пользователей
+(БД строятся один раз и кэшируются в --data-dir). Результаты — медиана/минимум времени
+одной операции; их можно сохранить как JSON baseline и сравнивать с ним
+(baseline зависит от машины: сравнивайте результаты, снятые на одном и том же железе):
+    python benchmarks/micro.py --save benchmarks/baselines/micro.json
+    python benchmarks/micro.py --compare benchmarks/baselines/micro.json --tolerance 0.3
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+# Модули бота читают настройки при импорте
+os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+os.environ.setdefault('ADMIN_ID', '1')
+
+from db import Database  # noqa: E402
+from dialogs import REGISTRATION, normalize_phone, validate_email  # noqa: E402
+from lesson_catalog import LessonCatalog  # noqa: E402
+from drip import LessonScheduler  # noqa: E402
+from migrations import migrate  # noqa: E402
+from promo import PromoService, format_promo_time  # noqa: E402
+from reports import write_report  # noqa: E402
+from users import UserRepository  # noqa: E402
+
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+FIRST_CHAT_ID = 1_000_000
+LESSONS = 12
+PROMOS = 200
+RUTUBE_URL = 'https://rutube.ru/video/private/0123456789abcdef0123456789abcdef/?r=wd&p=AbC-123_xyz'
+
+
+def build_database(path: Path, users: int, seed: int = 1) -> None:
+    """Синтетическая БД: users пользователей, ~30% оплатили, ~5% с платежом pending, промокоды и уроки."""
+    rng = random.Random(seed)
+    tmp = path.with_suffix('.tmp')
+    tmp.unlink(missing_ok=True)
+    with closing(sqlite3.connect(tmp)) as conn:
+        migrate(conn)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        start = datetime(2024, 1, 1)
+        with conn:
+            conn.executemany(
+                "INSERT INTO tasks (task_id, task_name, task_content, task_link) VALUES (?, ?, ?, ?)",
+                [(task_id, f'Урок {task_id}', f'Задание урока {task_id}. ' * 10, None) for task_id in range(1, LESSONS + 1)]
+            )
+            conn.executemany("""
+                INSERT INTO promo (promo_key, promo_price, promo_start_period, promo_end_period, max_uses)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(f'PROMO{index}', 1000 + index, format_promo_time(start), format_promo_time(datetime(2099, 1, 1)),
+                   None if index % 2 else 1_000_000) for index in range(PROMOS)])
+            batch = 50_000
+            for offset in range(0, users, batch):
+                user_rows, payment_rows, schedule_rows = [], [], []
+                for chat_id in range(FIRST_CHAT_ID + offset, FIRST_CHAT_ID + min(offset + batch, users)):
+                    created = start + timedelta(seconds=rng.randrange(365 * 86400))
+                    created_text = created.strftime('%Y-%m-%d %H:%M:%S')
+                    user_rows.append((chat_id, created_text, 'Иван', 'Петров', f'user{chat_id}', '+79991234567',
+                                      f'user{chat_id}@example.com', 1, 1,
+                                      f'PROMO{chat_id % PROMOS}' if chat_id % 10 == 0 else None))
+                    roll = rng.random()
+                    if roll < 0.35:
+                        status = 'succeeded' if roll < 0.30 else 'pending'
+                        payment_rows.append((chat_id, f'pay-{chat_id}', status, 1990.0, created_text,
+                                             created_text if status == 'succeeded' else None))
+                        if status == 'succeeded':
+                            schedule_rows.append((chat_id, rng.randint(1, LESSONS), '10:00', 180, created_text))
+                conn.executemany("""
+                    INSERT INTO users (chat_id, created_at, first_name, last_name, username, phone, email,
+                                       consent_agreed, registered, promo_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, user_rows)
+                conn.executemany("""
+                    INSERT INTO payments (chat_id, yookassa_payment_id, status, amount, created_at, paid_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, payment_rows)
+                conn.executemany("""
+                    INSERT INTO lesson_schedule (chat_id, unlocked_task_id, send_time, utc_offset, released_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, schedule_rows)
+        conn.execute("ANALYZE")
+    tmp.replace(path)
+
+
+def database_for(data_dir: Path, users: int) -> Path:
+    path = data_dir / f'users_{users}.db'
+    if not path.exists():
+        started = time.perf_counter()
+        build_database(path, users)
+        print(f'БД на {users} пользователей построена за {time.perf_counter() - started:.1f} с', file=sys.stderr)
+    return path
+
+
+class Stats(NamedTuple):
+    median_us: float
+    min_us: float
+    mean_us: float
+    rounds: int
+    number: int
+
+
+def _stats(samples: list[float], number: int) -> Stats:
+    per_op = [sample / number * 1e6 for sample in samples]
+    return Stats(statistics.median(per_op), min(per_op), statistics.fmean(per_op), len(samples), number)
+
+
+def measure(func: Callable[[], Any], number: int, rounds: int) -> Stats:
+    func()  # Прогрев
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append(time.perf_counter() - started)
+    return _stats(samples, number)
+
+
+async def measure_async(func: Callable[[], Awaitable[Any]], number: int, rounds: int) -> Stats:
+    await func()
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(number):
+            await func()
+        samples.append(time.perf_counter() - started)
+    return _stats(samples, number)
+
+
+async def measure_concurrent(func: Callable[[int], Awaitable[Any]], concurrency: int, rounds: int) -> Stats:
+    """Время на операцию при concurrency одновременных вызовах (для group commit)."""
+    await asyncio.gather(*(func(index) for index in range(concurrency)))
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await asyncio.gather(*(func(index) for index in range(concurrency)))
+        samples.append(time.perf_counter() - started)
+    return _stats(samples, concurrency)
+
+
+class Context:
+    """Объекты бота поверх одной синтетической БД."""
+
+    def __init__(self, path: Path, users: int, seed: int) -> None:
+        self.users = users
+        self.rng = random.Random(seed)
+        self.db = Database(str(path), workers=4)
+        self.repository = UserRepository(self.db)
+        self.catalog = LessonCatalog(self.db)
+        self.scheduler = LessonScheduler(self.db, self.catalog)
+        self.promos = PromoService(self.db)
+
+    async def start(self) -> None:
+        await self.catalog.reload()
+        await self.promos.reload()
+
+    def chat_id(self) -> int:
+        return FIRST_CHAT_ID + self.rng.randrange(self.users)
+
+    async def close(self) -> None:
+        await self.repository.close()
+        self.db.close()
+
+
+# name -> async (ctx, rounds) -> Stats; size_dependent=False — результат не зависит от размера БД
+Benchmark = Callable[[Context, int], Awaitable[Stats]]
+BENCHMARKS: dict[str, tuple[Benchmark, bool]] = {}
+
+
+def benchmark(name: str, size_dependent: bool = True) -> Callable[[Benchmark], Benchmark]:
+    def register(func: Benchmark) -> Benchmark:
+        BENCHMARKS[name] = (func, size_dependent)
+        return func
+    return register
+
+
+@benchmark('get_user')
+async def bench_get_user(ctx: Context, rounds: int) -> Stats:
+    return await measure_async(lambda: ctx.repository.get(ctx.chat_id()), 200, rounds)
+
+
+@benchmark('user_status_miss')
+async def bench_user_status_miss(ctx: Context, rounds: int) -> Stats:
+    async def status() -> None:
+        chat_id = ctx.chat_id()
+        ctx.repository.invalidate(chat_id)
+        await ctx.repository.status(chat_id)
+    return await measure_async(status, 200, rounds)
+
+
+@benchmark('user_status_hit')
+async def bench_user_status_hit(ctx: Context, rounds: int) -> Stats:
+    chat_ids = [ctx.chat_id() for _ in range(100)]
+    for chat_id in chat_ids:
+        await ctx.repository.status(chat_id)
+    paid = [chat_id for chat_id in chat_ids if (await ctx.repository.status(chat_id)).paid] or chat_ids
+    return await measure_async(lambda: ctx.repository.status(ctx.rng.choice(paid)), 2000, rounds)
+
+
+@benchmark('update_user_fields')
+async def bench_update_user_fields(ctx: Context, rounds: int) -> Stats:
+    repository = UserRepository(ctx.db, flush_interval=0)
+    try:
+        return await measure_async(lambda: repository.update(ctx.chat_id(), first_name='Анна'), 100, rounds)
+    finally:
+        await repository.close()
+
+
+@benchmark('update_user_fields_x64')
+async def bench_update_user_fields_concurrent(ctx: Context, rounds: int) -> Stats:
+    return await measure_concurrent(lambda _: ctx.repository.update(ctx.chat_id(), last_name='Смирнова'), 64, rounds)
+
+
+@benchmark('validate_promo', size_dependent=False)
+async def bench_validate_promo(ctx: Context, rounds: int) -> Stats:
+    now = datetime.now()
+    return measure(lambda: ctx.promos.get_active(f'PROMO{ctx.rng.randrange(PROMOS)}', now), 20000, rounds)
+
+
+@benchmark('redeem_promo')
+async def bench_redeem_promo(ctx: Context, rounds: int) -> Stats:
+    return await measure_async(lambda: ctx.promos.redeem(f'PROMO{ctx.rng.randrange(PROMOS)}', ctx.chat_id()), 100, rounds)
+
+
+@benchmark('validate_email', size_dependent=False)
+async def bench_validate_email(ctx: Context, rounds: int) -> Stats:
+    return measure(lambda: validate_email('ivan.petrov+course@example-mail.ru'), 20000, rounds)
+
+
+@benchmark('validate_phone', size_dependent=False)
+async def bench_validate_phone(ctx: Context, rounds: int) -> Stats:
+    return measure(lambda: normalize_phone('+7 (999) 123-45-67'), 20000, rounds)
+
+
+@benchmark('registration_step', size_dependent=False)
+async def bench_registration_step(ctx: Context, rounds: int) -> Stats:
+    """Выбор шага регистрации по состоянию, проверка и нормализация ввода (без Telegram и БД)."""
+    answers = [('name', 'Иван'), ('surname', 'Петров'), ('email', 'Ivan@Example.com'),
+               ('phone', '8 (999) 123-45-67'), ('username', 'ivan')]
+    return measure(lambda: [REGISTRATION.handle(state, text) for state, text in answers], 5000, rounds)
+
+
+@benchmark('lesson_lookup')
+async def bench_lesson_lookup(ctx: Context, rounds: int) -> Stats:
+    """Проверки кнопки урока: статус пользователя, открытый урок по расписанию и урок из каталога."""
+    async def lookup() -> None:
+        chat_id = ctx.chat_id()
+        status = await ctx.repository.status(chat_id)
+        if status.paid:
+            await ctx.scheduler.unlocked_task_id(chat_id)
+        ctx.catalog.get(ctx.rng.randint(1, LESSONS))
+    return await measure_async(lookup, 200, rounds)
+
+
+@benchmark('prepare_report_csv')
+async def bench_prepare_report(ctx: Context, rounds: int) -> Stats:
+    def report(conn: sqlite3.Connection) -> None:
+        path, _ = write_report(conn, 'csv')
+        os.remove(path)
+    # Отчет по 1M пользователей — несколько секунд, поэтому раундов меньше
+    return await measure_async(lambda: ctx.db.run(report), 1, max(1, rounds // 2) if ctx.users >= 1_000_000 else rounds)
+
+
+@benchmark('extract_rutube_video_id', size_dependent=False)
+async def bench_extract_rutube(ctx: Context, rounds: int) -> Stats:
+    from download_video import extract_rutube_video_id
+    return measure(lambda: extract_rutube_video_id(RUTUBE_URL), 20000, rounds)
+
+
+async def run(sizes: list[int], only: Optional[list[str]], rounds: int, data_dir: Path, seed: int) -> dict:
+    results: dict[str, dict[str, dict]] = {}
+    selected = [name for name in BENCHMARKS if not only or any(fnmatch.fnmatch(name, pattern) for pattern in only)]
+    for index, users in enumerate(sizes):
+        source = database_for(data_dir, users)
+        with tempfile.TemporaryDirectory() as tmp:
+            # Бенчмарки пишут в БД: каждый запуск работает с копией
+            path = Path(tmp) / source.name
+            path.write_bytes(source.read_bytes())
+            ctx = Context(path, users, seed)
+            await ctx.start()
+            try:
+                for name in selected:
+                    func, size_dependent = BENCHMARKS[name]
+                    if not size_dependent and index:
+                        continue
+                    stats = await func(ctx, rounds)
+                    size = str(users) if size_dependent else '-'
+                    results.setdefault(name, {})[size] = stats._asdict()
+                    print(f'{name:<26}{size:>9}{stats.median_us:>12.1f} мкс{stats.min_us:>12.1f} мкс (мин)')
+            finally:
+                await ctx.close()
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'sqlite': sqlite3.sqlite_version,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Регрессии: время выросло больше чем на tolerance относительно baseline.
+    Сравнивается минимум по раундам — он меньше всего зависит от фоновой нагрузки на машине.
+    """
+    problems = []
+    for name, sizes in baseline['results'].items():
+        for size, base in sizes.items():
+            stats = current['results'].get(name, {}).get(size)
+            if stats is None:
+                continue
+            change = stats['min_us'] / base['min_us'] - 1 if base['min_us'] else 0.0
+            print(f'{name:<26}{size:>9}{base["min_us"]:>12.1f} → {stats["min_us"]:>10.1f} мкс ({change:+.0%})')
+            if change > tolerance:
+                problems.append(f'{name} [{size}]: {base["min_us"]:.1f} → {stats["min_us"]:.1f} мкс ({change:+.0%})')
+    return problems
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description='Микробенчмарки горячих функций бота')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='число пользователей в БД')
+    parser.add_argument('--only', nargs='+', help='имена бенчмарков (шаблоны fnmatch)')
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default=str(Path(tempfile.gettempdir()) / 'sale_bot_benchmarks'),
+                        help='каталог для кэша синтетических БД')
+    parser.add_argument('--save', help='сохранить результаты как baseline (JSON)')
+    parser.add_argument('--compare', help='сравнить с baseline и завершиться с кодом 1 при регрессии')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='допустимый рост времени относительно baseline')
+    parser.add_argument('--list', action='store_true', help='показать список бенчмарков')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return 0
+    data_dir = Path(args.data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    current = await run(args.sizes, args.only, args.rounds, data_dir, args.seed)
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.save).write_text(json.dumps(current, ensure_ascii=False, indent=2))
+    if args.compare:
+        problems = compare(current, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for problem in problems:
+            print(f'РЕГРЕССИЯ: {problem}', file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
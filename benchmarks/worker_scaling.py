@@ -0,0 +1,151 @@
+"""
+Нагрузочный стенд режима нескольких воркеров.
+
+Запускает фейковый Bot API (aiohttp), N процессов bot.py в режиме webhook с общей временной БД
+и отправляет M update (/help от разных пользователей) на воркеры по кругу, как балансировщик.
+Воркер пересылает update чужих чатов владельцу, ответ sendMessage приходит в фейковый API;
+пропускная способность — M / время до получения всех ответов.
+
+Пример:
+    python benchmarks/worker_scaling.py --workers 1 2 4 --updates 4000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+import aiohttp
+from fakes import FakeBotApi, free_port, start_app
+
+ROOT = Path(__file__).resolve().parent.parent
+TOKEN = '123456:benchmark'
+SECRET = 'benchmark-secret'
+ADMIN_ID = 1
+
+
+def make_update(update_id: int, chat_id: int) -> bytes:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': user['first_name']},
+            'from': user, 'text': '/help',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        },
+    }).encode()
+
+
+def start_workers(count: int, api_url: str, workdir: str, concurrent_updates: int) -> tuple[list[subprocess.Popen], list[str]]:
+    ports = [free_port() for _ in range(count)]
+    urls = [f'http://127.0.0.1:{port}' for port in ports]
+    processes = []
+    for worker_id, port in enumerate(ports):
+        env = dict(
+            os.environ,
+            BOT_TOKEN=TOKEN,
+            ADMIN_ID=str(ADMIN_ID),
+            BOT_RUN_MODE='webhook',
+            WEBHOOK_URL=urls[0],
+            WEBHOOK_SECRET=SECRET,
+            WEB_SERVER_HOST='127.0.0.1',
+            WEB_SERVER_PORT=str(port),
+            TELEGRAM_API_BASE_URL=api_url,
+            CONCURRENT_UPDATES=str(concurrent_updates),
+            LESSON_DRIP='0',
+            PAYMENT_RECONCILE_INTERVAL='3600',
+        )
+        if count > 1:
+            env.update(WORKER_ID=str(worker_id), WORKER_URLS=','.join(urls))
+        log = open(Path(workdir) / f'worker-{worker_id}.log', 'w')
+        processes.append(subprocess.Popen([sys.executable, str(ROOT / 'bot.py')], cwd=workdir, env=env,
+                                          stdout=log, stderr=subprocess.STDOUT))
+    return processes, urls
+
+
+async def wait_ready(session: aiohttp.ClientSession, urls: list[str], timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                async with session.get(url + '/metrics') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Воркер {url} не запустился')
+            await asyncio.sleep(0.2)
+
+
+async def run_case(api: FakeBotApi, api_url: str, workers: int, updates: int, users: int,
+                   concurrency: int, concurrent_updates: int) -> Optional[float]:
+    with tempfile.TemporaryDirectory() as workdir:
+        processes, urls = start_workers(workers, api_url, workdir, concurrent_updates)
+        try:
+            async with aiohttp.ClientSession() as session:
+                await wait_ready(session, urls)
+                already_sent = api.calls['sendMessage']
+                semaphore = asyncio.Semaphore(concurrency)
+                headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET, 'Content-Type': 'application/json'}
+
+                async def post(index: int) -> None:
+                    # Балансировщик: update распределяются по воркерам без учета chat_id
+                    body = make_update(index + 1, 10_000 + index % users)
+                    async with semaphore:
+                        async with session.post(urls[index % workers] + '/telegram/webhook',
+                                                data=body, headers=headers) as response:
+                            response.raise_for_status()
+
+                started = time.perf_counter()
+                await asyncio.gather(*(post(index) for index in range(updates)))
+                deadline = time.monotonic() + 300
+                while (answered := api.calls['sendMessage'] - already_sent) < updates:
+                    if time.monotonic() > deadline:
+                        print(f'  {workers} воркеров: получено {answered} из {updates} ответов', file=sys.stderr)
+                        return None
+                    await asyncio.sleep(0.01)
+                return updates / (time.perf_counter() - started)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Масштабирование бота по числу воркеров')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500, help='число разных chat_id')
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременных запросов к воркерам')
+    parser.add_argument('--concurrent-updates', type=int, default=32, help='CONCURRENT_UPDATES воркера')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа фейкового Bot API, с')
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.api_latency)
+    runner, api_url = await start_app(api.app())
+    print(f'CPU: {os.cpu_count()}, update: {args.updates}, пользователей: {args.users}')
+    baseline = None
+    try:
+        for workers in args.workers:
+            rate = await run_case(api, api_url, workers, args.updates, args.users,
+                                  args.concurrency, args.concurrent_updates)
+            if rate is None:
+                continue
+            baseline = baseline or rate / workers
+            print(f'{workers:>3} воркеров: {rate:8.1f} update/с, эффективность {rate / (baseline * workers):.0%}')
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,21 +1,45 @@
-import io
 import re
 import os
+import time
+import signal
 import asyncio
 import sqlite3
 import logging
-import subprocess
+from contextlib import closing
+from collections import OrderedDict
 from typing import Optional
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, InputFile, Message
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler
 from telegram.ext import filters
-from download_video import download_all_videos  # Импорт функции для скачивания всех видео
-from yookassa import Configuration, Payment
-import time
-from datetime import datetime
-import re
-import csv
+from telegram.error import BadRequest
+from download_video import VideoPrefetcher  # Фоновое скачивание видео уроков
+from admin_photo import AdminPhotoCache
+from lesson_catalog import Lesson, LessonCatalog
+from cache_versions import CacheVersionWatcher
+from promo import PromoService, format_promo_time, parse_promo_time
+from dialogs import ADMIN_PROMO, REGISTRATION, InputError
+from users import UserRepository
+from broadcast import BROADCAST_AUDIENCES, BroadcastManager
+from metrics import (LESSON_DELIVERY, UPLOAD_BYTES, VIDEO_SEND, cache_result, create_metrics_handler,
+                     instrument_handler, monitor_event_loop_lag)
+from drip import LessonScheduler, format_utc_offset, parse_send_time, parse_utc_offset
+from db import Database
+from migrations import migrate
+from media_cache import fits_caption, get_cached_video, save_cached_video, delete_cached_video
+from video_probe import DEFAULT_PROBE, probe_video
+from payment_gateway import PaymentGateway
+from reports import (REPORT_FORMATS, ReportFormatUnavailable, available_report_formats, last_report_time, record_report_run, report_filename,
+                     report_timestamp, write_report)
+from persistence import SQLitePersistence
+from web_server import WebServer
+from telegram_webhook import create_telegram_webhook_handler
+from update_processor import PerChatUpdateProcessor
+from workers import FORWARD_SECRET_HEADER, WorkerRouter
+from yookassa_webhook import FINAL_PAYMENT_STATUSES, create_yookassa_webhook_handler, reconcile_pending_payments
+from yookassa import Configuration
+import uuid
+from datetime import datetime, timedelta
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -32,6 +56,59 @@ if not ADMIN_ID:
 
 Configuration.account_id = os.getenv('YOOKASSA_SHOP_ID')
 Configuration.secret_key = os.getenv('YOOKASSA_SECRET_KEY')
+# Адрес API YooKassa (для тестового стенда; по умолчанию — адрес из SDK)
+if os.getenv('YOOKASSA_API_URL'):
+    Configuration.api_url = os.getenv('YOOKASSA_API_URL')
+
+# Встроенный HTTP сервер для уведомлений YooKassa (запускается, только если задан порт)
+WEB_SERVER_HOST = os.getenv('WEB_SERVER_HOST', '0.0.0.0')
+WEB_SERVER_PORT = os.getenv('WEB_SERVER_PORT')
+WEB_SERVER_TRUST_PROXY = os.getenv('WEB_SERVER_TRUST_PROXY', '0') == '1'
+YOOKASSA_WEBHOOK_PATH = os.getenv('YOOKASSA_WEBHOOK_PATH', '/yookassa/webhook')
+YOOKASSA_WEBHOOK_VERIFY_IP = os.getenv('YOOKASSA_WEBHOOK_VERIFY_IP', '1') == '1'
+# Период сверки платежей pending с YooKassa (на случай потерянных уведомлений), в секундах
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', '300'))
+# Период проверки cache_versions (изменения уроков и промокодов) для сброса кэшей, в секундах
+LESSON_CATALOG_CHECK_INTERVAL = int(os.getenv('LESSON_CATALOG_CHECK_INTERVAL', '60'))
+# Открытие уроков по одному в день в выбранное пользователем время (0 — все уроки доступны сразу)
+LESSON_DRIP = os.getenv('LESSON_DRIP', '1') == '1'
+# Метрики в формате Prometheus на встроенном HTTP сервере (по умолчанию доступны только с localhost)
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_LOCAL_ONLY = os.getenv('METRICS_LOCAL_ONLY', '1') == '1'
+
+# Режим получения update: polling (по умолчанию) или webhook через встроенный HTTP сервер
+BOT_RUN_MODE = os.getenv('BOT_RUN_MODE', 'polling')
+# Публичный https адрес сервера (без пути), на который Telegram отправляет update
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько update обрабатывать одновременно (update одного чата — всегда по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+# Адрес Bot API (например, локальный telegram-bot-api сервер или тестовый стенд)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+
+# Несколько воркеров (только webhook): общие БД и каталог videos, чаты распределены по воркерам
+# консистентным хешем chat_id. WORKER_URLS — внутренние адреса всех воркеров через запятую.
+WORKER_ID = int(os.getenv('WORKER_ID', '0'))
+WORKER_URLS = [url.strip() for url in os.getenv('WORKER_URLS', '').split(',') if url.strip()]
+WORKER_FORWARD_PATH = os.getenv('WORKER_FORWARD_PATH', '/internal/update')
+WORKER_FORWARD_SECRET = os.getenv('WORKER_FORWARD_SECRET') or WEBHOOK_SECRET
+worker_router = WorkerRouter(WORKER_ID, WORKER_URLS, WORKER_FORWARD_SECRET or '',
+                             forward_path=WORKER_FORWARD_PATH) if WORKER_URLS else None
+WORKER_COUNT = worker_router.workers if worker_router else 1
+# Ведущий воркер (владелец чата администратора) выполняет задачи в единственном экземпляре:
+# установку webhook, скачивание видео, рассылки и сверку платежей
+IS_LEADER = worker_router is None or worker_router.owner(int(ADMIN_ID)) == WORKER_ID
+
+# Фото профиля администратора для приветствия: скачивается один раз, далее отправляется по file_id
+admin_photo_cache = AdminPhotoCache(ADMIN_ID, ttl=float(os.getenv('ADMIN_PHOTO_TTL', '3600')))
+
+# Вызовы YooKassa: отдельный пул потоков, таймауты, повторы и circuit breaker
+payment_gateway = PaymentGateway(
+    max_workers=int(os.getenv('YOOKASSA_MAX_CONCURRENCY', '4')),
+    timeout=float(os.getenv('YOOKASSA_TIMEOUT', '15')),
+    attempts=int(os.getenv('YOOKASSA_ATTEMPTS', '3')),
+)
 
 # Настройка логирования для отслеживания событий и ошибок
 logging.basicConfig(
@@ -39,110 +116,69 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Подключение к базе данных SQLite (разрешение работы из разных потоков для polling)
-conn = sqlite3.connect('sales_in_stories.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# Создание таблицы tasks, если она не существует
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS tasks (
-        task_id INTEGER PRIMARY KEY,
-        task_name TEXT NOT NULL,
-        task_content TEXT NOT NULL,
-        task_link TEXT
-    )
-""")
-conn.commit()  # Фиксация создания таблицы
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER UNIQUE,
-        yookassa_payment_id TEXT UNIQUE,
-        status TEXT DEFAULT 'pending',
-        amount REAL,
-        description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        paid_at TIMESTAMP NULL
-    )
-""")
-conn.commit()
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        chat_id INTEGER PRIMARY KEY,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        first_name TEXT,
-        last_name TEXT,
-        username TEXT,
-        phone TEXT,
-        email TEXT UNIQUE,
-        consent_agreed INTEGER DEFAULT 0,
-        registered INTEGER DEFAULT 0,
-        link_clicked INTEGER DEFAULT 0,
-        promo_key TEXT,
-        promo_price REAL
-    )
-""")
-conn.commit()
-
-# Migration: add username if missing
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass  # Column already exists
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS promo (
-        promo_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        promo_key TEXT UNIQUE NOT NULL,
-        promo_price REAL NOT NULL,
-        promo_start_period TEXT NOT NULL,
-        promo_end_period TEXT NOT NULL
-    )
-""")
-conn.commit()
+# Асинхронный доступ к SQLite: запросы выполняются в пуле потоков БД, а не в event loop
+db = Database('sales_in_stories.db', workers=int(os.getenv('DB_WORKERS', '4')))
 
-def get_user(chat_id: int):
+# Видео уроков скачиваются в фоне, бот отвечает на сообщения сразу после запуска
+video_prefetcher = VideoPrefetcher(
+    db,
+    workers=int(os.getenv('VIDEO_DOWNLOAD_WORKERS', '3')),
+    attempts=int(os.getenv('VIDEO_DOWNLOAD_ATTEMPTS', '3')),
+)
+prefetch_task: Optional[asyncio.Task] = None
+
+# Схема БД: при актуальной версии выполняется только чтение PRAGMA user_version
+with closing(db.connect()) as startup_conn:
+    migrate(startup_conn)
+
+# Уроки курса в памяти (загружаются в post_init)
+lesson_catalog = LessonCatalog(db)
+
+# Сброс кэшей в памяти при изменениях, сделанных любым воркером или вручную в БД
+cache_watcher = CacheVersionWatcher(db)
+cache_watcher.subscribe('tasks', lesson_catalog.refresh_if_changed)
+
+# Данные пользователей: изменения разных пользователей фиксируются одной транзакцией
+# и статусы (согласие, регистрация, оплата) в LRU для проверок доступа без запроса к БД
+user_repository = UserRepository(
+    db,
+    flush_interval=float(os.getenv('USER_WRITE_FLUSH_MS', '5')) / 1000,
+    status_cache_size=int(os.getenv('USER_STATUS_CACHE_SIZE', '10000')),
+)
+cache_watcher.subscribe('user_status', user_repository.refresh_status_if_changed)
+
+# Промокоды в памяти (загружаются в post_init, сбрасываются при изменении cache_versions('promo'))
+promo_service = PromoService(db)
+cache_watcher.subscribe('promo', promo_service.refresh_if_changed)
+
+# Рассылки администратора с ограничением частоты Telegram (запускаются в post_init)
+broadcast_manager = BroadcastManager(
+    db,
+    int(ADMIN_ID),
+    # Лимит Telegram общий на бота, поэтому делится между воркерами (рассылка урока по расписанию идет с каждого)
+    rate=float(os.getenv('BROADCAST_RATE', '30')) / WORKER_COUNT,
+    concurrency=int(os.getenv('BROADCAST_CONCURRENCY', '10')),
+)
+
+# Расписание уроков: новый урок раз в день (время по умолчанию — 10:00 по Москве)
+lesson_scheduler = LessonScheduler(
+    db,
+    lesson_catalog,
+    default_send_time=parse_send_time(os.getenv('LESSON_SEND_TIME', '10:00')) or '10:00',
+    default_utc_offset=int(os.getenv('LESSON_UTC_OFFSET_MINUTES', '180')),
+)
+
+async def get_user(chat_id: int):
     """Get user data from DB."""
-    cursor.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    row = cursor.fetchone()
-    if row:
-        cols = [desc[0] for desc in cursor.description]
-        return dict(zip(cols, row))
-    return None
+    return await user_repository.get(chat_id)
 
-def ensure_user(chat_id: int):
+async def ensure_user(chat_id: int):
     """Ensure user record exists."""
-    cursor.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,))
-    conn.commit()
+    await user_repository.ensure(chat_id)
 
-def update_user_fields(chat_id: int, **kwargs):
+async def update_user_fields(chat_id: int, **kwargs):
     """Update or insert user fields."""
-    ensure_user(chat_id)
-    fields = ', '.join(f"{k}=?" for k in kwargs.keys())
-    values = list(kwargs.values()) + [chat_id]
-    cursor.execute(f"UPDATE users SET {fields} WHERE chat_id = ?", values)
-    conn.commit()
-
-def validate_email(email: str) -> bool:
-    pattern = r'^[a-zA-Z][a-zA-Z0-9_.+-]*@[a-zA-Z][a-zA-Z0-9-]*\.[a-zA-Z][a-zA-Z0-9-.]+$'
-    return bool(re.match(pattern, email))
-
-def validate_phone(phone: str) -> bool:
-    pattern = r'^\+?[\d\s\-\(\)]{10,15}$'
-    return bool(re.match(pattern, phone))
-
-def validate_promo(promo_key: str) -> Optional[float]:
-    """Validate promo and return price if valid."""
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute("""
-        SELECT promo_price FROM promo
-        WHERE promo_key = ? AND promo_start_period <= ? AND promo_end_period >= ?
-    """, (promo_key, now, now))
-    row = cursor.fetchone()
-    return row[0] if row else None
+    await user_repository.update(chat_id, **kwargs)
 
 def get_admin_keyboard() -> InlineKeyboardMarkup:
     """Admin menu keyboard."""
@@ -153,6 +189,21 @@ def get_admin_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("Промокод", callback_data='promo_menu')]
     ])
 
+def get_report_keyboard() -> InlineKeyboardMarkup:
+    """Report submenu keyboard."""
+    keyboard = [
+        [InlineKeyboardButton("Полный отчет (CSV)", callback_data='report_all_csv')],
+        [InlineKeyboardButton("Новые с прошлого отчета (CSV)", callback_data='report_new_csv')],
+        [InlineKeyboardButton("Полный отчет (CSV.GZ)", callback_data='report_all_gz')],
+    ]
+    if 'xlsx' in available_report_formats():
+        keyboard.append([InlineKeyboardButton("Полный отчет (XLSX)", callback_data='report_all_xlsx')])
+    keyboard.append([InlineKeyboardButton("← Назад", callback_data='admin_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+def report_usage() -> str:
+    return f"/report ГГГГ-ММ-ДД ГГГГ-ММ-ДД [{'|'.join(available_report_formats())}]"
+
 def get_promo_keyboard() -> InlineKeyboardMarkup:
     """Promo submenu keyboard."""
     return InlineKeyboardMarkup([
@@ -163,27 +214,57 @@ def get_promo_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("← Назад", callback_data='admin_menu')]
     ])
 
-def is_consent_and_registered(chat_id: int) -> bool:
-    """Check if user has consented and registered."""
-    user = get_user(chat_id)
+def user_is_consent_and_registered(user: Optional[dict]) -> bool:
+    """Check consent/registration flags of an already loaded user row."""
     return bool(user and user.get('consent_agreed', 0) == 1 and user.get('registered', 0) == 1)
 
+async def is_consent_and_registered(chat_id: int) -> bool:
+    """Check if user has consented and registered."""
+    return (await user_repository.status(chat_id)).consent_and_registered
+
 async def is_user_paid(chat_id: int) -> bool:
-    cursor.execute("SELECT 1 FROM payments WHERE chat_id = ? AND status = 'succeeded'", (chat_id,))
-    return cursor.fetchone() is not None
+    return await user_repository.is_paid(chat_id)
+
+async def get_pending_payment_url(chat_id: int, context: ContextTypes.DEFAULT_TYPE, amount: float) -> Optional[str]:
+    """
+    Возвращает ссылку на оплату уже созданного платежа, если он все еще ожидает оплаты
+    и сумма не изменилась (например, после применения промокода).
+    """
+    row = await db.fetchone(
+        "SELECT yookassa_payment_id, amount, confirmation_url FROM payments WHERE chat_id = ? AND status = 'pending'",
+        (chat_id,)
+    )
+    if not row:
+        return None
+    payment_id, pending_amount, confirmation_url = row
+    if not confirmation_url or pending_amount is None or abs(pending_amount - amount) >= 0.005:
+        return None
+    status = await fetch_payment_status(payment_id)
+    if status == 'pending':
+        return confirmation_url
+    await apply_payment_status(context.bot, payment_id, 'canceled' if status == 'rejected' else status)
+    return None
 
 async def create_payment(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
-    user = get_user(chat_id)
-    if not user or not is_consent_and_registered(chat_id):
+    user = await get_user(chat_id)
+    if not user or not user_is_consent_and_registered(user):
         logging.error(f"User not registered/consented: {chat_id}")
         return None
-    idempotency_key = f"course_{chat_id}_{int(time.time())}"
+    idempotency_key = f"course_{chat_id}_{uuid.uuid4().hex}"
     try:
         first_name = user.get('first_name', '') or ''
         last_name = user.get('last_name', '') or ''
         email = user.get('email', '')
         phone = user.get('phone', '')
         promo_price = user.get('promo_price') or float(os.getenv('COURSE_PRICE', '1990.00'))
+
+        # Повторное нажатие "Купить курс" не создает новый платеж, пока старый ожидает оплаты
+        pending_url = await get_pending_payment_url(chat_id, context, promo_price)
+        if pending_url:
+            return pending_url
+        if await is_user_paid(chat_id):
+            return None
+
         amount_value = f"{promo_price:.2f}"
         description = f"Оплата курса 'Продажи в сториз' для {first_name} {last_name} ({email}, {phone}) [{chat_id}]"
         metadata = {
@@ -199,7 +280,7 @@ async def create_payment(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> Op
         username = f"@{chat.username}" if chat.username else ''
         metadata["username"] = username
 
-        payment = Payment.create({
+        payment = await payment_gateway.create_payment({
             "amount": {
                 "value": amount_value,
                 "currency": "RUB"
@@ -214,83 +295,239 @@ async def create_payment(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> Op
         }, idempotency_key)
         
         # Store pending
-        cursor.execute("""
-            INSERT OR REPLACE INTO payments (chat_id, yookassa_payment_id, status, amount, description)
-            VALUES (?, ?, 'pending', ?, ?)
-        """, (chat_id, payment.id, promo_price, description))
-        conn.commit()
-        
-        return payment.confirmation.confirmation_url
+        confirmation_url = payment.confirmation.confirmation_url
+        await db.run(_store_pending_payment, chat_id, payment.id, promo_price, description, confirmation_url)
+
+        return confirmation_url
     except Exception as e:
         logging.error(f"Payment creation failed: {e}")
         return None
 
-async def check_payment(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    cursor.execute("SELECT yookassa_payment_id FROM payments WHERE chat_id = ? AND status = 'pending'", (chat_id,))
-    row = cursor.fetchone()
+def _supersede_pending_payment(conn: sqlite3.Connection, chat_id: int) -> None:
+    """Переносит платеж pending пользователя в payment_attempts: его ссылку еще можно оплатить."""
+    conn.execute("""
+        INSERT OR IGNORE INTO payment_attempts (yookassa_payment_id, chat_id, amount, created_at)
+        SELECT yookassa_payment_id, chat_id, amount, created_at FROM payments
+        WHERE chat_id = ? AND status = 'pending' AND yookassa_payment_id IS NOT NULL
+    """, (chat_id,))
+
+def _store_pending_payment(conn: sqlite3.Connection, chat_id: int, payment_id: str, amount: float,
+                           description: str, confirmation_url: str) -> None:
+    """Сохраняет новый платеж пользователя; прежний платеж pending остается в payment_attempts."""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _supersede_pending_payment(conn, chat_id)
+        conn.execute("""
+            INSERT INTO payments (chat_id, yookassa_payment_id, status, amount, description, confirmation_url)
+            VALUES (?, ?, 'pending', ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                yookassa_payment_id = excluded.yookassa_payment_id, status = 'pending', amount = excluded.amount,
+                description = excluded.description, confirmation_url = excluded.confirmation_url,
+                created_at = CURRENT_TIMESTAMP, paid_at = NULL, last_checked_at = NULL
+        """, (chat_id, payment_id, amount, description, confirmation_url))
+
+def _set_attempt_status(conn: sqlite3.Connection, payment_id: str, status: str) -> Optional[int]:
+    """
+    Итоговый статус замененного платежа. Оплата старой ссылки засчитывается: платеж снова становится
+    платежом пользователя, а текущий pending уходит в payment_attempts.
+    """
+    row = conn.execute(
+        "SELECT chat_id, amount FROM payment_attempts WHERE yookassa_payment_id = ? AND status = 'pending'",
+        (payment_id,)
+    ).fetchone()
     if not row:
-        return False
-    payment_id = row[0]
-    try:
-        payment = Payment.find_one(payment_id)
-        if payment.status == 'succeeded':
-            cursor.execute("""
+        return None
+    chat_id, amount = row
+    conn.execute("UPDATE payment_attempts SET status = ? WHERE yookassa_payment_id = ?", (status, payment_id))
+    if status != 'succeeded':
+        return None
+    if conn.execute("SELECT 1 FROM payments WHERE chat_id = ? AND status = 'succeeded'", (chat_id,)).fetchone():
+        logging.warning(f"Пользователь {chat_id} оплатил курс повторно (платеж {payment_id})")
+        return None
+    _supersede_pending_payment(conn, chat_id)
+    conn.execute("DELETE FROM payment_attempts WHERE yookassa_payment_id = ?", (payment_id,))
+    conn.execute("""
+        INSERT INTO payments (chat_id, yookassa_payment_id, status, amount, paid_at)
+        VALUES (?, ?, 'succeeded', ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            yookassa_payment_id = excluded.yookassa_payment_id, status = 'succeeded',
+            amount = excluded.amount, confirmation_url = NULL, paid_at = CURRENT_TIMESTAMP
+    """, (chat_id, payment_id, amount))
+    return chat_id
+
+def _set_payment_status(conn: sqlite3.Connection, payment_id: str, status: str) -> Optional[int]:
+    """Переводит платеж из pending в итоговый статус. Возвращает chat_id или None, если платеж уже обработан."""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT chat_id FROM payments WHERE yookassa_payment_id = ? AND status = 'pending'", (payment_id,)
+        ).fetchone()
+        if not row:
+            return _set_attempt_status(conn, payment_id, status)
+        if status == 'succeeded':
+            conn.execute("""
                 UPDATE payments SET status = 'succeeded', paid_at = CURRENT_TIMESTAMP
-                WHERE chat_id = ?
-            """, (chat_id,))
-            conn.commit()
-            return True
-        elif payment.status in ['canceled', 'rejected']:
-            cursor.execute("UPDATE payments SET status = ? WHERE chat_id = ?", (payment.status, chat_id))
-            conn.commit()
-    except Exception as e:
-        logging.error(f"Payment check failed: {e}")
+                WHERE yookassa_payment_id = ?
+            """, (payment_id,))
+        else:
+            conn.execute("UPDATE payments SET status = ? WHERE yookassa_payment_id = ?", (status, payment_id))
+        return row[0]
+
+async def apply_payment_status(bot: Bot, payment_id: str, status: str, notify: bool = True) -> bool:
+    """
+    Фиксирует итоговый статус платежа YooKassa (из уведомления, сверки или кнопки "Проверить оплату").
+    При успешной оплате отправляет пользователю подтверждение. Повторные вызовы ничего не меняют.
+    """
+    if status not in FINAL_PAYMENT_STATUSES:
+        return False
+    chat_id = await db.run(_set_payment_status, payment_id, status)
+    if chat_id is None:
+        return False
+    user_repository.invalidate(chat_id)
+    logging.info(f"Платеж {payment_id} пользователя {chat_id}: {status}")
+    if notify and status == 'succeeded':
+        try:
+            await bot.send_message(chat_id=chat_id, text="Оплата подтверждена! 🎉 Начинаем курс:", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Начать курс", callback_data='start_course')]]))
+        except Exception as e:
+            logging.error(f"Не удалось отправить подтверждение оплаты {chat_id}: {e}")
+    return True
+
+async def fetch_payment_status(payment_id: str) -> Optional[str]:
+    """Запрашивает текущий статус платежа в YooKassa через payment_gateway."""
+    payment = await payment_gateway.find_payment(payment_id)
+    return payment.status
+
+async def check_payment(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # Платеж мог уже быть подтвержден уведомлением YooKassa или сверкой
+    if await is_user_paid(chat_id):
+        return True
+    # Текущий платеж и прежние, замененные при смене суммы: оплаченной может оказаться старая ссылка
+    rows = await db.fetchall("""
+        SELECT yookassa_payment_id FROM payments WHERE chat_id = ? AND status = 'pending'
+        UNION ALL
+        SELECT yookassa_payment_id FROM payment_attempts WHERE chat_id = ? AND status = 'pending'
+    """, (chat_id, chat_id))
+    for (payment_id,) in rows:
+        try:
+            status = await fetch_payment_status(payment_id)
+            if status == 'rejected':
+                status = 'canceled'
+            await apply_payment_status(context.bot, payment_id, status, notify=False)
+            if status == 'succeeded':
+                return True
+        except Exception as e:
+            logging.error(f"Payment check failed: {e}")
     return False
 
+async def reconcile_payments_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая сверка платежей pending, для которых не пришло уведомление."""
+    await reconcile_pending_payments(
+        db, fetch_payment_status,
+        lambda payment_id, status: apply_payment_status(context.bot, payment_id, status)
+    )
+
 
-async def get_admin_photo(bot: Bot, admin_id: str) -> Optional[InputFile]:
+async def send_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int, fmt: str,
+                      since: Optional[str] = None, until: Optional[str] = None) -> None:
     """
-    Получает фото профиля администратора для приветственного сообщения.
+    Формирует отчет во временном файле в потоке БД и отправляет его документом.
+    Выгрузка записывается в report_runs только после отправки: при ошибке отправки
+    следующий отчет "новые с прошлого отчета" снова включит эти строки.
     """
+    started_at = report_timestamp()
     try:
-        # Получение информации о чате администратора
-        admin_chat = await bot.get_chat(admin_id)
-    except Exception as e:
-        # Логирование ошибки получения чата
-        logging.error(f"Ошибка получения чата админа {admin_id}: {e}")
-        return None  # Возврат None при ошибке
+        path, rows = await db.run(write_report, fmt, since, until)
+    except ReportFormatUnavailable as e:
+        await context.bot.send_message(chat_id=chat_id, text=str(e))
+        return
+    try:
+        UPLOAD_BYTES.inc(os.path.getsize(path), kind='report')
+        with open(path, 'rb') as report_file:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=InputFile(report_file, filename=report_filename(fmt)),
+                caption=f"Строк в отчете: {rows}" + (f" (с {since})" if since else "")
+            )
+        await db.run(record_report_run, started_at, fmt, since, until, rows)
+    finally:
+        os.remove(path)
 
-    if admin_chat and admin_chat.photo:
-        try:
-            # Логирование попытки получения фото
-            logging.info(f"Попытка получить фото профиля администратора {admin_id}")
-            # Получение файла фото
-            photo = await bot.get_file(admin_chat.photo.big_file_id)
-            logging.info(f"Получена информация о фото: {photo}")
-
-            if photo and photo.file_path:
-                # Логирование загрузки фото
-                logging.info(f"Загрузка фото по пути: {photo.file_path}")
-                # Скачивание фото как байтовый массив
-                photo_bytes = await photo.download_as_bytearray()
-
-                if photo_bytes:
-                    # Логирование размера фото
-                    logging.info(f"Размер загруженного фото: {len(photo_bytes)} байт")
-                    # Возврат фото как InputFile
-                    return InputFile(io.BytesIO(photo_bytes), filename='admin_photo.jpg')
-                else:
-                    # Предупреждение о пустом фото
-                    logging.warning("Не удалось загрузить фото: photo_bytes пуст")
-            else:
-                # Предупреждение об отсутствии пути к файлу
-                logging.warning("Не удалось получить file_path фото")
-        except Exception as e:
-            # Логирование ошибки обработки фото
-            logging.error(f"Ошибка при работе с фото профиля: {e}")
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /report [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [csv|gz|xlsx]: отчет за период (только для администратора).
+    """
+    if not update.message or str(update.message.chat.id) != ADMIN_ID:
+        return
+    args = list(context.args or [])
+    fmt = args.pop() if args and args[-1] in REPORT_FORMATS else 'csv'
+    try:
+        dates = [datetime.strptime(arg, '%Y-%m-%d') for arg in args[:2]]
+    except ValueError:
+        await update.message.reply_text(f"Формат: {report_usage()}")
+        return
+    since = dates[0].strftime('%Y-%m-%d %H:%M:%S') if dates else None
+    # Дата окончания включается в период целиком
+    until = (dates[1] + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S') if len(dates) > 1 else None
+    await send_report(context, update.message.chat.id, fmt, since=since, until=until)
 
-    # Возврат None, если фото недоступно
-    return None
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /broadcast <paid|unpaid|registered|all> [video=N] текст: рассылка (только для администратора).
+    """
+    if not update.message or str(update.message.chat.id) != ADMIN_ID:
+        return
+    usage = f"Формат: /broadcast <{'|'.join(BROADCAST_AUDIENCES)}> [video=N] текст"
+    # Текст берется из сообщения целиком, чтобы сохранить переносы строк
+    parts = (update.message.text or '').split(None, 2)
+    if len(parts) < 2 or parts[1] not in BROADCAST_AUDIENCES:
+        await update.message.reply_text(usage)
+        return
+    audience = parts[1]
+    text = parts[2] if len(parts) > 2 else ''
+    task_id = None
+    match = re.match(r'video=(\d+)\s*', text)
+    if match:
+        task_id = int(match.group(1))
+        text = text[match.end():]
+    try:
+        broadcast_id, total = await broadcast_manager.create(audience, text.strip() or None, task_id)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{usage}")
+        return
+    await update.message.reply_text(
+        f"Рассылка #{broadcast_id} поставлена в очередь: {total} получателей.\n"
+        f"Статус: /broadcast_status, отмена: /broadcast_cancel {broadcast_id}"
+    )
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /broadcast_status: последние рассылки и их прогресс (только для администратора).
+    """
+    if not update.message or str(update.message.chat.id) != ADMIN_ID:
+        return
+    rows = await broadcast_manager.recent()
+    if not rows:
+        await update.message.reply_text("Рассылок еще не было.")
+        return
+    lines = [f"#{bid} {audience}: {status}, отправлено {sent}/{total}, ошибок {failed}"
+             for bid, audience, status, total, sent, failed in rows]
+    await update.message.reply_text("\n".join(lines))
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /broadcast_cancel ID: отмена рассылки (только для администратора).
+    """
+    if not update.message or str(update.message.chat.id) != ADMIN_ID:
+        return
+    try:
+        broadcast_id = int((context.args or [''])[0])
+    except ValueError:
+        await update.message.reply_text("Формат: /broadcast_cancel ID")
+        return
+    if await broadcast_manager.cancel(broadcast_id):
+        await update.message.reply_text(f"Рассылка #{broadcast_id} отменена.")
+    else:
+        await update.message.reply_text(f"Рассылка #{broadcast_id} не найдена или уже завершена.")
 
 async def list_videos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -323,47 +560,363 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 /start - Запустить курс "Продажи в сториз за 12 дней"
 /help - Показать эту справку
+/lesson_time - Время получения нового урока (например, /lesson_time 09:00 +3)
 
 *Как пользоваться:*
 1. Нажмите /start для приветствия и оплаты (3990 ₽ через YooKassa).
 2. Купите курс → "Проверить оплату".
 3. После оплаты: "Начать курс 🎉" → уроки с видео + текстом.
-4. "Следующий урок" для перехода.
+4. Новый урок открывается каждый день в выбранное время и приходит в чат.
 
 Курс защищён оплатой. Тестовые карты YooKassa: 4111 1111 1111 1111.
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
-async def send_video(update: Update, context: ContextTypes.DEFAULT_TYPE, task_id: int) -> None:
-    chat_id = update.effective_chat.id
+# Загрузка видео урока в Telegram: одновременные первые отправки одного урока ждут одну загрузку
+video_upload_locks: dict[int, asyncio.Lock] = {}
+
+async def send_cached_video(context: ContextTypes.DEFAULT_TYPE, chat_id: int, task_id: int, video_path: str,
+                            caption: str, reply_markup: Optional[InlineKeyboardMarkup],
+                            record_metric: bool = True) -> Optional[Message]:
+    """Отправка по file_id без загрузки файла; None, если видео нет в кэше или file_id отклонен."""
+    cached = await db.run(get_cached_video, task_id, video_path)
+    if record_metric:
+        cache_result('media', cached is not None)
+    if not cached:
+        return None
+    started = time.perf_counter()
+    try:
+        message = await context.bot.send_video(
+            chat_id=chat_id,
+            video=cached.file_id,
+            caption=caption,
+            reply_markup=reply_markup,
+            height=cached.height,
+            width=cached.width,
+            duration=cached.duration,
+            protect_content=True
+        )
+    except BadRequest as e:
+        # file_id больше не действителен (например, сменился токен бота) — загружаем файл заново
+        logging.warning(f"file_id видео задачи {task_id} отклонен Telegram: {e}")
+        await db.run(delete_cached_video, task_id)
+        return None
+    VIDEO_SEND.observe(time.perf_counter() - started, source='file_id')
+    return message
+
+async def send_video(context: ContextTypes.DEFAULT_TYPE, chat_id: int, task_id: int,
+                     caption: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Optional[Message]:
+    """
+    Отправляет видео урока (по file_id, если оно уже загружалось в Telegram).
+    Возвращает отправленное сообщение или None, если файла нет или отправка не удалась.
+    """
     video_path = f"./videos/task_{task_id}.mp4"
     if not os.path.exists(video_path):
         logging.error(f"Видео файл не найден: {video_path}")
-        return
+        await context.bot.send_message(chat_id=chat_id, text="Видео к этому уроку ещё загружается, попробуйте открыть урок чуть позже.")
+        return None
+    caption = caption or f'Задание №{task_id}'
+
+    # Повторная отправка по file_id без загрузки файла, если видео уже было загружено в Telegram
+    message = await send_cached_video(context, chat_id, task_id, video_path, caption, reply_markup)
+    if message:
+        return message
+
+    lock = video_upload_locks.setdefault(task_id, asyncio.Lock())
+    async with lock:
+        # Пока ждали блокировку, видео мог загрузить другой пользователь
+        message = await send_cached_video(context, chat_id, task_id, video_path, caption, reply_markup,
+                                          record_metric=False)
+        if message:
+            return message
+        try:
+            probe = await probe_video(db, video_path)
+            if probe is None:
+                logging.warning(f"Не удалось получить размеры видео {video_path}, используем дефолт")
+                probe = DEFAULT_PROBE
+
+            started = time.perf_counter()
+            UPLOAD_BYTES.inc(os.path.getsize(video_path), kind='video')
+            with open(video_path, 'rb') as video_file:
+                message = await context.bot.send_video(
+                    chat_id=chat_id,
+                    video=video_file,
+                    caption=caption,
+                    reply_markup=reply_markup,
+                    height=probe.height,
+                    width=probe.width,
+                    duration=probe.duration,
+                    supports_streaming=True,
+                    protect_content=True
+                )
+            VIDEO_SEND.observe(time.perf_counter() - started, source='upload')
+            if message and message.video:
+                await db.run(save_cached_video, task_id, video_path, message.video)
+                logging.info(f"Видео задачи {task_id} закэшировано: file_id {message.video.file_id}")
+            return message
+        except Exception as e:
+            logging.error(f"Ошибка отправки видео для задачи {task_id}: {str(e)}")
+            return None
+
+async def remove_lesson_keyboard(bot: Bot, chat_id: int, message_id: int) -> None:
+    """Удаление кнопки "Следующий урок" с предыдущего сообщения урока (в фоне, ошибки не критичны)."""
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-             '-show_entries', 'stream=width,height', '-of', 'csv=s=x:p=0', video_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
-        if result.returncode == 0:
-            width, height = map(int, result.stdout.strip().split('x'))
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
+        logging.info(f"Удалена кнопка с предыдущего сообщения {message_id}")
+    except Exception as e:
+        logging.error(f"Не удалось отредактировать предыдущее сообщение: {e}")
+
+async def deliver_lesson(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lesson: Lesson) -> None:
+    """
+    Отправка урока: видео и текст.
+    Если текст помещается в подпись, урок уходит одним сообщением (видео с текстом и кнопкой).
+    Иначе видео и текст отправляются последовательно: Telegram упорядочивает сообщения
+    по времени получения, и параллельная отправка могла бы показать текст раньше видео.
+    Удаление кнопки с предыдущего урока выполняется в фоне и не задерживает ответ.
+    """
+    started = time.perf_counter()
+    timings: dict[str, float] = {}
+
+    previous_msg_id = context.user_data.get('last_task_message_id') if context.user_data else None
+    if previous_msg_id:
+        context.application.create_task(remove_lesson_keyboard(context.bot, chat_id, previous_msg_id))
+
+    single_message = fits_caption(lesson.text)
+    stage = time.perf_counter()
+    try:
+        if single_message:
+            message = await send_video(context, chat_id, lesson.task_id, lesson.text, lesson.reply_markup)
         else:
-            logging.warning(f"Не удалось получить размеры видео {video_path}, используем дефолт")
-            width, height = 640, 360
+            message = await send_video(context, chat_id, lesson.task_id)
+    except Exception as e:
+        # Логирование ошибки видео и отправка текста без видео
+        logging.error(f"Ошибка отправки видео: {e}")
+        await context.bot.send_message(chat_id=chat_id, text=f"Ошибка обработки видео: {str(e)}")
+        message = None
+    timings['video'] = time.perf_counter() - stage
+
+    if not single_message or message is None:
+        # Отправка текста задачи отдельным сообщением (длинный текст или видео не отправлено)
+        stage = time.perf_counter()
+        message = await context.bot.send_message(
+            chat_id=chat_id, text=lesson.text, reply_markup=lesson.reply_markup
+        )
+        timings['text'] = time.perf_counter() - stage
 
-        with open(video_path, 'rb') as video_file:
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=video_file,
-                caption=f'Задание №{task_id}',
-                height=height,
-                width=width,
-                protect_content=True
-            )
+    # Сохранение ID сообщения с кнопкой для удаления кнопки в следующий раз
+    if context.user_data is not None:
+        context.user_data['last_task_message_id'] = message.message_id
+
+    timings['total'] = time.perf_counter() - started
+    for name, seconds in timings.items():
+        LESSON_DELIVERY.observe(seconds, stage=name)
+    logging.info(f"Урок {lesson.task_id} отправлен чату {chat_id}: " +
+                 ", ".join(f"{name}={seconds * 1000:.0f} мс" for name, seconds in timings.items()))
+
+async def send_admin_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, photo) -> Optional[Message]:
+    """Отправляет фото админа и запоминает file_id для следующих приветствий."""
+    async def send_photo(photo) -> Optional[Message]:
+        try:
+            return await context.bot.send_photo(chat_id=chat_id, photo=photo)
+        except BadRequest as e:
+            logging.warning(f"Не удалось отправить фото админа: {e}")
+            if isinstance(photo, str):
+                admin_photo_cache.invalidate_file_id()
+            return None
+
+    photo_message = await admin_photo_cache.send(photo, send_photo)
+    admin_photo_cache.remember(photo_message)
+    return photo_message
+
+async def refresh_admin_photo_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая проверка смены фото профиля администратора."""
+    await admin_photo_cache.refresh(context.bot)
+
+async def cache_versions_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая проверка cache_versions: перезагрузка каталога уроков и промокодов при изменении."""
+    try:
+        await cache_watcher.check()
+    except Exception as e:
+        logging.error(f"Ошибка проверки версий кэшей: {e}")
+
+async def reload_lessons_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /reload_lessons: перечитать уроки из БД (только для администратора).
+    """
+    if not update.message or str(update.message.chat.id) != ADMIN_ID:
+        return
+    try:
+        count = await lesson_catalog.reload()
+    except Exception as e:
+        logging.error(f"Ошибка перезагрузки каталога уроков: {e}")
+        await update.message.reply_text(f"Ошибка перезагрузки уроков: {str(e)}")
+        return
+    await update.message.reply_text(f"Уроки перезагружены: {count}")
+
+def format_next_lesson_time(next_due_at: datetime, utc_offset: int) -> str:
+    local = next_due_at + timedelta(minutes=utc_offset)
+    return f"{local.strftime('%d.%m в %H:%M')} ({format_utc_offset(utc_offset)})"
+
+async def drip_lessons_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Раз в минуту: открывает следующий урок всем, у кого наступило время, и отправляет уроки
+    одной волной через общий ограничитель частоты рассылок.
+    """
+    try:
+        # Каждый воркер открывает уроки только своим чатам
+        released = await lesson_scheduler.release_due(owns=worker_router.is_local if worker_router else None)
     except Exception as e:
-        logging.error(f"Ошибка отправки видео для задачи {task_id}: {str(e)}")
+        logging.error(f"Ошибка расписания уроков: {e}")
+        return
+    if not released:
+        return
+    started = time.perf_counter()
+    application = context.application
+    semaphore = asyncio.Semaphore(broadcast_manager.concurrency)
 
+    async def deliver(chat_id: int, task_id: int) -> None:
+        lesson = lesson_catalog.get(task_id)
+        if lesson is None:
+            return
+        async with semaphore:
+            # Длинный урок — два сообщения (видео и текст)
+            for _ in range(1 if fits_caption(lesson.text) else 2):
+                await broadcast_manager.bucket.acquire()
+            await broadcast_manager.per_chat.wait(chat_id)
+            # Контекст пользователя, чтобы deliver_lesson обновил его user_data (кнопка предыдущего урока)
+            user_context = application.context_types.context(application, chat_id=chat_id, user_id=chat_id)
+            try:
+                await deliver_lesson(user_context, chat_id, lesson)
+            except Exception as e:
+                # Урок уже открыт: пользователь может открыть его кнопкой
+                logging.error(f"Не удалось отправить урок {task_id} пользователю {chat_id}: {e}")
+
+    await asyncio.gather(*(deliver(chat_id, task_id) for chat_id, task_id in released))
+    application.mark_data_for_update_persistence(user_ids=[chat_id for chat_id, _ in released])
+    logging.info(f"Расписание: отправлено уроков {len(released)} за {time.perf_counter() - started:.1f} с")
+
+async def lesson_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /lesson_time ЧЧ:ММ [+3]: время получения нового урока (местное, смещение от UTC).
+    """
+    if not update.message:
+        return
+    chat_id = update.message.chat.id
+    if not LESSON_DRIP:
+        await update.message.reply_text("Все уроки курса доступны сразу.")
+        return
+    if not await is_user_paid(chat_id):
+        await update.message.reply_text("Доступ к курсу платный. Нажмите /start для оплаты.")
+        return
+    args = context.args or []
+    send_time = parse_send_time(args[0]) if args else None
+    utc_offset = parse_utc_offset(args[1]) if len(args) > 1 else None
+    if send_time is None or (len(args) > 1 and utc_offset is None):
+        schedule = await lesson_scheduler.get(chat_id)
+        current = f"Сейчас: {schedule.send_time} ({format_utc_offset(schedule.utc_offset)}).\n" if schedule else ""
+        await update.message.reply_text(f"{current}Формат: /lesson_time ЧЧ:ММ [смещение от UTC, например +3]")
+        return
+    next_due_at = await lesson_scheduler.set_send_time(chat_id, send_time, utc_offset)
+    schedule = await lesson_scheduler.get(chat_id)
+    text = f"✅ Новые уроки будут приходить в {send_time} ({format_utc_offset(schedule.utc_offset)})."
+    if next_due_at:
+        text += f"\nСледующий урок: {format_next_lesson_time(next_due_at, schedule.utc_offset)}."
+    await update.message.reply_text(text)
+
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '25'))
+
+# Имена пользователей, которые есть только в payments (кэш ответов get_chat)
+chat_name_cache: "OrderedDict[int, str]" = OrderedDict()
+CHAT_NAME_CACHE_SIZE = 2048
+
+def _fetch_users_page(conn: sqlite3.Connection, after_id: Optional[int], before_id: Optional[int], limit: int):
+    """Страница списка пользователей (keyset по chat_id) и общая статистика одним обращением к БД."""
+    if before_id is not None:
+        condition, params, order = "chat_id < ?", (before_id, before_id), "DESC"
+    else:
+        bound = after_id if after_id is not None else -2 ** 63
+        condition, params, order = "chat_id > ?", (bound, bound), "ASC"
+    rows = conn.execute(f"""
+        WITH ids AS (
+            SELECT chat_id FROM users WHERE {condition}
+            UNION
+            SELECT chat_id FROM payments WHERE {condition}
+        )
+        SELECT ids.chat_id,
+               u.chat_id IS NOT NULL AS registered,
+               u.first_name,
+               u.last_name,
+               COALESCE(MAX(p.status = 'succeeded'), 0) AS paid
+        FROM ids
+        LEFT JOIN users u ON u.chat_id = ids.chat_id
+        LEFT JOIN payments p ON p.chat_id = ids.chat_id
+        GROUP BY ids.chat_id
+        ORDER BY ids.chat_id {order}
+        LIMIT ?
+    """, (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+    totals = conn.execute("""
+        SELECT (SELECT COUNT(*) FROM users),
+               (SELECT COUNT(*) FROM payments WHERE status = 'succeeded')
+    """).fetchone()
+    return rows, has_more, totals
+
+async def get_chat_name(bot: Bot, chat_id: int) -> str:
+    """Имя из Telegram для chat_id без записи в users (с кэшированием)."""
+    cache_result('chat_name', chat_id in chat_name_cache)
+    if chat_id in chat_name_cache:
+        chat_name_cache.move_to_end(chat_id)
+        return chat_name_cache[chat_id]
+    try:
+        chat_obj = await bot.get_chat(chat_id)
+        name = f"{chat_obj.first_name or ''} {chat_obj.last_name or ''}".strip()
+    except Exception as e:
+        logging.error(f"Failed to fetch chat {chat_id}: {e}")
+        return ''
+    chat_name_cache[chat_id] = name
+    if len(chat_name_cache) > CHAT_NAME_CACHE_SIZE:
+        chat_name_cache.popitem(last=False)
+    return name
+
+async def build_users_page(context: ContextTypes.DEFAULT_TYPE, after_id: Optional[int] = None,
+                           before_id: Optional[int] = None) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура страницы "Список пользователей" с кнопками ← / →."""
+    rows, has_more, (total_registered, total_paid) = await db.run(
+        _fetch_users_page, after_id, before_id, USERS_PAGE_SIZE
+    )
+    # Имена тех, кто есть только в payments, запрашиваются у Telegram параллельно
+    missing = [cid for cid, registered, *_ in rows if not registered]
+    fetched = dict(zip(missing, await asyncio.gather(*(get_chat_name(context.bot, cid) for cid in missing))))
+
+    stats_text = f"👥 Зарегистрировано всего пользователей: {total_registered}\n💰 Оплатили: {total_paid}\n\n"
+    lines = []
+    for cid, registered, fn, ln, paid in rows:
+        if registered:
+            name = f"{fn or ''} {ln or ''}".strip()
+            reg_status = 'зарегистрирован'
+        else:
+            name = fetched.get(cid, '')
+            reg_status = 'не зарегистрирован'
+        name = name or f"User {cid}"
+        pay_status = 'оплатил' if paid else 'не оплатил'
+        lines.append(f"{name} - {reg_status} - {pay_status}")
+
+    # В направлении листания есть еще строки — has_more, в обратном — если мы пришли с другой страницы
+    has_prev = has_more if before_id is not None else after_id is not None
+    has_next = has_more if before_id is None else True
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton("←", callback_data=f'list_users_prev_{rows[0][0]}'))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton("→", callback_data=f'list_users_next_{rows[-1][0]}'))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("← Назад", callback_data='admin_menu')])
+    return stats_text + '\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+@instrument_handler('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды /start: отправляет приветствие с фото админа и кнопкой начать курс.
@@ -379,12 +932,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         else:
             logging.info(f"Запуск приветствия для chat_id {chat_id}")
 
-            ensure_user(chat_id)
-            user = get_user(chat_id)
-            paid = await is_user_paid(chat_id)
-            photo = await get_admin_photo(context.bot, ADMIN_ID) if ADMIN_ID else None
+            await ensure_user(chat_id)
+            status, photo = await asyncio.gather(
+                user_repository.status(chat_id), admin_photo_cache.get(context.bot)
+            )
 
-        if is_consent_and_registered(chat_id):
+        if status.consent_and_registered:
             welcome_text = (
                 "Рада приветствовать вас на моём авторском курсе 'Продажи в сториз за 12 дней'\n\n"
                 "Ольга Авдеева — наставник по продажам и эксперт в создании стратегий для роста бизнеса.\n\n"
@@ -397,22 +950,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 "⭕️Текст — текстовое описание, инфоповод и важные особенности для достижения успешного результата.\n\n"
                 "Этот бот создан как помощник для обучения экспертов и предпринимателей без выгорания."
             )
-            if paid:
+            if status.paid:
                 extra_text = "\n\n✅ Вы уже оплатили курс!"
                 button_text = "Начать курс 🎉"
                 callback_data_b = 'start_course'
             else:
-                promo_price = user.get('promo_price')
+                promo_price = status.promo_price
                 price_str = f"{promo_price:.2f}" if promo_price is not None else os.getenv('COURSE_PRICE', '1990.00')
                 extra_text = f"\n\n💳 Купить курс ({price_str} ₽)"
                 button_text = f"Купить курс ({price_str} ₽)"
                 callback_data_b = 'buy_course'
             full_text = welcome_text + extra_text
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(button_text, callback_data=callback_data_b)]])
-            if photo:
-                photo_message = await context.bot.send_photo(chat_id=chat_id, photo=photo)
-                if photo_message and context.user_data is not None:
-                    context.user_data['photo_message_id'] = photo_message.message_id
+            photo_message = await send_admin_photo(context, chat_id, photo)
+            if photo_message and context.user_data is not None:
+                context.user_data['photo_message_id'] = photo_message.message_id
             welcome_message = await context.bot.send_message(chat_id=chat_id, text=full_text, reply_markup=keyboard)
             if context.user_data is not None:
                 context.user_data['welcome_message_id'] = welcome_message.message_id
@@ -430,8 +982,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 [InlineKeyboardButton("Согласен ✅", callback_data='consent_yes'),
                 InlineKeyboardButton("Не согласен ❌", callback_data='consent_no')]
             ])
-            if photo:
-                await context.bot.send_photo(chat_id=chat_id, photo=photo)
+            await send_admin_photo(context, chat_id, photo)
             await context.bot.send_message(chat_id=chat_id, text=consent_text, reply_markup=keyboard)
 
     except Exception as e:
@@ -439,6 +990,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if update.message:
             await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте снова.")
 
+def callback_kind(update: Update) -> str:
+    """Тип callback для метрик: номер урока -> lesson, id в конце callback_data отбрасывается."""
+    data = update.callback_query.data if update.callback_query else None
+    if not data:
+        return 'none'
+    if data.isdigit():
+        return 'lesson'
+    kind = re.sub(r'(_next|_prev)?_\d+$', '', data)
+    return kind if re.fullmatch(r'[a-z_]{1,40}', kind) else 'other'
+
+@instrument_handler('button', callback_kind)
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик нажатий кнопок: переход по урокам, отправка видео и текста задачи.
@@ -456,14 +1018,20 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_id = update.effective_chat.id  # ID чата для отправки
 
         if query.data == 'buy_course':
-            if not is_consent_and_registered(chat_id):
+            if not await is_consent_and_registered(chat_id):
                 await context.bot.send_message(chat_id=chat_id, text="Сначала завершите регистрацию. Нажмите /start.")
                 await query.answer()
                 return
+            if await is_user_paid(chat_id):
+                await context.bot.send_message(chat_id=chat_id, text="✅ Вы уже оплатили курс!", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Начать курс", callback_data='start_course')]]))
+                await query.answer()
+                return
             url = await create_payment(chat_id, context)
             if url:
                 check_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Проверить оплату", callback_data='check_pay')]])
                 await context.bot.send_message(chat_id=chat_id, text=f"Перейдите по ссылке для оплаты:\n{url}", reply_markup=check_keyboard)
+            elif await is_user_paid(chat_id):
+                pass  # Ожидавший платеж оказался оплачен, подтверждение уже отправлено
             else:
                 await context.bot.send_message(chat_id=chat_id, text="Ошибка создания платежа. Попробуйте позже.")
             await query.answer()
@@ -479,118 +1047,78 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
 
         elif query.data == 'open_docs':
-            update_user_fields(chat_id, link_clicked=1)
+            await update_user_fields(chat_id, link_clicked=1)
             url = "https://disk.yandex.ru/d/GpPCV_3ozvydig"
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📄 Ознакомиться с документами", url=url)]])
             await query.edit_message_text("Ознакомьтесь с документами по ссылке ниже:\n(для продолжения нажмите /start)", reply_markup=keyboard)
             await query.answer("Документы открыты для просмотра")
+            return
 
         elif query.data == 'consent_yes':
-            update_user_fields(chat_id, consent_agreed=1)
-            context.user_data['reg_state'] = 'name'
+            await update_user_fields(chat_id, consent_agreed=1)
+            context.user_data[REGISTRATION.state_key] = REGISTRATION.first
             await query.edit_message_text("✅ Согласие на обработку персональных данных получено!\n\nТеперь зарегистрируйтесь,\nвведите ваше имя:")
             await query.answer("Начинаем регистрацию")
+            return
 
         elif query.data == 'consent_no':
-            update_user_fields(chat_id, consent_agreed=0)
+            await update_user_fields(chat_id, consent_agreed=0)
             await context.bot.send_message(chat_id=chat_id, text="❌ К сожалению, без согласия на обработку персональных данных доступ к курсу невозможен.\nНажмите /start для новой попытки.")
             await query.answer("Согласие отказано")
+            return
 
         elif query.data == 'has_promo_yes':
-            context.user_data['reg_state'] = 'promo_code'
-            await query.edit_message_text("Введите промокод:")
+            context.user_data[REGISTRATION.state_key] = 'promo_code'
+            await query.edit_message_text(REGISTRATION.steps['promo_code'].prompt)
             await query.answer()
+            return
 
         elif query.data == 'has_promo_no':
-            update_user_fields(chat_id, promo_key=None, promo_price=None, registered=1)
+            await update_user_fields(chat_id, promo_key=None, promo_price=None, registered=1)
             if context.user_data is not None:
-                context.user_data.pop('reg_state', None)
+                context.user_data.pop(REGISTRATION.state_key, None)
             default_price = os.getenv('COURSE_PRICE', '1990.00')
             await query.edit_message_text(f"✅ Регистрация завершена! Цена курса: {default_price} ₽\nНажмите /start для покупки.")
             await query.answer()
+            return
 
         elif query.data == 'prepare_report':
-            query_str = """
-                SELECT 
-                    ROW_NUMBER() OVER (ORDER BY u.created_at) as "Номер п/п",
-                    u.last_name as "Фамилия",
-                    u.first_name as "Имя",
-                    u.phone as "Номер телефона",
-                    u.email as "email",
-                    u.created_at as "Дата заявки",
-                    p.paid_at as "Дата оплаты",
-                    p.amount as "Бюджет",
-                    CASE WHEN p.status = 'succeeded' THEN 'Оплачено' ELSE 'Не оплачено' END as "Оплата",
-                    COALESCE(u.promo_key, 'Нет') as "Промокод"
-                FROM users u 
-                LEFT JOIN payments p ON u.chat_id = p.chat_id 
-                ORDER BY u.created_at
-            """
-            cursor.execute(query_str)
-            rows = cursor.fetchall()
-            cols = [desc[0] for desc in cursor.description]
-
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerow(cols)
-            writer.writerows(rows)
-            csv_content = output.getvalue().encode('utf-8')
-            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            filename = f'report_{timestamp}.csv'
-            bio = io.BytesIO(csv_content)
-            bio.name = filename
-
-            await context.bot.send_document(chat_id=chat_id, document=InputFile(bio, filename=filename))
-            await query.answer("Отчет отправлен")
+            if str(chat_id) != ADMIN_ID:
+                await query.answer("Только для администратора.")
+                return
+            await query.edit_message_text(
+                f"Отчет по пользователям и оплатам.\nДля периода используйте {report_usage()}",
+                reply_markup=get_report_keyboard()
+            )
+            await query.answer()
             return
 
-        elif query.data == 'list_users':
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_registered = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'succeeded'")
-            total_paid = cursor.fetchone()[0]
-            stats_text = f"👥 Зарегистрировано всего пользователей: {total_registered}\n💰 Оплатили: {total_paid}\n\n"
-
-            cursor.execute("""
-                SELECT DISTINCT chat_id FROM users
-                UNION
-                SELECT chat_id FROM payments
-                ORDER BY chat_id
-            """)
-            all_chat_ids = [row[0] for row in cursor.fetchall()]
-
-            list_text = ""
-            for cid in all_chat_ids:
-                user = get_user(cid)
-                if user:
-                    fn = user.get('first_name', '') or ''
-                    ln = user.get('last_name', '') or ''
-                    reg_status = 'зарегистрирован'
-                else:
-                    reg_status = 'не зарегистрирован'
-                    try:
-                        chat_obj = await context.bot.get_chat(cid)
-                        fn = chat_obj.first_name or ''
-                        ln = chat_obj.last_name or ''
-                    except Exception as e:
-                        logging.error(f"Failed to fetch chat {cid}: {e}")
-                        fn = ln = ''
-                name = f"{fn} {ln}".strip()
-                if not name:
-                    name = f"User {cid}"
-                cursor.execute("SELECT 1 FROM payments WHERE chat_id = ? AND status = 'succeeded'", (cid,))
-                pay_row = cursor.fetchone()
-                pay_status = 'оплатил' if pay_row else 'не оплатил'
-                list_text += f"{name} - {reg_status} - {pay_status}\n"
-
-            full_text = stats_text + list_text.rstrip('\n')
-            await query.edit_message_text(full_text)
+        elif query.data.startswith('report_'):
+            if str(chat_id) != ADMIN_ID:
+                await query.answer("Только для администратора.")
+                return
+            _, scope, fmt = query.data.split('_', 2)
+            since = await db.run(last_report_time) if scope == 'new' else None
+            await query.answer("Готовлю отчет")
+            await send_report(context, chat_id, fmt, since=since)
+            return
+
+        elif query.data == 'list_users' or query.data.startswith(('list_users_next_', 'list_users_prev_')):
+            if str(chat_id) != ADMIN_ID:
+                await query.answer("Только для администратора.")
+                return
+            after_id = before_id = None
+            if query.data.startswith('list_users_next_'):
+                after_id = int(query.data.rsplit('_', 1)[1])
+            elif query.data.startswith('list_users_prev_'):
+                before_id = int(query.data.rsplit('_', 1)[1])
+            text, reply_markup = await build_users_page(context, after_id, before_id)
+            await query.edit_message_text(text, reply_markup=reply_markup)
             await query.answer("Список пользователей")
             return
 
         elif query.data == 'delete_user':
-            cursor.execute("SELECT chat_id, first_name, last_name FROM users WHERE first_name IS NOT NULL ORDER BY created_at DESC LIMIT 10")
-            users = cursor.fetchall()
+            users = await db.fetchall("SELECT chat_id, first_name, last_name FROM users WHERE first_name IS NOT NULL ORDER BY created_at DESC LIMIT 10")
             if not users:
                 await query.edit_message_text("Нет пользователей для удаления.")
                 await query.answer()
@@ -625,28 +1153,21 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if str(chat_id) != ADMIN_ID:
                 await query.answer("Только для администратора.")
                 return
-            context.user_data['admin_promo_state'] = 'promo_key'
-            await query.edit_message_text("Введите название промокода:")
+            context.user_data[ADMIN_PROMO.state_key] = ADMIN_PROMO.first
+            await query.edit_message_text(ADMIN_PROMO.steps[ADMIN_PROMO.first].prompt)
             await query.answer()
 
         elif query.data == 'list_active_promos':
             if str(chat_id) != ADMIN_ID:
                 await query.answer("Только для администратора.")
                 return
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            cursor.execute("""
-                SELECT promo_key, promo_price, promo_start_period, promo_end_period
-                FROM promo WHERE promo_start_period <= ? AND promo_end_period >= ?
-                ORDER BY promo_start_period
-            """, (now, now))
-            promos = cursor.fetchall()
+            promos = promo_service.active()
             if not promos:
                 text = "Нет действующих промокодов."
             else:
                 text = "Действующие промокоды:\n\n"
                 for promo in promos:
-                    key, price, start, end = promo
-                    text += f"• {key}: {price:.2f} ₽\n  {start} — {end}\n\n"
+                    text += f"• {promo.key}: {promo.price:.2f} ₽\n  {format_promo_time(promo.start)} — {format_promo_time(promo.end)}\n\n"
             keyboard = get_promo_keyboard()
             await query.edit_message_text(text, reply_markup=keyboard)
             await query.answer()
@@ -655,19 +1176,15 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if str(chat_id) != ADMIN_ID:
                 await query.answer("Только для администратора.")
                 return
-            cursor.execute("""
-                SELECT promo_key, promo_price, promo_start_period, promo_end_period
-                FROM promo 
-                ORDER BY promo_start_period DESC
-            """)
-            promos = cursor.fetchall()
+            promos = await promo_service.list_all()
             if not promos:
                 text = "Нет промокодов."
             else:
                 text = "Все промокоды:\n\n"
                 for promo in promos:
-                    key, price, start, end = promo
-                    text += f"• {key}: {price:.2f} ₽\n  {start} — {end}\n\n"
+                    _, key, price, start, end, max_uses, used_count = promo
+                    usage = f"{used_count} из {max_uses}" if max_uses is not None else f"{used_count}"
+                    text += f"• {key}: {price:.2f} ₽\n  {start} — {end}\n  Использований: {usage}\n\n"
             keyboard = get_promo_keyboard()
             await query.edit_message_text(text, reply_markup=keyboard)
             await query.answer()
@@ -677,8 +1194,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if str(chat_id) != ADMIN_ID:
                 await query.answer("Только для администратора.")
                 return
-            cursor.execute("SELECT promo_id, promo_key, promo_price FROM promo ORDER BY promo_id DESC LIMIT 20")
-            promos = cursor.fetchall()
+            promos = await db.fetchall("SELECT promo_id, promo_key, promo_price FROM promo ORDER BY promo_id DESC LIMIT 20")
             if not promos:
                 text = "Нет промокодов для удаления."
                 keyboard = get_promo_keyboard()
@@ -701,11 +1217,16 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         elif query.data.startswith('delete_confirm_'):
             try:
                 del_id = int(query.data.split('_', 2)[2])
-                user = get_user(del_id)
+                user = await get_user(del_id)
                 name = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or f"User {del_id}"
-                cursor.execute("DELETE FROM users WHERE chat_id = ?", (del_id,))
-                cursor.execute("DELETE FROM payments WHERE chat_id = ?", (del_id,))
-                conn.commit()
+
+                def delete_user(conn: sqlite3.Connection) -> None:
+                    with conn:
+                        conn.execute("DELETE FROM users WHERE chat_id = ?", (del_id,))
+                        conn.execute("DELETE FROM payments WHERE chat_id = ?", (del_id,))
+                        conn.execute("DELETE FROM payment_attempts WHERE chat_id = ?", (del_id,))
+                await db.run(delete_user)
+                user_repository.invalidate(del_id)
                 await query.edit_message_text(f"Пользователь {name} ({del_id}) удалён из базы данных.", reply_markup=get_admin_keyboard())
             except (ValueError, IndexError):
                 await query.edit_message_text("Ошибка удаления.", reply_markup=get_admin_keyboard())
@@ -721,12 +1242,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             try:
                 parts = query.data.split('_')
                 promo_id = int(parts[-1])
-                cursor.execute("SELECT promo_key FROM promo WHERE promo_id = ?", (promo_id,))
-                row = cursor.fetchone()
-                if row:
-                    key = row[0]
-                    cursor.execute("DELETE FROM promo WHERE promo_id = ?", (promo_id,))
-                    conn.commit()
+                key = await promo_service.delete(promo_id)
+                if key:
                     await query.edit_message_text(f"✅ Промокод '{key}' (ID: {promo_id}) удалён.", reply_markup=get_promo_keyboard())
                 else:
                     await query.edit_message_text("❌ Промокод не найден.", reply_markup=get_promo_keyboard())
@@ -739,7 +1256,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
         else:
             if str(chat_id) != ADMIN_ID:
-                if not is_consent_and_registered(chat_id):
+                if not await is_consent_and_registered(chat_id):
                     await query.answer()
                     return
                 if not await is_user_paid(chat_id):
@@ -749,68 +1266,116 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
             # Handle start_course or numeric lesson
             if query.data == 'start_course':
-                task_id = 1
+                task_id = lesson_catalog.first_id
             else:
                 task_id = int(query.data)
 
-        # Запрос данных задачи из БД
-        cursor.execute("SELECT task_name, task_content, task_link FROM tasks WHERE task_id = ?", (task_id,))
-        task = cursor.fetchone()
+            # Уроки открываются по одному в день
+            if LESSON_DRIP and str(chat_id) != ADMIN_ID and task_id is not None:
+                unlocked_task_id = await lesson_scheduler.unlocked_task_id(chat_id)
+                if unlocked_task_id is None or task_id > unlocked_task_id:
+                    schedule = await lesson_scheduler.get(chat_id)
+                    text = "Этот урок ещё не открыт."
+                    if schedule and schedule.next_due_at:
+                        text = f"Следующий урок откроется {format_next_lesson_time(schedule.next_due_at, schedule.utc_offset)}."
+                    await query.answer(text + " Время уроков: /lesson_time", show_alert=True)
+                    return
+
+        # Урок из каталога в памяти: текст и кнопка "Следующий урок" собраны заранее
+        lesson = lesson_catalog.get(task_id) if task_id is not None else None
 
-        if not task:
+        if not lesson:
             # Отправка ошибки если задача не найдена
             await context.bot.send_message(chat_id=chat_id, text=f"Задача {task_id} не найдена.")
             return
 
-        task_name, task_content, task_link = task
-
-        # Получение общего количества задач
-        cursor.execute("SELECT COUNT(*) FROM tasks")
-        total_tasks = cursor.fetchone()[0]
-
-        # Подготовка кнопки следующей задачи, если не последняя
-        next_task_id = task_id + 1
-        if task_id < total_tasks:
-            keyboard = [[InlineKeyboardButton("Следующий урок", callback_data=str(next_task_id))]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-        else:
-            reply_markup = None
-
-        # Удаление кнопки с предыдущего сообщения задачи
-        if context.user_data:
-            previous_msg_id = context.user_data.get('last_task_message_id')
-            if previous_msg_id:
-                try:
-                    await context.bot.edit_message_reply_markup(
-                        chat_id=chat_id, message_id=previous_msg_id, reply_markup=None
-                    )
-                    logging.info(f"Удалена кнопка с предыдущего сообщения {previous_msg_id}")
-                except Exception as e:
-                    logging.error(f"Не удалось отредактировать предыдущее сообщение: {e}")
-
-        # Отправка видео для задачи
-        try:
-            await send_video(update, context, task_id)
-        except Exception as e:
-            # Логирование ошибки видео и отправка текста без видео
-            logging.error(f"Ошибка отправки видео: {e}")
-            await context.bot.send_message(chat_id=chat_id, text=f"Ошибка обработки видео: {str(e)}")
-
-        # Отправка текста задачи
-        task_text = f"{task_name}\n{task_content}"
-        if task_link:
-            task_text += f"\n\nСсылка: {task_link}"  # Добавление ссылки если есть
-        task_message = await context.bot.send_message(
-            chat_id=chat_id, text=task_text, reply_markup=reply_markup
-        )
-        # Сохранение ID текущего сообщения для удаления кнопки в следующий раз
-        if context.user_data is not None:
-            context.user_data['last_task_message_id'] = task_message.message_id
+        await deliver_lesson(context, chat_id, lesson)
 
     except Exception as e:
         # Общее логирование ошибки
         logging.error(f"Ошибка в функции button: {e}")
 
+async def user_field_taken(field: str, value, chat_id: int) -> bool:
+    """Значение уникального поля (email, телефон) уже есть у другого пользователя."""
+    return await db.fetchone(f"SELECT 1 FROM users WHERE {field} = ? AND chat_id != ?", (value, chat_id)) is not None
+
+async def admin_promo_text(message: Message, user_data: dict, state: str, text: str) -> None:
+    """Шаг диалога добавления промокода; значения копятся в user_data до последнего шага."""
+    step = ADMIN_PROMO.steps[state]
+    try:
+        transition = ADMIN_PROMO.handle(state, text, user_data)
+    except InputError as e:
+        await message.reply_text(str(e))
+        return
+    if step.taken and promo_service.exists(transition.value):
+        await message.reply_text(step.taken)
+        return
+    user_data[transition.field] = transition.value
+    if transition.next:
+        user_data[ADMIN_PROMO.state_key] = transition.next
+        await message.reply_text(transition.prompt)
+        return
+
+    values = {step.field: user_data.pop(step.field, None) for step in ADMIN_PROMO.steps.values()}
+    user_data.pop(ADMIN_PROMO.state_key, None)
+    promo_id = await promo_service.create(
+        values['pending_promo_key'],
+        values['pending_promo_price'],
+        parse_promo_time(values['pending_promo_start']),
+        parse_promo_time(values['pending_promo_end']),
+        values['pending_promo_max_uses'],
+    )
+    keyboard = get_promo_keyboard()
+    if promo_id is None:
+        await message.reply_text("Промокод с таким названием уже существует.", reply_markup=keyboard)
+        return
+    await message.reply_text("✅ Промокод добавлен успешно!", reply_markup=keyboard)
+
+async def apply_promo_code(message: Message, user_data: dict, chat_id: int, code: str) -> None:
+    if promo_service.get_active(code) is None:
+        await message.reply_text("Неверный промокод или срок действия истек.\nВведите промокод:")
+        return
+    promo = await promo_service.redeem(code, chat_id)
+    if promo is None:
+        await message.reply_text("Лимит использований промокода исчерпан.\nВведите другой промокод:")
+        return
+    await update_user_fields(chat_id, promo_key=code, promo_price=promo.price, registered=1)
+    user_data.pop(REGISTRATION.state_key, None)
+    await message.reply_text(f"✅ Промокод применен! Цена курса: {promo.price:.2f} ₽\nРегистрация завершена. Нажмите /start для покупки.")
+
+async def registration_text(message: Message, user_data: dict, chat_id: int, state: str, text: str) -> None:
+    """Шаг регистрации: значение сохраняется в users сразу после проверки."""
+    step = REGISTRATION.steps[state]
+    try:
+        transition = REGISTRATION.handle(state, text)
+    except InputError as e:
+        await message.reply_text(str(e))
+        return
+    if step.taken and await user_field_taken(transition.field, transition.value, chat_id):
+        await message.reply_text(step.taken)
+        return
+    if state == 'promo_code':
+        await apply_promo_code(message, user_data, chat_id, transition.value)
+        return
+    try:
+        await update_user_fields(chat_id, **{transition.field: transition.value})
+    except sqlite3.IntegrityError:
+        if not step.taken:
+            raise
+        # То же значение одновременно зарегистрировал другой пользователь
+        await message.reply_text(step.taken)
+        return
+    if transition.next:
+        user_data[REGISTRATION.state_key] = transition.next
+        await message.reply_text(transition.prompt)
+        return
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Да ✅", callback_data='has_promo_yes'),
+         InlineKeyboardButton("Нет ❌", callback_data='has_promo_no')]
+    ])
+    await message.reply_text("У Вас есть промокод?", reply_markup=keyboard)
+
+@instrument_handler('register_text')
 async def register_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text inputs during registration and admin promo addition."""
     if not update.message:
@@ -820,113 +1385,104 @@ async def register_text_handler(update: Update, context: ContextTypes.DEFAULT_TY
         return
     text = (update.message.text or '').strip()
 
-    admin_promo_state = context.user_data.get('admin_promo_state')
+    admin_promo_state = context.user_data.get(ADMIN_PROMO.state_key)
     if str(chat_id) == ADMIN_ID and admin_promo_state:
-        if admin_promo_state == 'promo_key':
-            if not text:
-                await update.message.reply_text("Введите название промокода:")
-                return
-            cursor.execute("SELECT 1 FROM promo WHERE promo_key = ?", (text,))
-            if cursor.fetchone():
-                await update.message.reply_text("Промокод уже существует. Введите другой:")
-                return
-            context.user_data['pending_promo_key'] = text
-            context.user_data['admin_promo_state'] = 'promo_price'
-            await update.message.reply_text("Установите стоимость при использовании промокода (число):")
-        elif admin_promo_state == 'promo_price':
-            try:
-                price = float(text)
-                context.user_data['pending_promo_price'] = price
-                context.user_data['admin_promo_state'] = 'promo_start'
-                await update.message.reply_text("Введите начало действия промокода (YYYY-MM-DD HH:MM:SS):")
-            except ValueError:
-                await update.message.reply_text("Неверная цена. Введите число (например, 1500.00):")
-        elif admin_promo_state == 'promo_start':
-            context.user_data['pending_promo_start'] = text
-            context.user_data['admin_promo_state'] = 'promo_end'
-            await update.message.reply_text("Введите окончание действия промокода (YYYY-MM-DD HH:MM:SS):")
-        elif admin_promo_state == 'promo_end':
-            key = context.user_data['pending_promo_key']
-            price = context.user_data['pending_promo_price']
-            start = context.user_data['pending_promo_start']
-            end = text
-            cursor.execute("""
-                INSERT INTO promo (promo_key, promo_price, promo_start_period, promo_end_period)
-                VALUES (?, ?, ?, ?)
-            """, (key, price, start, end))
-            conn.commit()
-            del context.user_data['admin_promo_state']
-            del context.user_data['pending_promo_key']
-            del context.user_data['pending_promo_price']
-            del context.user_data['pending_promo_start']
-            keyboard = get_promo_keyboard()
-            await update.message.reply_text("✅ Промокод добавлен успешно!", reply_markup=keyboard)
+        if ADMIN_PROMO.step(admin_promo_state) is not None:
+            await admin_promo_text(update.message, context.user_data, admin_promo_state, text)
         return
 
-    reg_state = context.user_data.get('reg_state')
-    if not reg_state:
+    reg_state = context.user_data.get(REGISTRATION.state_key)
+    if REGISTRATION.step(reg_state) is None:
         return  # Ignore if not in reg state
+    await registration_text(update.message, context.user_data, chat_id, reg_state, text)
+
+web_server: Optional[WebServer] = None
+loop_lag_task: Optional[asyncio.Task] = None
+
+async def post_init(application) -> None:
+    """Запуск фонового скачивания видео, HTTP сервера уведомлений YooKassa и фоновой сверки платежей."""
+    global web_server, prefetch_task, loop_lag_task
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    await lesson_catalog.reload()
+    await promo_service.reload()
+    if IS_LEADER:
+        await broadcast_manager.start(application.bot)
+        prefetch_task = asyncio.create_task(video_prefetcher.run())
+    if WEB_SERVER_PORT:
+        web_server = WebServer(WEB_SERVER_HOST, int(WEB_SERVER_PORT))
+        web_server.add_route('POST', YOOKASSA_WEBHOOK_PATH, create_yookassa_webhook_handler(
+            lambda payment_id, status: apply_payment_status(application.bot, payment_id, status),
+            fetch_payment_status,
+            verify_ip=YOOKASSA_WEBHOOK_VERIFY_IP,
+            trust_proxy=WEB_SERVER_TRUST_PROXY,
+        ))
+        web_server.add_route('GET', METRICS_PATH, create_metrics_handler(local_only=METRICS_LOCAL_ONLY))
+        if BOT_RUN_MODE == 'webhook':
+            web_server.add_route('POST', WEBHOOK_PATH, create_telegram_webhook_handler(
+                application, WEBHOOK_SECRET, router=worker_router))
+        if worker_router is not None:
+            # update, пересланные другими воркерами
+            web_server.add_route('POST', WORKER_FORWARD_PATH, create_telegram_webhook_handler(
+                application, WORKER_FORWARD_SECRET, secret_header=FORWARD_SECRET_HEADER))
+        await web_server.start()
+
+    if application.job_queue is not None:
+        if IS_LEADER:
+            application.job_queue.run_repeating(reconcile_payments_job, interval=PAYMENT_RECONCILE_INTERVAL, first=30)
+        application.job_queue.run_repeating(refresh_admin_photo_job, interval=admin_photo_cache.ttl, first=0)
+        application.job_queue.run_repeating(cache_versions_job, interval=LESSON_CATALOG_CHECK_INTERVAL, first=LESSON_CATALOG_CHECK_INTERVAL)
+        if LESSON_DRIP:
+            # Начало каждой минуты: все пользователи с одним временем получают урок одной волной
+            application.job_queue.run_repeating(drip_lessons_job, interval=60, first=60 - datetime.now().second)
+    else:
+        logging.warning("JobQueue недоступен (установите python-telegram-bot[job-queue]), фоновые задачи отключены")
+
+async def post_shutdown(application) -> None:
+    """Остановка HTTP сервера и закрытие пула соединений с БД при остановке бота."""
+    if prefetch_task is not None and not prefetch_task.done():
+        prefetch_task.cancel()
+    if loop_lag_task is not None:
+        loop_lag_task.cancel()
+    video_prefetcher.close()
+    await broadcast_manager.stop()
+    await user_repository.close()
+    if web_server is not None:
+        await web_server.stop()
+    if worker_router is not None:
+        await worker_router.close()
+    payment_gateway.close()
+    db.close()
+
+async def run_webhook(application) -> None:
+    """
+    Режим webhook: update принимает встроенный HTTP сервер (маршрут WEBHOOK_PATH добавляется в post_init),
+    порядок запуска и остановки такой же, как в run_polling.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
 
-    if reg_state == 'name':
-        if len(text) < 2:
-            await update.message.reply_text("Имя слишком короткое. Введите имя (минимум 2 символа):")
-            return
-        if not text.isalpha():
-            await update.message.reply_text("Имя должно содержать только буквы.")
-            return
-        update_user_fields(chat_id, first_name=text)
-        context.user_data['reg_state'] = 'surname'
-        await update.message.reply_text("Введите фамилию:")
-    elif reg_state == 'surname':
-        if len(text) < 2:
-            await update.message.reply_text("Фамилия слишком короткая. Введите фамилию (минимум 2 символа):")
-            return
-        if not text.isalpha():
-            await update.message.reply_text("Фамилия должна содержать только буквы.")
-            return
-        update_user_fields(chat_id, last_name=text)
-        context.user_data['reg_state'] = 'email'
-        await update.message.reply_text("Введите email:")
-    elif reg_state == 'email':
-        if not validate_email(text):
-            await update.message.reply_text("Неверный формат email. Пример: example@mail.com\nВведите email:")
-            return
-        cursor.execute("SELECT 1 FROM users WHERE email = ? AND chat_id != ?", (text, chat_id))
-        if cursor.fetchone():
-            await update.message.reply_text("Этот email уже зарегистрирован. Введите другой:")
-            return
-        update_user_fields(chat_id, email=text)
-        context.user_data['reg_state'] = 'phone'
-        await update.message.reply_text("Введите номер телефона (например, +7 (999) 123-45-67):")
-    elif reg_state == 'phone':
-        if not validate_phone(text):
-            await update.message.reply_text("Неверный формат телефона. Пример: +79991234567\nВведите номер телефона:")
-            return
-        update_user_fields(chat_id, phone=text)
-        context.user_data['reg_state'] = 'username'
-        await update.message.reply_text("Введите username из учетной записи telegram:")
-
-    elif reg_state == 'username':
-        username_input = text.strip()
-        if not username_input:
-            await update.message.reply_text("Username не может быть пустым. Введите username из учетной записи telegram:")
-            return
-        update_user_fields(chat_id, username=username_input)
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да ✅", callback_data='has_promo_yes'),
-             InlineKeyboardButton("Нет ❌", callback_data='has_promo_no')]
-        ])
-        await update.message.reply_text("У Вас есть промокод?", reply_markup=keyboard)
-
-    elif reg_state == 'promo_code':
-        promo_price = validate_promo(text)
-        if promo_price is None:
-            await update.message.reply_text("Неверный промокод или срок действия истек.\nВведите промокод:")
-            return
-        update_user_fields(chat_id, promo_key=text, promo_price=promo_price, registered=1)
-        if context.user_data is not None:
-            context.user_data.pop('reg_state', None)
-        await update.message.reply_text(f"✅ Промокод применен! Цена курса: {promo_price:.2f} ₽\nРегистрация завершена. Нажмите /start для покупки.")
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.start()
+        if IS_LEADER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(max(CONCURRENT_UPDATES * WORKER_COUNT, 1), 100),
+            )
+            logging.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        if worker_router is not None:
+            logging.info(f"Воркер {WORKER_ID} из {WORKER_COUNT}{' (ведущий)' if IS_LEADER else ''}")
+        await stop.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
 
 def main() -> None:
     """
@@ -934,27 +1490,54 @@ def main() -> None:
     """
     if BOT_TOKEN is None:
         raise ValueError("BOT_TOKEN не установлен в переменных окружения.")
+    if BOT_RUN_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"Неизвестный BOT_RUN_MODE: {BOT_RUN_MODE} (polling или webhook)")
+    if BOT_RUN_MODE == 'webhook' and not (WEBHOOK_URL and WEB_SERVER_PORT):
+        raise ValueError("Для BOT_RUN_MODE=webhook укажите WEBHOOK_URL и WEB_SERVER_PORT")
+    if worker_router is not None and BOT_RUN_MODE != 'webhook':
+        raise ValueError("Несколько воркеров (WORKER_URLS) поддерживаются только в режиме BOT_RUN_MODE=webhook")
+    if worker_router is not None and not WORKER_FORWARD_SECRET:
+        raise ValueError("Для нескольких воркеров укажите WORKER_FORWARD_SECRET или WEBHOOK_SECRET")
 
     # Создание приложения Telegram бота
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # user_data (регистрация, навигация по урокам) хранится в БД и записывается пакетно
+    persistence = SQLitePersistence(db, update_interval=float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '10')))
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    if CONCURRENT_UPDATES > 1:
+        # Медленная загрузка видео одному пользователю не задерживает ответы остальным
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    if BOT_RUN_MODE == 'webhook':
+        builder = builder.updater(None)  # update приходят через встроенный HTTP сервер
+    application = builder.build()
 
     # Добавление обработчиков команд и callback
     application.add_handler(CommandHandler("start", start))  # /start
     application.add_handler(CommandHandler("list_videos", list_videos))  # /list_videos
     application.add_handler(CommandHandler("help", help_command))  # /help
+    application.add_handler(CommandHandler("report", report_command))  # /report (админ)
+    application.add_handler(CommandHandler("reload_lessons", reload_lessons_command))  # /reload_lessons (админ)
+    application.add_handler(CommandHandler("lesson_time", lesson_time_command))  # /lesson_time
+    application.add_handler(CommandHandler("broadcast", broadcast_command))  # /broadcast (админ)
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_command))  # /broadcast_status (админ)
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))  # /broadcast_cancel (админ)
     application.add_handler(CallbackQueryHandler(button))  # Кнопки
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, register_text_handler))
 
-    # Запуск polling для получения обновлений
-    application.run_polling()
+    if BOT_RUN_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        # Запуск polling для получения обновлений
+        application.run_polling()
 
 if __name__ == '__main__':
-    # Асинхронная функция для скачивания всех видео при запуске
-    async def download_all_videos_async():
-        download_all_videos()  # Вызов синхронной функции скачивания
-        logging.info("Завершено скачивание всех видео.")
-
-    # Скачивание видео перед запуском бота
-    asyncio.run(download_all_videos_async())
-    # Запуск бота
+    # Запуск бота (видео скачиваются в фоне из post_init)
     main()
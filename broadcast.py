@@ -0,0 +1,341 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, Optional
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from media_cache import CachedVideo, fits_caption, get_cached_video, save_cached_video
+from video_probe import DEFAULT_PROBE, probe_video
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Получатели рассылки: выбираются один раз при создании и сохраняются в broadcast_recipients
+BROADCAST_AUDIENCES = {
+    'paid': "SELECT chat_id FROM payments WHERE status = 'succeeded'",
+    'unpaid': """
+        SELECT chat_id FROM users
+        WHERE registered = 1 AND chat_id NOT IN (SELECT chat_id FROM payments WHERE status = 'succeeded')
+    """,
+    'registered': "SELECT chat_id FROM users WHERE registered = 1",
+    'all': "SELECT chat_id FROM users",
+}
+
+RECIPIENTS_PAGE_SIZE = 500
+
+
+def _seconds(value) -> float:
+    """RetryAfter.retry_after в PTB 22 — int или timedelta в зависимости от PTB_TIMEDELTA."""
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: не более rate отправок в секунду, с запасом capacity на короткий всплеск.
+    По умолчанию запаса нет — отправки идут равномерно, без всплеска после простоя.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу на seconds секунд (после RetryAfter ограничение действует на весь бот)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    async def acquire(self) -> None:
+        # Ожидающие обслуживаются по очереди (asyncio.Lock справедлив)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат."""
+
+    def __init__(self, interval: float = 1.0, max_chats: int = 10000) -> None:
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next: dict[int, float] = {}
+
+    async def wait(self, chat_id: int) -> None:
+        now = time.monotonic()
+        ready = self._next.get(chat_id, 0.0)
+        self._next[chat_id] = max(now, ready) + self.interval
+        if len(self._next) > self.max_chats:
+            self._next = {chat: at for chat, at in self._next.items() if at > now}
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+
+def _create_broadcast(conn: sqlite3.Connection, audience: str, text: Optional[str], task_id: Optional[int]) -> tuple[int, int]:
+    with conn:
+        broadcast_id = conn.execute(
+            "INSERT INTO broadcasts (audience, text, task_id) VALUES (?, ?, ?)", (audience, text, task_id)
+        ).lastrowid
+        total = conn.execute(f"""
+            INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, chat_id)
+            SELECT DISTINCT ?, chat_id FROM ({BROADCAST_AUDIENCES[audience]}) WHERE chat_id IS NOT NULL
+        """, (broadcast_id,)).rowcount
+        conn.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, broadcast_id))
+    return broadcast_id, total
+
+
+def _checkpoint(conn: sqlite3.Connection, broadcast_id: int, results: list[tuple[int, str, Optional[str]]]) -> None:
+    """Сохраняет результаты отправки пачкой: одна транзакция на checkpoint_every получателей."""
+    with conn:
+        conn.executemany(
+            "UPDATE broadcast_recipients SET status = ?, error = ? WHERE broadcast_id = ? AND chat_id = ?",
+            [(status, error, broadcast_id, chat_id) for chat_id, status, error in results]
+        )
+        sent = sum(1 for _, status, _ in results if status == 'sent')
+        conn.execute(
+            "UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (sent, len(results) - sent, broadcast_id)
+        )
+
+
+def _set_status(conn: sqlite3.Connection, broadcast_id: int, status: str) -> None:
+    finished = status in ('done', 'cancelled', 'failed')
+    with conn:
+        conn.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END "
+            "WHERE id = ? AND status NOT IN ('done', 'cancelled', 'failed')",
+            (status, finished, broadcast_id)
+        )
+
+
+class BroadcastManager:
+    """
+    Рассылки администратора по пользователям из users/payments.
+    Рассылки выполняются по очереди одной фоновой задачей; отправка ограничена общим
+    token bucket (по умолчанию 30 сообщений/с) и интервалом 1 с на чат, RetryAfter
+    приостанавливает всю отправку. Прогресс сохраняется в broadcast_recipients,
+    незавершенные рассылки продолжаются после перезапуска с неотправленных получателей
+    (повторно могут уйти только сообщения последней несохраненной пачки).
+    Видео урока отправляется по file_id из media_cache.
+    """
+
+    def __init__(self, db: 'Database', admin_chat_id: int, rate: float = 30.0, per_chat_interval: float = 1.0,
+                 concurrency: int = 10, attempts: int = 3, checkpoint_every: int = 50,
+                 checkpoint_interval: float = 2.0, videos_dir: str = './videos') -> None:
+        self.db = db
+        self.admin_chat_id = admin_chat_id
+        self.bucket = TokenBucket(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.videos_dir = videos_dir
+        self.bot: Optional[Bot] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._runner: Optional[asyncio.Task] = None
+        self._cancelled: set[int] = set()
+
+    # --- Управление ---
+
+    async def start(self, bot: Bot) -> None:
+        """Запускает обработку очереди и ставит в нее незавершенные рассылки."""
+        self.bot = bot
+        rows = await self.db.fetchall("SELECT id FROM broadcasts WHERE status IN ('queued', 'running') ORDER BY id")
+        for (broadcast_id,) in rows:
+            logging.info(f"Рассылка #{broadcast_id} будет продолжена")
+            self._queue.put_nowait(broadcast_id)
+        self._runner = asyncio.create_task(self._run_queue())
+
+    async def stop(self) -> None:
+        if self._runner is not None and not self._runner.done():
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+
+    async def create(self, audience: str, text: Optional[str], task_id: Optional[int] = None) -> tuple[int, int]:
+        """Создает рассылку и ставит ее в очередь. Возвращает (id рассылки, число получателей)."""
+        if audience not in BROADCAST_AUDIENCES:
+            raise ValueError(f"Неизвестная аудитория: {audience}")
+        if not text and task_id is None:
+            raise ValueError("Пустая рассылка")
+        if task_id is not None and text and not fits_caption(text):
+            raise ValueError("Текст рассылки с видео не помещается в подпись (1024 символа)")
+        broadcast_id, total = await self.db.run(_create_broadcast, audience, text, task_id)
+        self._queue.put_nowait(broadcast_id)
+        logging.info(f"Рассылка #{broadcast_id} ({audience}) поставлена в очередь: {total} получателей")
+        return broadcast_id, total
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        changed = await self.db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status IN ('queued', 'running')", (broadcast_id,)
+        )
+        if changed:
+            self._cancelled.add(broadcast_id)
+        return bool(changed)
+
+    async def recent(self, limit: int = 5) -> list[tuple]:
+        return await self.db.fetchall(
+            "SELECT id, audience, status, total, sent, failed FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+        )
+
+    # --- Выполнение ---
+
+    async def _run_queue(self) -> None:
+        while True:
+            broadcast_id = await self._queue.get()
+            try:
+                await self._run(broadcast_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+                await self.db.run(_set_status, broadcast_id, 'failed')
+
+    async def _prepare_video(self, task_id: int) -> Optional[CachedVideo]:
+        """file_id видео урока; если видео еще не загружалось, оно загружается администратору (предпросмотр)."""
+        path = os.path.join(self.videos_dir, f"task_{task_id}.mp4")
+        if not os.path.exists(path):
+            return None
+        cached = await self.db.run(get_cached_video, task_id, path)
+        if cached:
+            return cached
+        probe = await probe_video(self.db, path) or DEFAULT_PROBE
+        with open(path, 'rb') as video_file:
+            message = await self.bot.send_video(
+                chat_id=self.admin_chat_id, video=video_file, caption=f'Задание №{task_id}',
+                width=probe.width, height=probe.height, duration=probe.duration,
+                supports_streaming=True, protect_content=True
+            )
+        await self.db.run(save_cached_video, task_id, path, message.video)
+        return await self.db.run(get_cached_video, task_id, path)
+
+    async def _send(self, chat_id: int, text: Optional[str], video: Optional[CachedVideo]) -> tuple[str, Optional[str]]:
+        """Отправляет сообщение рассылки одному получателю. Возвращает (статус, ошибка)."""
+        errors = 0
+        while True:
+            await self.per_chat.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                if video:
+                    await self.bot.send_video(
+                        chat_id=chat_id, video=video.file_id, caption=text,
+                        width=video.width, height=video.height, duration=video.duration,
+                        protect_content=True
+                    )
+                else:
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                return 'sent', None
+            except RetryAfter as e:
+                delay = _seconds(e.retry_after)
+                logging.warning(f"Рассылка: flood control, пауза {delay:.0f} с")
+                self.bucket.pause(delay)
+            except Forbidden as e:
+                return 'blocked', str(e)  # пользователь заблокировал бота
+            except BadRequest as e:
+                return 'failed', str(e)
+            except NetworkError as e:
+                errors += 1
+                if errors >= self.attempts:
+                    return 'failed', str(e)
+                await asyncio.sleep(errors)
+            except TelegramError as e:
+                return 'failed', str(e)
+
+    async def _run(self, broadcast_id: int) -> None:
+        row = await self.db.fetchone("SELECT status, text, task_id FROM broadcasts WHERE id = ?", (broadcast_id,))
+        if not row or row[0] not in ('queued', 'running'):
+            return
+        _, text, task_id = row
+        video = None
+        if task_id is not None:
+            video = await self._prepare_video(task_id)
+            if video is None:
+                logging.error(f"Рассылка #{broadcast_id}: нет видео урока {task_id}")
+                await self.db.run(_set_status, broadcast_id, 'failed')
+                await self.bot.send_message(chat_id=self.admin_chat_id, text=f"Рассылка #{broadcast_id}: видео урока {task_id} не найдено.")
+                return
+        await self.db.run(_set_status, broadcast_id, 'running')
+        started = time.monotonic()
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results: list[tuple[int, str, Optional[str]]] = []
+        last_checkpoint = time.monotonic()
+        checkpoint_lock = asyncio.Lock()
+
+        async def flush(force: bool = False) -> None:
+            nonlocal results, last_checkpoint
+            async with checkpoint_lock:
+                if not results or (not force and len(results) < self.checkpoint_every
+                                   and time.monotonic() - last_checkpoint < self.checkpoint_interval):
+                    return
+                batch, results = results, []
+                last_checkpoint = time.monotonic()
+                await self.db.run(_checkpoint, broadcast_id, batch)
+
+        async def worker() -> None:
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                if broadcast_id in self._cancelled:
+                    continue
+                status, error = await self._send(chat_id, text, video)
+                results.append((chat_id, status, error))
+                await flush()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            after = 0
+            while broadcast_id not in self._cancelled:
+                page = await self.db.fetchall("""
+                    SELECT chat_id FROM broadcast_recipients
+                    WHERE broadcast_id = ? AND status = 'pending' AND chat_id > ?
+                    ORDER BY chat_id LIMIT ?
+                """, (broadcast_id, after, RECIPIENTS_PAGE_SIZE))
+                if not page:
+                    break
+                for (chat_id,) in page:
+                    await queue.put(chat_id)
+                after = page[-1][0]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            # Сохранить уже отправленное, даже если рассылку прервала остановка бота
+            await asyncio.shield(flush(force=True))
+
+        if broadcast_id in self._cancelled:
+            logging.info(f"Рассылка #{broadcast_id} отменена")
+            return
+        await self.db.run(_set_status, broadcast_id, 'done')
+        total, sent, failed = await self.db.fetchone(
+            "SELECT total, sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,)
+        )
+        logging.info(f"Рассылка #{broadcast_id} завершена за {time.monotonic() - started:.0f} с: {sent}/{total}, ошибок {failed}")
+        try:
+            await self.bot.send_message(
+                chat_id=self.admin_chat_id,
+                text=f"Рассылка #{broadcast_id} завершена: отправлено {sent} из {total}, ошибок {failed}."
+            )
+        except TelegramError as e:
+            logging.error(f"Не удалось уведомить администратора о рассылке #{broadcast_id}: {e}")
@@ -0,0 +1,38 @@
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+if TYPE_CHECKING:
+    from db import Database
+
+# version -> None; подписчик сам сравнивает версию с загруженной
+OnVersion = Callable[[int], Awaitable[object]]
+
+
+def read_cache_versions(conn: sqlite3.Connection) -> dict[str, int]:
+    return dict(conn.execute("SELECT name, version FROM cache_versions").fetchall())
+
+
+class CacheVersionWatcher:
+    """
+    Сброс кэшей в памяти во всех процессах бота.
+    Счетчики cache_versions увеличивают триггеры на кэшируемых таблицах (tasks, promo),
+    поэтому изменение, сделанное любым воркером или вручную в БД, видят все воркеры:
+    периодическая проверка — один запрос, кэш перечитывается только при изменении счетчика.
+    """
+
+    def __init__(self, db: 'Database') -> None:
+        self.db = db
+        self._subscribers: dict[str, list[OnVersion]] = {}
+
+    def subscribe(self, name: str, callback: OnVersion) -> None:
+        self._subscribers.setdefault(name, []).append(callback)
+
+    async def check(self) -> None:
+        versions = await self.db.run(read_cache_versions)
+        for name, callbacks in self._subscribers.items():
+            for callback in callbacks:
+                try:
+                    await callback(versions.get(name, 0))
+                except Exception as e:
+                    logging.error(f"Ошибка обновления кэша {name}: {e}")
@@ -0,0 +1,111 @@
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Sequence, TypeVar
+from metrics import DB_ERRORS, DB_LATENCY
+
+T = TypeVar('T')
+
+
+class Database:
+    """
+    Асинхронный доступ к SQLite: запросы выполняются в отдельном пуле потоков,
+    у каждого потока свое соединение (WAL позволяет читать параллельно с записью).
+    Обработчики бота ожидают результат через await и не блокируют event loop.
+    """
+
+    def __init__(self, path: str, workers: int = 4, busy_timeout: float = 30.0) -> None:
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sqlite')
+
+    def connect(self) -> sqlite3.Connection:
+        """Открывает новое соединение с настройками, общими для всех потоков."""
+        # check_same_thread=False нужен только для close() из основного потока при остановке
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, cached_statements=256,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL fsync выполняется при checkpoint, а не при каждой фиксации:
+        # после сбоя процесса данные сохраняются, при отключении питания теряются последние транзакции
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока пула (создается при первом обращении)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, func: Callable[..., T], args: tuple, kwargs: dict) -> T:
+        conn = self._connection()
+        op = getattr(func, '__name__', 'query')
+        started = time.perf_counter()
+        try:
+            return func(conn, *args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(op=op)
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, op=op)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Выполняет func(conn, *args, **kwargs) в потоке БД и возвращает результат."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._call, func, args, kwargs))
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        def fetchone(conn: sqlite3.Connection) -> Optional[tuple]:
+            return conn.execute(sql, params).fetchone()
+        return await self.run(fetchone)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> list[tuple]:
+        def fetchall(conn: sqlite3.Connection) -> list[tuple]:
+            return conn.execute(sql, params).fetchall()
+        return await self.run(fetchall)
+
+    async def fetchone_dict(self, sql: str, params: Sequence[Any] = ()) -> Optional[dict]:
+        """Возвращает строку как dict {колонка: значение} или None."""
+        def fetchone_dict(conn: sqlite3.Connection) -> Optional[dict]:
+            cur = conn.execute(sql, params)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([desc[0] for desc in cur.description], row))
+        return await self.run(fetchone_dict)
+
+    async def fetchval(self, sql: str, params: Sequence[Any] = (), default: Any = None) -> Any:
+        """Возвращает первое значение первой строки."""
+        row = await self.fetchone(sql, params)
+        return row[0] if row else default
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Выполняет изменяющий запрос с фиксацией, возвращает количество затронутых строк."""
+        def execute(conn: sqlite3.Connection) -> int:
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(execute)
+
+    def close(self) -> None:
+        """Останавливает пул и закрывает соединения всех потоков."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logging.error(f"Ошибка закрытия соединения с БД: {e}")
+            self._connections.clear()
@@ -0,0 +1,200 @@
+import math
+import re
+from typing import Any, Callable, NamedTuple, Optional
+from promo import format_promo_time, parse_promo_time
+
+# Диалоги ввода данных (регистрация пользователя, добавление промокода администратором) в виде таблиц:
+# состояние -> шаг (разбор и нормализация ввода, поле для значения, следующее состояние).
+# Модуль не зависит от Telegram и БД: обработчик бота выбирает шаг по состоянию из user_data,
+# сохраняет значение и отправляет вопрос следующего шага.
+
+EMAIL_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9_.+-]*@[a-zA-Z][a-zA-Z0-9-]*\.[a-zA-Z][a-zA-Z0-9-.]+')
+# Номер как его вводят люди: цифры, пробелы, скобки, дефисы, точки и необязательный "+" в начале
+PHONE_INPUT_RE = re.compile(r'\+?[\d\s\-().]{10,24}')
+PHONE_SEPARATORS_RE = re.compile(r'[\s\-().]')
+# Код страны для номеров, введенных без него (8 999 ..., 999 ...)
+DEFAULT_COUNTRY_CODE = '7'
+
+
+class InputError(ValueError):
+    """Ввод не прошел проверку; текст исключения отправляется пользователю."""
+
+
+class Step(NamedTuple):
+    prompt: str  # Вопрос, которым начинается шаг
+    parse: Callable[[str, dict], Any]  # (текст, значения предыдущих шагов) -> значение или InputError
+    field: str  # Куда сохраняется значение
+    next: Optional[str]  # Следующее состояние; None — диалог завершен
+    taken: Optional[str] = None  # Ответ, если значение уже занято другим пользователем (поле уникально)
+
+
+class Transition(NamedTuple):
+    field: str
+    value: Any
+    next: Optional[str]
+    prompt: Optional[str]  # Вопрос следующего шага
+
+
+class Dialog:
+    """Таблица шагов диалога; состояние хранится в user_data[state_key]."""
+
+    def __init__(self, state_key: str, first: str, steps: dict[str, Step]) -> None:
+        unknown = {step.next for step in steps.values() if step.next is not None} - steps.keys()
+        if first not in steps or unknown:
+            raise ValueError(f"Диалог {state_key}: неизвестные состояния {sorted(unknown | ({first} - steps.keys()))}")
+        self.state_key = state_key
+        self.first = first
+        self.steps = steps
+
+    def step(self, state: Optional[str]) -> Optional[Step]:
+        return self.steps.get(state) if state else None
+
+    def handle(self, state: str, text: str, values: Optional[dict] = None) -> Transition:
+        """Разбирает ответ на шаг state; InputError, если ввод неверный."""
+        step = self.steps[state]
+        value = step.parse(text, values or {})
+        next_step = self.steps[step.next] if step.next is not None else None
+        return Transition(step.field, value, step.next, next_step.prompt if next_step else None)
+
+
+def validate_email(email: str) -> bool:
+    return EMAIL_RE.fullmatch(email) is not None
+
+
+def normalize_phone(phone: str) -> Optional[str]:
+    """
+    Приводит номер к E.164 (+79991234567), чтобы один номер в разной записи находился как дубликат.
+    Номера без кода страны (8 999 ..., 999 ...) считаются номерами DEFAULT_COUNTRY_CODE.
+    Возвращает None, если это не номер телефона.
+    """
+    phone = phone.strip()
+    if PHONE_INPUT_RE.fullmatch(phone) is None:
+        return None
+    digits = PHONE_SEPARATORS_RE.sub('', phone)
+    if digits.lstrip('+').startswith('0'):
+        return None
+    if digits.startswith('+'):
+        digits = digits[1:]
+    elif DEFAULT_COUNTRY_CODE == '7' and len(digits) == 11 and digits[0] in '78':
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = DEFAULT_COUNTRY_CODE + digits
+    if not digits.isdigit() or not 10 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+
+def validate_phone(phone: str) -> bool:
+    return normalize_phone(phone) is not None
+
+
+def _parse_name(too_short: str, not_letters: str) -> Callable[[str, dict], str]:
+    def parse(text: str, values: dict) -> str:
+        text = text.strip()
+        if len(text) < 2:
+            raise InputError(too_short)
+        if not text.isalpha():
+            raise InputError(not_letters)
+        return text
+    return parse
+
+
+def _parse_email(text: str, values: dict) -> str:
+    email = text.strip()
+    if not validate_email(email):
+        raise InputError("Неверный формат email. Пример: example@mail.com\nВведите email:")
+    return email.lower()
+
+
+def _parse_phone(text: str, values: dict) -> str:
+    phone = normalize_phone(text)
+    if phone is None:
+        raise InputError("Неверный формат телефона. Пример: +79991234567\nВведите номер телефона:")
+    return phone
+
+
+def _parse_username(text: str, values: dict) -> str:
+    username = text.strip()
+    if not username:
+        raise InputError("Username не может быть пустым. Введите username из учетной записи telegram:")
+    return username
+
+
+def _parse_promo_code(text: str, values: dict) -> str:
+    code = text.strip()
+    if not code:
+        raise InputError("Введите промокод:")
+    return code
+
+
+REGISTRATION = Dialog('reg_state', 'name', {
+    'name': Step("Введите имя:", _parse_name(
+        "Имя слишком короткое. Введите имя (минимум 2 символа):", "Имя должно содержать только буквы."),
+        'first_name', 'surname'),
+    'surname': Step("Введите фамилию:", _parse_name(
+        "Фамилия слишком короткая. Введите фамилию (минимум 2 символа):", "Фамилия должна содержать только буквы."),
+        'last_name', 'email'),
+    'email': Step("Введите email:", _parse_email, 'email', 'phone',
+                  taken="Этот email уже зарегистрирован. Введите другой:"),
+    'phone': Step("Введите номер телефона (например, +7 (999) 123-45-67):", _parse_phone, 'phone', 'username',
+                  taken="Этот номер телефона уже зарегистрирован. Введите другой:"),
+    # Дальше бот спрашивает кнопками, есть ли промокод; шаг promo_code начинается по кнопке "Да"
+    'username': Step("Введите username из учетной записи telegram:", _parse_username, 'username', None),
+    'promo_code': Step("Введите промокод:", _parse_promo_code, 'promo_key', None),
+})
+
+
+def _parse_promo_key(text: str, values: dict) -> str:
+    key = text.strip()
+    if not key:
+        raise InputError("Введите название промокода:")
+    return key
+
+
+def _parse_price(text: str, values: dict) -> float:
+    try:
+        price = float(text.strip().replace(',', '.'))
+    except ValueError:
+        price = math.nan
+    if not math.isfinite(price) or price < 0:
+        raise InputError("Неверная цена. Введите число (например, 1500.00):")
+    return price
+
+
+def _parse_promo_start(text: str, values: dict) -> str:
+    start = parse_promo_time(text)
+    if start is None:
+        raise InputError("Неверная дата. Введите начало действия промокода (YYYY-MM-DD HH:MM:SS):")
+    return format_promo_time(start)
+
+
+def _parse_promo_end(text: str, values: dict) -> str:
+    end = parse_promo_time(text, end_of_day=True)
+    if end is None:
+        raise InputError("Неверная дата. Введите окончание действия промокода (YYYY-MM-DD HH:MM:SS):")
+    start = values.get('pending_promo_start')
+    if start is not None and end < parse_promo_time(start):
+        raise InputError("Окончание раньше начала. Введите окончание действия промокода:")
+    return format_promo_time(end)
+
+
+def _parse_max_uses(text: str, values: dict) -> Optional[int]:
+    text = text.strip()
+    if not text.isdigit():
+        raise InputError("Введите целое число (0 — без ограничения):")
+    return int(text) or None
+
+
+# Значения шагов хранятся в user_data под именами полей до создания промокода
+ADMIN_PROMO = Dialog('admin_promo_state', 'promo_key', {
+    'promo_key': Step("Введите название промокода:", _parse_promo_key, 'pending_promo_key', 'promo_price',
+                      taken="Промокод уже существует. Введите другой:"),
+    'promo_price': Step("Установите стоимость при использовании промокода (число):", _parse_price,
+                        'pending_promo_price', 'promo_start'),
+    'promo_start': Step("Введите начало действия промокода (YYYY-MM-DD HH:MM:SS):", _parse_promo_start,
+                        'pending_promo_start', 'promo_end'),
+    'promo_end': Step("Введите окончание действия промокода (YYYY-MM-DD HH:MM:SS):", _parse_promo_end,
+                      'pending_promo_end', 'promo_max_uses'),
+    'promo_max_uses': Step("Введите лимит использований промокода (0 — без ограничения):", _parse_max_uses,
+                           'pending_promo_max_uses', None),
+})
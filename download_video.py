@@ -1,7 +1,10 @@
 import io
 import os
+import time
+import asyncio
 import sqlite3
 import logging
+import subprocess
 import requests
 import yt_dlp as youtubedl
 from typing import Optional, Any, Dict
@@ -9,6 +12,10 @@ from dotenv import load_dotenv
 import re
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
+from concurrent.futures import ThreadPoolExecutor
+from db import Database
+from migrations import migrate
+from video_probe import VideoProbe, run_ffprobe, save_probe
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -21,10 +28,6 @@ if not ADMIN_ID:
 # Set up logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-# Connect to the SQLite database
-conn = sqlite3.connect('sales_in_stories.db', check_same_thread=False)
-cursor = conn.cursor()
-
 def extract_rutube_video_id(url: str) -> tuple[Optional[str], Optional[str]]:
     """Извлекает ID видео и токен p из URL Rutube"""
     match = re.search(
@@ -50,58 +53,245 @@ def get_rutube_json(video_id: str, p_token: str) -> Optional[dict]:
         print(f"API Error: {str(e)}")
         return None
 
+# Кодеки, которые Telegram воспроизводит без перекодирования
+COMPATIBLE_VIDEO_CODECS = ('h264', 'avc1')
+COMPATIBLE_AUDIO_CODECS = ('aac', 'mp4a')
+# Запас на контейнер и неточность оценки размера
+SIZE_BUDGET_MARGIN = 0.92
+FALLBACK_FORMAT = 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]'
+
+def estimate_format_size(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[float]:
+    """Размер формата в байтах: из метаданных или по битрейту (tbr, кбит/с) и длительности."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return float(size)
+    bitrate = fmt.get('tbr') or ((fmt.get('vbr') or 0) + (fmt.get('abr') or 0))
+    if bitrate and duration:
+        return bitrate * 1000 / 8 * duration
+    return None
+
+def select_format_within_budget(info: Dict[str, Any], max_bytes: int, max_height: int = 720) -> Optional[str]:
+    """
+    Выбирает по уже извлеченным метаданным лучший формат (до max_height), который укладывается в max_bytes.
+    Возвращает спецификацию формата yt-dlp ('id' или 'video_id+audio_id') или None, если размер не оценить.
+    """
+    duration = info.get('duration')
+    formats = info.get('formats') or []
+    budget = max_bytes * SIZE_BUDGET_MARGIN
+
+    def has(fmt: Dict[str, Any], kind: str) -> bool:
+        return fmt.get(kind) not in (None, 'none')
+
+    audio_only = [f for f in formats if f.get('format_id') and has(f, 'acodec') and not has(f, 'vcodec')]
+    candidates: list[tuple[tuple, str]] = []
+    for fmt in formats:
+        if not fmt.get('format_id') or not has(fmt, 'vcodec') or (fmt.get('height') or 0) > max_height:
+            continue
+        size = estimate_format_size(fmt, duration)
+        if size is None:
+            continue
+        if has(fmt, 'acodec'):
+            pairs = [(size, fmt['format_id'], fmt)]
+        else:
+            pairs = []
+            for audio in audio_only:
+                audio_size = estimate_format_size(audio, duration)
+                if audio_size is not None:
+                    pairs.append((size + audio_size, f"{fmt['format_id']}+{audio['format_id']}", fmt))
+        for total, spec, video in pairs:
+            if total <= budget:
+                compatible = str(video.get('vcodec', '')).startswith(COMPATIBLE_VIDEO_CODECS)
+                # Больше высота, затем совместимый кодек (без перекодирования), затем больший размер
+                candidates.append(((video.get('height') or 0, compatible, total), spec))
+    if not candidates:
+        return None
+    return max(candidates)[1]
+
+def finalize_video(source: str, target: str, duration: Optional[float], max_bytes: int) -> None:
+    """
+    Приводит скачанный файл к формату для Telegram: если кодеки уже H.264/AAC — быстрый remux
+    с +faststart, иначе перекодирование в libx264. Если файл превышает max_bytes, перекодирует
+    с битрейтом, рассчитанным под лимит.
+    """
+    probe = run_ffprobe(source)
+    if probe is None:
+        raise RuntimeError(f"Файл {source} не является корректным видео")
+    duration = probe.duration or duration
+    compatible = (probe.video_codec in COMPATIBLE_VIDEO_CODECS
+                  and (probe.audio_codec is None or probe.audio_codec in COMPATIBLE_AUDIO_CODECS))
+
+    if compatible and os.path.getsize(source) <= max_bytes:
+        codec_args = ['-c', 'copy']
+    elif os.path.getsize(source) <= max_bytes or not duration:
+        codec_args = ['-c:v', 'libx264', '-crf', '22', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']
+    else:
+        audio_kbps = 128
+        video_kbps = max(int(max_bytes * SIZE_BUDGET_MARGIN * 8 / 1000 / duration) - audio_kbps, 200)
+        logging.info(f"Видео {source} больше {max_bytes} байт, перекодирование с битрейтом {video_kbps}k")
+        codec_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                      '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps}k', '-bufsize', f'{video_kbps * 2}k',
+                      '-c:a', 'aac', '-b:a', f'{audio_kbps}k']
+
+    result = subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-i', source, *codec_args, '-movflags', '+faststart', target],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с ошибкой: {result.stderr.strip()[-500:]}")
+    if os.path.getsize(target) > max_bytes:
+        raise RuntimeError(f"Видео {target} превышает лимит {max_bytes} байт после перекодирования")
+
 def download_video_with_size_limit(url: str, filepath: str, max_size_mb: int = 50) -> None:
+    """
+    Скачивает видео за один запрос метаданных: extract_info без обработки (process=False) возвращает
+    сырой список форматов, по нему выбирается формат, укладывающийся в max_size_mb, и тот же результат
+    обрабатывается и скачивается с format=<выбранный формат>. Выбор формата yt-dlp по FALLBACK_FORMAT
+    выполняется, только если размер форматов не оценить.
+    """
+    max_size_bytes = max_size_mb * 1024 * 1024
+    raw_template = f'{filepath}.raw.%(ext)s'
     ydl_opts: Dict[str, Any] = {
-        'outtmpl': filepath,
+        'outtmpl': raw_template,
         'quiet': True,
-        'format': 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]',
         'merge_output_format': 'mp4',
     }
 
     with youtubedl.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        duration: Optional[int] = info.get('duration')
-        max_size_bytes = max_size_mb * 1024 * 1024
-        if duration is not None and duration > 0:
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }]
-            ydl_opts['postprocessor_args'] = [
-                '-c:v', 'libx264',
-                '-crf', '22',
-                '-preset', 'veryfast',
-                '-pix_fmt', 'yuv420p',
-                '-movflags', '+faststart',
-            ]
-
-        with youtubedl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-
-def download_all_videos() -> None:
-    logging.info("Starting download_all_videos function.")
-    cursor.execute("SELECT task_id, task_link FROM tasks;")
-    tasks = cursor.fetchall()
-
-    logging.info(f"Fetched {len(tasks)} tasks from the database.")
-
-    for task_id, video_url in tasks:
-        filepath = f'./videos/task_{task_id}.mp4'
-        if not os.path.exists(filepath):
-            logging.info(f"Starting download for task_id: {task_id}, video_url: {video_url}")
+        info = ydl.extract_info(url, download=False, process=False)
+        # Ссылка может вести на другую страницу (например, embed) — метаданные берутся с конечной
+        while info.get('_type') in ('url', 'url_transparent') and info.get('url'):
+            info = ydl.extract_info(info['url'], download=False, process=False)
+    format_spec = select_format_within_budget(info, max_size_bytes)
+    if format_spec:
+        logging.info(f"Выбран формат {format_spec} для {url}")
+    with youtubedl.YoutubeDL(dict(ydl_opts, format=format_spec or FALLBACK_FORMAT)) as ydl:
+        result = ydl.process_ie_result(info, download=True)
+
+    downloads = result.get('requested_downloads') or []
+    raw_path = downloads[0].get('filepath') if downloads else None
+    if not raw_path or not os.path.exists(raw_path):
+        raise RuntimeError(f"yt-dlp не создал файл для {url}")
+    try:
+        finalize_video(raw_path, filepath, info.get('duration'), max_size_bytes)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+def _set_download_status(conn: sqlite3.Connection, task_id: int, status: str,
+                         attempts: Optional[int] = None, error: Optional[str] = None) -> None:
+    with conn:
+        conn.execute("""
+            INSERT INTO video_downloads (task_id, status, attempts, last_error, updated_at)
+            VALUES (?, ?, COALESCE(?, 0), ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(task_id) DO UPDATE SET
+                status = excluded.status,
+                attempts = COALESCE(?, attempts),
+                last_error = excluded.last_error,
+                updated_at = CURRENT_TIMESTAMP
+        """, (task_id, status, attempts, error, attempts))
+
+class VideoPrefetcher:
+    """
+    Фоновое скачивание видео уроков пулом из нескольких потоков.
+    Видео скачивается во временный файл task_{id}.part.mp4 (yt-dlp докачивает его после сбоя)
+    и атомарно переименовывается в task_{id}.mp4 после проверки ffprobe, поэтому бот
+    никогда не отправляет недокачанный файл. Статус каждой задачи хранится в video_downloads.
+    """
+
+    def __init__(self, db: Database, videos_dir: str = './videos', workers: int = 3,
+                 attempts: int = 3, retry_delay: float = 30.0, max_size_mb: int = 50) -> None:
+        self.db = db
+        self.videos_dir = videos_dir
+        self.workers = workers
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.max_size_mb = max_size_mb
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='video-download')
+
+    def video_path(self, task_id: int) -> str:
+        return os.path.join(self.videos_dir, f'task_{task_id}.mp4')
+
+    def part_path(self, task_id: int) -> str:
+        return os.path.join(self.videos_dir, f'task_{task_id}.part.mp4')
+
+    def _download(self, task_id: int, video_url: str) -> Optional[VideoProbe]:
+        """Выполняется в потоке пула: скачивание во временный файл и проверка ffprobe."""
+        part_path = self.part_path(task_id)
+        download_video_with_size_limit(video_url, part_path, max_size_mb=self.max_size_mb)
+        if not os.path.exists(part_path):
+            raise RuntimeError(f"yt-dlp не создал файл {part_path}")
+        probe = run_ffprobe(part_path)
+        if probe is None:
+            raise RuntimeError(f"Файл {part_path} не является корректным видео")
+        return probe
+
+    async def _fetch(self, task_id: int, video_url: str) -> bool:
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            await self.db.run(_set_download_status, task_id, 'downloading', attempt)
+            logging.info(f"Скачивание видео задачи {task_id} (попытка {attempt}/{self.attempts})")
+            started = time.monotonic()
+            final_path = self.video_path(task_id)
             try:
-                download_video_with_size_limit(video_url, filepath, max_size_mb=50)
-                logging.info(f'Video {filepath} downloaded.')
+                probe = await loop.run_in_executor(self._executor, self._download, task_id, video_url)
+                os.replace(self.part_path(task_id), final_path)
+                # Rename сохраняет mtime, поэтому результат probe действителен и для итогового файла
+                await self.db.run(save_probe, final_path, probe)
             except Exception as e:
                 logging.error(f"Ошибка обработки видео для задачи {task_id}: {str(e)}")
-            finally:
-                if not os.path.exists(filepath):
-                    logging.error(f'Failed to download video для task {task_id}.')
-        else:
-            print(f"The file task_{task_id}.mp4 was uploaded earlier")
-    conn.commit()
-    conn.close()
-    logging.info(f"Completed all downloads.")
+                await self.db.run(_set_download_status, task_id, 'failed', attempt, str(e)[:500])
+                if attempt < self.attempts:
+                    await asyncio.sleep(self.retry_delay * attempt)
+                continue
+            await self.db.run(_set_download_status, task_id, 'ready', attempt)
+            logging.info(f'Video {final_path} downloaded за {time.monotonic() - started:.1f} с.')
+            return True
+        return False
+
+    async def run(self) -> None:
+        """Скачивает все отсутствующие видео; готовые файлы сразу доступны боту."""
+        os.makedirs(self.videos_dir, exist_ok=True)
+        await self.db.run(migrate)
+        tasks = await self.db.fetchall("SELECT task_id, task_link FROM tasks ORDER BY task_id")
+        logging.info(f"Fetched {len(tasks)} tasks from the database.")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for task_id, video_url in tasks:
+            if os.path.exists(self.video_path(task_id)):
+                await self.db.run(_set_download_status, task_id, 'ready')
+            elif video_url:
+                await self.db.run(_set_download_status, task_id, 'pending')
+                queue.put_nowait((task_id, video_url))
+        if queue.empty():
+            logging.info("Все видео уже скачаны.")
+            return
+        logging.info(f"Видео к скачиванию: {queue.qsize()}")
+
+        results: list[bool] = []
+
+        async def worker() -> None:
+            while True:
+                try:
+                    task_id, video_url = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                results.append(await self._fetch(task_id, video_url))
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        logging.info(f"Completed all downloads: успешно {sum(results)} из {len(results)}.")
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def download_all_videos(db_path: str = 'sales_in_stories.db') -> None:
+    """Синхронное скачивание всех видео (запуск download_video.py вручную)."""
+    db = Database(db_path)
+    prefetcher = VideoPrefetcher(db, workers=int(os.getenv('VIDEO_DOWNLOAD_WORKERS', '3')))
+    try:
+        asyncio.run(prefetcher.run())
+    finally:
+        prefetcher.close()
+        db.close()
 
 if __name__ == "__main__":
     download_all_videos()
@@ -0,0 +1,197 @@
+import re
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    from db import Database
+    from lesson_catalog import LessonCatalog
+
+# Время в БД хранится в UTC в формате CURRENT_TIMESTAMP, чтобы сравнение строк совпадало с сравнением времени
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+SEND_TIME_RE = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+UTC_OFFSET_RE = re.compile(r'^(?:UTC|GMT)?([+-])(\d{1,2})(?::?([0-5]\d))?$', re.IGNORECASE)
+
+
+class Schedule(NamedTuple):
+    unlocked_task_id: Optional[int]
+    send_time: str
+    utc_offset: int
+    next_due_at: Optional[datetime]
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_send_time(value: str) -> Optional[str]:
+    """'9:30' -> '09:30'; None, если время некорректно."""
+    match = SEND_TIME_RE.match(value.strip())
+    return f"{int(match.group(1)):02d}:{match.group(2)}" if match else None
+
+
+def parse_utc_offset(value: str) -> Optional[int]:
+    """'+3', 'UTC+05:30', '-4' -> смещение в минутах; None, если формат некорректен."""
+    match = UTC_OFFSET_RE.match(value.strip())
+    if not match:
+        return None
+    minutes = int(match.group(2)) * 60 + int(match.group(3) or 0)
+    if minutes > 14 * 60:
+        return None
+    return -minutes if match.group(1) == '-' else minutes
+
+
+def format_utc_offset(minutes: int) -> str:
+    sign = '-' if minutes < 0 else '+'
+    hours, rest = divmod(abs(minutes), 60)
+    return f"UTC{sign}{hours}" + (f":{rest:02d}" if rest else '')
+
+
+def next_release(send_time: str, utc_offset: int, released_at: datetime) -> datetime:
+    """Время следующего урока (UTC): send_time по местному времени на следующий день после released_at."""
+    hour, minute = map(int, send_time.split(':'))
+    local_day = (released_at + timedelta(minutes=utc_offset)).date() + timedelta(days=1)
+    local = datetime(local_day.year, local_day.month, local_day.day, hour, minute)
+    return local - timedelta(minutes=utc_offset)
+
+
+def _to_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.strptime(value, TIMESTAMP_FORMAT) if value else None
+
+
+def _enroll(conn: sqlite3.Connection, chat_id: int, first_id: Optional[int], next_id: Optional[int],
+            send_time: str, utc_offset: int, now: datetime) -> None:
+    next_due = next_release(send_time, utc_offset, now) if next_id is not None else None
+    with conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO lesson_schedule
+                (chat_id, unlocked_task_id, send_time, utc_offset, released_at, next_due_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (chat_id, first_id, send_time, utc_offset, now.strftime(TIMESTAMP_FORMAT),
+              next_due.strftime(TIMESTAMP_FORMAT) if next_due else None))
+
+
+def _get_schedule(conn: sqlite3.Connection, chat_id: int) -> Optional[Schedule]:
+    row = conn.execute(
+        "SELECT unlocked_task_id, send_time, utc_offset, next_due_at FROM lesson_schedule WHERE chat_id = ?",
+        (chat_id,)
+    ).fetchone()
+    return Schedule(row[0], row[1], row[2], _to_datetime(row[3])) if row else None
+
+
+def _set_send_time(conn: sqlite3.Connection, chat_id: int, send_time: str, utc_offset: int, now: datetime) -> Optional[datetime]:
+    with conn:
+        row = conn.execute(
+            "SELECT released_at, next_due_at FROM lesson_schedule WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        released_at, next_due_at = _to_datetime(row[0]) or now, row[1]
+        next_due = None
+        if next_due_at is not None:
+            # Не раньше следующего дня после последнего урока и не в прошлом
+            next_due = next_release(send_time, utc_offset, released_at)
+            while next_due <= now:
+                next_due += timedelta(days=1)
+        conn.execute(
+            "UPDATE lesson_schedule SET send_time = ?, utc_offset = ?, next_due_at = ? WHERE chat_id = ?",
+            (send_time, utc_offset, next_due.strftime(TIMESTAMP_FORMAT) if next_due else None, chat_id)
+        )
+    return next_due
+
+
+def _release_due(conn: sqlite3.Connection, now: datetime, first_id: Optional[int],
+                 next_ids: dict[int, Optional[int]], limit: int, after: tuple[str, int] = ('', 0),
+                 owns: Optional[Callable[[int], bool]] = None) -> tuple[list[tuple[int, int]], int, tuple[str, int]]:
+    """
+    Открывает следующий урок пользователям с next_due_at <= now (не более limit строк за вызов,
+    начиная после ключа after) и переносит их next_due_at на следующий день.
+    owns(chat_id) отбирает чаты текущего воркера. Возвращает ([(chat_id, task_id)], число строк, последний ключ).
+    """
+    released: list[tuple[int, int]] = []
+    updates = []
+    now_text = now.strftime(TIMESTAMP_FORMAT)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""
+            SELECT next_due_at, chat_id, unlocked_task_id, send_time, utc_offset FROM lesson_schedule
+            WHERE next_due_at IS NOT NULL AND next_due_at <= ? AND (next_due_at, chat_id) > (?, ?)
+            ORDER BY next_due_at, chat_id LIMIT ?
+        """, (now_text, after[0], after[1], limit)).fetchall()
+        for _, chat_id, unlocked_task_id, send_time, utc_offset in rows:
+            if owns is not None and not owns(chat_id):
+                continue
+            task_id = first_id if unlocked_task_id is None else next_ids.get(unlocked_task_id)
+            if task_id is None:
+                # Уроков больше нет (или урок удален из каталога) — пользователь выходит из расписания
+                updates.append((unlocked_task_id, now_text, None, chat_id))
+                continue
+            next_due = next_release(send_time, utc_offset, now) if next_ids.get(task_id) is not None else None
+            updates.append((task_id, now_text, next_due.strftime(TIMESTAMP_FORMAT) if next_due else None, chat_id))
+            released.append((chat_id, task_id))
+        conn.executemany(
+            "UPDATE lesson_schedule SET unlocked_task_id = ?, released_at = ?, next_due_at = ? WHERE chat_id = ?",
+            updates
+        )
+    last_key = (rows[-1][0], rows[-1][1]) if rows else after
+    return released, len(rows), last_key
+
+
+class LessonScheduler:
+    """
+    Открытие уроков по одному в день (курс "за 12 дней").
+    Состояние хранится только в lesson_schedule: задача JobQueue раз в минуту выбирает
+    всех пользователей с наступившим next_due_at по индексу, поэтому после перезапуска
+    ничего не нужно восстанавливать в памяти, а пропущенные уроки открываются при первом запуске.
+    """
+
+    def __init__(self, db: 'Database', catalog: 'LessonCatalog', default_send_time: str = '10:00',
+                 default_utc_offset: int = 180, batch_size: int = 1000) -> None:
+        self.db = db
+        self.catalog = catalog
+        self.default_send_time = default_send_time
+        self.default_utc_offset = default_utc_offset
+        self.batch_size = batch_size
+        self._lock = asyncio.Lock()
+
+    async def get(self, chat_id: int) -> Optional[Schedule]:
+        return await self.db.run(_get_schedule, chat_id)
+
+    async def unlocked_task_id(self, chat_id: int) -> Optional[int]:
+        """Последний открытый урок пользователя; при первом обращении пользователь ставится в расписание."""
+        schedule = await self.get(chat_id)
+        if schedule is None:
+            first_id = self.catalog.first_id
+            first = self.catalog.get(first_id) if first_id is not None else None
+            await self.db.run(_enroll, chat_id, first_id, first.next_id if first else None,
+                              self.default_send_time, self.default_utc_offset, utcnow())
+            schedule = await self.get(chat_id)
+        return schedule.unlocked_task_id if schedule else None
+
+    async def set_send_time(self, chat_id: int, send_time: str, utc_offset: Optional[int] = None) -> Optional[datetime]:
+        """Меняет время получения уроков. Возвращает время следующего урока (UTC) или None."""
+        await self.unlocked_task_id(chat_id)
+        if utc_offset is None:
+            schedule = await self.get(chat_id)
+            utc_offset = schedule.utc_offset if schedule else self.default_utc_offset
+        return await self.db.run(_set_send_time, chat_id, send_time, utc_offset, utcnow())
+
+    async def release_due(self, now: Optional[datetime] = None,
+                          owns: Optional[Callable[[int], bool]] = None) -> list[tuple[int, int]]:
+        """
+        Открывает уроки всем, у кого наступило время. Возвращает [(chat_id, task_id)].
+        В режиме нескольких воркеров owns(chat_id) оставляет только чаты этого воркера.
+        """
+        now = now or utcnow()
+        next_ids = {task_id: lesson.next_id for task_id, lesson in self.catalog.lessons.items()}
+        released: list[tuple[int, int]] = []
+        after = ('', 0)
+        async with self._lock:
+            while True:
+                batch, processed, after = await self.db.run(
+                    _release_due, now, self.catalog.first_id, next_ids, self.batch_size, after, owns
+                )
+                released.extend(batch)
+                if processed < self.batch_size:
+                    return released
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, NamedTuple, Optional
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+if TYPE_CHECKING:
+    from db import Database
+
+
+class Lesson(NamedTuple):
+    """Урок с заранее собранным текстом сообщения и клавиатурой перехода к следующему уроку."""
+    task_id: int
+    name: str
+    text: str
+    link: Optional[str]
+    next_id: Optional[int]
+    reply_markup: Optional[InlineKeyboardMarkup]
+
+
+def build_lessons(rows: list[tuple]) -> dict[int, Lesson]:
+    """Строит уроки из строк (task_id, task_name, task_content, task_link), упорядоченных по task_id."""
+    lessons: dict[int, Lesson] = {}
+    for index, (task_id, task_name, task_content, task_link) in enumerate(rows):
+        # Следующий урок — следующий существующий task_id (номера могут идти с пропусками)
+        next_id = rows[index + 1][0] if index + 1 < len(rows) else None
+        text = f"{task_name}\n{task_content}"
+        if task_link:
+            text += f"\n\nСсылка: {task_link}"  # Добавление ссылки если есть
+        reply_markup = None
+        if next_id is not None:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Следующий урок", callback_data=str(next_id))]])
+        lessons[task_id] = Lesson(task_id, task_name, text, task_link, next_id, reply_markup)
+    return lessons
+
+
+def _tasks_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = 'tasks'").fetchone()
+    return row[0] if row else 0
+
+
+def _load(conn: sqlite3.Connection) -> tuple[int, list[tuple]]:
+    # Версия и строки читаются в одной транзакции, чтобы не пропустить изменение между ними
+    with conn:
+        conn.execute("BEGIN")
+        version = _tasks_version(conn)
+        rows = conn.execute(
+            "SELECT task_id, task_name, task_content, task_link FROM tasks ORDER BY task_id"
+        ).fetchall()
+    return version, rows
+
+
+class LessonCatalog:
+    """
+    Уроки курса в памяти: навигация по урокам не обращается к БД.
+    Каталог перечитывается командой администратора или при изменении счетчика
+    cache_versions('tasks'), который увеличивают триггеры на таблице tasks.
+    """
+
+    def __init__(self, db: 'Database') -> None:
+        self.db = db
+        self.lessons: dict[int, Lesson] = {}
+        self.first_id: Optional[int] = None
+        self.version: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    def get(self, task_id: int) -> Optional[Lesson]:
+        return self.lessons.get(task_id)
+
+    def __len__(self) -> int:
+        return len(self.lessons)
+
+    async def reload(self) -> int:
+        """Перечитывает уроки из БД; возвращает количество уроков."""
+        async with self._lock:
+            version, rows = await self.db.run(_load)
+            lessons = build_lessons(rows)
+            # Замена ссылок атомарна для обработчиков: они видят либо старый, либо новый каталог
+            self.lessons = lessons
+            self.first_id = rows[0][0] if rows else None
+            self.version = version
+        logging.info(f"Каталог уроков загружен: {len(lessons)} уроков, версия {version}")
+        return len(lessons)
+
+    async def refresh_if_changed(self, version: Optional[int] = None) -> bool:
+        """Перечитывает уроки, только если таблица tasks менялась с последней загрузки."""
+        if version is None:
+            version = await self.db.run(_tasks_version)
+        if version == self.version:
+            return False
+        await self.reload()
+        return True
@@ -0,0 +1,60 @@
+import os
+import sqlite3
+from typing import NamedTuple, Optional
+
+
+class CachedVideo(NamedTuple):
+    """Запись кэша: file_id, который Telegram вернул после первой загрузки видео."""
+    file_id: str
+    width: Optional[int]
+    height: Optional[int]
+    duration: Optional[int]
+
+
+# Максимальная длина подписи к медиа (в UTF-16 символах, как считает Telegram)
+CAPTION_LIMIT = 1024
+
+
+def fits_caption(text: str) -> bool:
+    return len(text.encode('utf-16-le')) // 2 <= CAPTION_LIMIT
+
+
+def file_signature(path: str) -> tuple[int, int]:
+    """Возвращает (mtime_ns, size) файла — по ним определяется, что видео не менялось."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def get_cached_video(conn: sqlite3.Connection, task_id: int, path: str) -> Optional[CachedVideo]:
+    """Возвращает file_id видео задачи, если файл не изменился с момента загрузки."""
+    mtime_ns, size = file_signature(path)
+    row = conn.execute("""
+        SELECT file_id, width, height, duration FROM media_cache
+        WHERE task_id = ? AND file_mtime_ns = ? AND file_size = ?
+    """, (task_id, mtime_ns, size)).fetchone()
+    return CachedVideo(*row) if row else None
+
+
+def save_cached_video(conn: sqlite3.Connection, task_id: int, path: str, video) -> None:
+    """Сохраняет telegram.Video из ответа send_video для повторного использования."""
+    mtime_ns, size = file_signature(path)
+    conn.execute("""
+        INSERT OR REPLACE INTO media_cache
+            (task_id, file_mtime_ns, file_size, file_id, file_unique_id, width, height, duration)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (task_id, mtime_ns, size, video.file_id, video.file_unique_id,
+          video.width, video.height, _seconds(video.duration)))
+    conn.commit()
+
+
+def _seconds(value) -> Optional[int]:
+    """PTB 22 отдает duration как int или timedelta в зависимости от PTB_TIMEDELTA."""
+    if value is None:
+        return None
+    return int(value.total_seconds()) if hasattr(value, 'total_seconds') else int(value)
+
+
+def delete_cached_video(conn: sqlite3.Connection, task_id: int) -> None:
+    """Удаляет запись кэша (например, если Telegram перестал принимать file_id)."""
+    conn.execute("DELETE FROM media_cache WHERE task_id = ?", (task_id,))
+    conn.commit()
@@ -0,0 +1,203 @@
+import time
+import asyncio
+import ipaddress
+import logging
+import threading
+from functools import wraps
+from typing import Callable, Optional, Sequence
+from aiohttp import web
+
+# Счетчики и гистограммы в текстовом формате Prometheus без внешних зависимостей.
+# Метрики обновляются и из потоков пула БД, поэтому у каждой метрики своя блокировка.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * len(self.buckets)
+                self._sums[key] = 0.0
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    'bot_handler_seconds', 'Время обработки update обработчиком', ('handler', 'kind')))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках', ('handler', 'kind')))
+LESSON_DELIVERY = REGISTRY.register(Histogram(
+    'bot_lesson_delivery_seconds', 'Этапы отправки урока', ('stage',)))
+VIDEO_SEND = REGISTRY.register(Histogram(
+    'bot_video_send_seconds', 'Отправка видео урока: по file_id или загрузкой файла', ('source',),
+    buckets=DEFAULT_BUCKETS + (60.0, 120.0)))
+UPLOAD_BYTES = REGISTRY.register(Counter(
+    'bot_upload_bytes_total', 'Объем файлов, загруженных в Telegram', ('kind',)))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    'bot_cache_requests_total', 'Обращения к кэшам (result: hit/miss)', ('cache', 'result')))
+YOOKASSA_LATENCY = REGISTRY.register(Histogram(
+    'yookassa_request_seconds', 'Запросы к YooKassa (одна попытка)', ('method', 'outcome')))
+DB_LATENCY = REGISTRY.register(Histogram(
+    'db_query_seconds', 'Выполнение функций БД в пуле потоков (без ожидания в очереди)', ('op',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+DB_ERRORS = REGISTRY.register(Counter(
+    'db_errors_total', 'Ошибки функций БД', ('op',)))
+LOOP_LAG = REGISTRY.register(Histogram(
+    'event_loop_lag_seconds', 'Задержка event loop (опоздание таймера)',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+
+
+def cache_result(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def instrument_handler(name: str, kind: Optional[Callable] = None):
+    """Декоратор обработчика PTB: время обработки и исключения; kind(update) — метка типа update."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update, context):
+            labels = {'handler': name, 'kind': kind(update) if kind else ''}
+            started = time.perf_counter()
+            try:
+                return await func(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(**labels)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """Фоновая задача: насколько позже запланированного просыпается sleep(interval)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - started - interval
+        LOOP_LAG.observe(max(lag, 0.0))
+        if lag > 1.0:
+            logging.warning(f"Event loop заблокирован на {lag:.2f} с")
+
+
+def create_metrics_handler(local_only: bool = True):
+    """Обработчик GET /metrics; по умолчанию доступен только с loopback адресов."""
+    async def handler(request: web.Request) -> web.Response:
+        if local_only:
+            try:
+                if not ipaddress.ip_address(request.remote or '').is_loopback:
+                    return web.Response(status=403)
+            except ValueError:
+                return web.Response(status=403)
+        return web.Response(
+            body=REGISTRY.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+    return handler
@@ -0,0 +1,467 @@
+import re
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+# Миграции схемы sales_in_stories.db. Номер примененной миграции хранится в PRAGMA user_version,
+# поэтому при обычном запуске выполняется только чтение версии.
+# Новые изменения схемы добавляются в конец списка MIGRATIONS; существующие миграции не меняются.
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _add_version_triggers(conn: sqlite3.Connection, table: str) -> None:
+    """Счетчик cache_versions(table) увеличивается при любом изменении таблицы."""
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES (?, 0)", (table,))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE cache_versions SET version = version + 1 WHERE name = '{table}';
+            END
+        """)
+
+
+def m001_base_schema(conn: sqlite3.Connection) -> None:
+    """Основные таблицы бота (для существующих баз — только недостающие колонки)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id INTEGER PRIMARY KEY,
+            task_name TEXT NOT NULL,
+            task_content TEXT NOT NULL,
+            task_link TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE,
+            yookassa_payment_id TEXT UNIQUE,
+            status TEXT DEFAULT 'pending',
+            amount REAL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            phone TEXT,
+            email TEXT UNIQUE,
+            consent_agreed INTEGER DEFAULT 0,
+            registered INTEGER DEFAULT 0,
+            link_clicked INTEGER DEFAULT 0,
+            promo_key TEXT,
+            promo_price REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS promo (
+            promo_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            promo_key TEXT UNIQUE NOT NULL,
+            promo_price REAL NOT NULL,
+            promo_start_period TEXT NOT NULL,
+            promo_end_period TEXT NOT NULL
+        )
+    """)
+    _add_column(conn, 'users', 'username', 'TEXT')
+    _add_column(conn, 'payments', 'confirmation_url', 'TEXT')
+
+
+def m002_service_tables(conn: sqlite3.Connection) -> None:
+    """Кэши медиа, статусы скачивания, persistence и история отчетов."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            task_id INTEGER PRIMARY KEY,
+            file_mtime_ns INTEGER NOT NULL,
+            file_size INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration INTEGER,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS video_probe (
+            path TEXT PRIMARY KEY,
+            file_mtime_ns INTEGER NOT NULL,
+            file_size INTEGER NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            duration INTEGER,
+            video_codec TEXT,
+            audio_codec TEXT,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS video_downloads (
+            task_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending, downloading, ready, failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_chat_data (
+            chat_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_kv (
+            key TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_conversations (
+            name TEXT NOT NULL,
+            conv_key BLOB NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, conv_key)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS report_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            since TEXT,
+            until TEXT,
+            format TEXT NOT NULL,
+            rows INTEGER NOT NULL
+        )
+    """)
+
+
+def m003_tasks_primary_key(conn: sqlite3.Connection) -> None:
+    """
+    Исправление расхождения схемы: в рабочей базе tasks создана с суррогатным id и task_id без индекса.
+    Таблица пересоздается с task_id INTEGER PRIMARY KEY (поиск урока — по rowid).
+    """
+    if 'id' not in _columns(conn, 'tasks'):
+        return
+    conn.execute("""
+        CREATE TABLE tasks_new (
+            task_id INTEGER PRIMARY KEY,
+            task_name TEXT NOT NULL,
+            task_content TEXT NOT NULL,
+            task_link TEXT
+        )
+    """)
+    # При дублях task_id остается последняя добавленная строка
+    conn.execute("""
+        INSERT INTO tasks_new (task_id, task_name, task_content, task_link)
+        SELECT task_id, COALESCE(task_name, ''), COALESCE(task_content, ''), task_link
+        FROM tasks
+        WHERE id IN (SELECT MAX(id) FROM tasks WHERE task_id IS NOT NULL GROUP BY task_id)
+    """)
+    conn.execute("DROP TABLE tasks")
+    conn.execute("ALTER TABLE tasks_new RENAME TO tasks")
+
+
+def m004_hot_path_indexes(conn: sqlite3.Connection) -> None:
+    """Индексы для частых запросов: проверка оплаты, сверка платежей, промокоды, отчеты."""
+    # Поиск платежа по chat_id уже идет по UNIQUE-индексу (одна строка на пользователя)
+    # Сверка платежей pending по времени создания
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments(status, created_at)")
+    # Действующие промокоды по периоду
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_period ON promo(promo_start_period, promo_end_period)")
+    # Отчеты и список пользователей по дате регистрации
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
+
+
+def m005_cache_versions(conn: sqlite3.Connection) -> None:
+    """
+    Счетчики изменений таблиц, данные которых кэшируются в памяти.
+    Кэш сверяет один счетчик вместо перечитывания таблицы; счетчик увеличивают триггеры,
+    поэтому изменения, сделанные вручную через sqlite3, тоже учитываются.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    _add_version_triggers(conn, 'tasks')
+
+
+def m006_broadcasts(conn: sqlite3.Connection) -> None:
+    """Рассылки администратора и прогресс по каждому получателю (для возобновления после перезапуска)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            audience TEXT NOT NULL,
+            text TEXT,
+            task_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',  -- queued, running, done, cancelled, failed
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            finished_at TIMESTAMP NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending, sent, failed, blocked
+            error TEXT,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def m007_lesson_schedule(conn: sqlite3.Connection) -> None:
+    """
+    Расписание уроков: один новый урок в день в выбранное пользователем местное время.
+    Планировщик выбирает пользователей по частичному индексу next_due_at.
+    Пользователи, оплатившие курс до появления расписания, получают доступ ко всем урокам.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lesson_schedule (
+            chat_id INTEGER PRIMARY KEY,
+            unlocked_task_id INTEGER,
+            send_time TEXT NOT NULL,  -- местное время HH:MM
+            utc_offset INTEGER NOT NULL,  -- смещение местного времени от UTC, в минутах
+            released_at TIMESTAMP,  -- UTC, когда открыт последний урок
+            next_due_at TIMESTAMP  -- UTC, NULL когда все уроки открыты
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lesson_schedule_due
+        ON lesson_schedule(next_due_at) WHERE next_due_at IS NOT NULL
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO lesson_schedule (chat_id, unlocked_task_id, send_time, utc_offset, released_at)
+        SELECT chat_id, (SELECT MAX(task_id) FROM tasks), '10:00', 180, CURRENT_TIMESTAMP
+        FROM payments WHERE status = 'succeeded' AND chat_id IS NOT NULL
+    """)
+
+
+def m008_promo_version(conn: sqlite3.Connection) -> None:
+    """Счетчик изменений промокодов для сброса их кэша во всех воркерах."""
+    _add_version_triggers(conn, 'promo')
+
+
+# Форматы периодов промокодов на момент m009 (копия из promo.py: миграция не должна меняться вместе с ним)
+_M009_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+_M009_INPUT_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M')
+_M009_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+
+def _m009_parse_promo_time(text: str, end_of_day: bool = False) -> Optional[datetime]:
+    text = ' '.join(text.split())
+    for fmt in _M009_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    for fmt in _M009_DATE_FORMATS:
+        try:
+            day = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return day + timedelta(days=1, seconds=-1) if end_of_day else day
+    return None
+
+
+def m009_promo_usage(conn: sqlite3.Connection) -> None:
+    """
+    Лимит и счетчик использований промокодов; периоды приводятся к формату _M009_TIME_FORMAT.
+    Счетчик использований меняется при каждом применении кода, поэтому он не увеличивает
+    cache_versions('promo') — кэш промокодов перечитывается только при изменении самих кодов.
+    """
+    _add_column(conn, 'promo', 'max_uses', 'INTEGER')
+    _add_column(conn, 'promo', 'used_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute("DROP TRIGGER IF EXISTS promo_version_update")
+    conn.execute("""
+        CREATE TRIGGER promo_version_update
+        AFTER UPDATE OF promo_key, promo_price, promo_start_period, promo_end_period, max_uses ON promo
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'promo';
+        END
+    """)
+    for promo_id, start_text, end_text in conn.execute(
+            "SELECT promo_id, promo_start_period, promo_end_period FROM promo").fetchall():
+        start = _m009_parse_promo_time(start_text or '')
+        end = _m009_parse_promo_time(end_text or '', end_of_day=True)
+        if start is None or end is None:
+            logging.warning(f"Промокод {promo_id}: некорректный период '{start_text}' — '{end_text}' оставлен без изменений")
+            continue
+        conn.execute("UPDATE promo SET promo_start_period = ?, promo_end_period = ? WHERE promo_id = ?",
+                     (start.strftime(_M009_TIME_FORMAT), end.strftime(_M009_TIME_FORMAT), promo_id))
+
+
+def m010_user_status_version(conn: sqlite3.Connection) -> None:
+    """
+    Счетчик для кэша статусов пользователей: увеличивается при изменении статуса платежа
+    и удалении пользователя или платежа (частые записи users через репозиторий его не меняют).
+    """
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('user_status', 0)")
+    for name, event in (('payments_status_update', 'UPDATE OF status ON payments'),
+                        ('payments_status_delete', 'DELETE ON payments'),
+                        ('users_status_delete', 'DELETE ON users')):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event}
+            BEGIN
+                UPDATE cache_versions SET version = version + 1 WHERE name = 'user_status';
+            END
+        """)
+
+
+# Правила нормализации телефонов на момент m011 (копия из dialogs.py: миграция не должна меняться вместе с ним)
+_M011_PHONE_INPUT_RE = re.compile(r'\+?[\d\s\-().]{10,24}')
+_M011_PHONE_SEPARATORS_RE = re.compile(r'[\s\-().]')
+
+
+def _m011_normalize_phone(phone: str) -> Optional[str]:
+    """Номер в E.164; номера без кода страны (8 999 ..., 999 ...) считаются российскими."""
+    phone = phone.strip()
+    if _M011_PHONE_INPUT_RE.fullmatch(phone) is None:
+        return None
+    digits = _M011_PHONE_SEPARATORS_RE.sub('', phone)
+    if digits.lstrip('+').startswith('0'):
+        return None
+    if digits.startswith('+'):
+        digits = digits[1:]
+    elif len(digits) == 11 and digits[0] in '78':
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    if not digits.isdigit() or not 10 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+
+def m011_canonical_contacts(conn: sqlite3.Connection) -> None:
+    """
+    Телефоны приводятся к E.164, email — к нижнему регистру, как их теперь сохраняет регистрация,
+    чтобы проверка дубликатов находила старые записи. Индекс по телефону для этой проверки.
+    """
+    for chat_id, phone in conn.execute("SELECT chat_id, phone FROM users WHERE phone IS NOT NULL").fetchall():
+        canonical = _m011_normalize_phone(phone)
+        if canonical is None:
+            logging.warning(f"Пользователь {chat_id}: телефон '{phone}' не распознан и оставлен без изменений")
+        elif canonical != phone:
+            conn.execute("UPDATE users SET phone = ? WHERE chat_id = ?", (canonical, chat_id))
+    # email, который в нижнем регистре уже есть у другого пользователя, не меняется (UNIQUE)
+    for chat_id, email in conn.execute("SELECT chat_id, email FROM users WHERE email != lower(email)").fetchall():
+        conn.execute("""
+            UPDATE users SET email = lower(email)
+            WHERE chat_id = ? AND NOT EXISTS (SELECT 1 FROM users WHERE email = ?)
+        """, (chat_id, email.lower()))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone)")
+
+
+def m012_payment_attempts(conn: sqlite3.Connection) -> None:
+    """
+    Прежние платежи pending, замененные новым (сумма изменилась после промокода).
+    Ссылку на старый платеж еще можно оплатить, поэтому его статус продолжает отслеживаться.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payment_attempts (
+            yookassa_payment_id TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            amount REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payment_attempts_pending
+        ON payment_attempts(created_at) WHERE status = 'pending'
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_attempts_chat ON payment_attempts(chat_id)")
+
+
+def m013_user_status_paid_revoked(conn: sqlite3.Connection) -> None:
+    """
+    Счетчик 'user_status' увеличивается только при потере статуса succeeded: кэш статусов доверяет
+    только paid=True, неоплаченный статус всегда перепроверяется. Прежний триггер срабатывал на каждую
+    запись status (в том числе на создание платежа) и очищал кэш статусов всех воркеров.
+    """
+    conn.execute("DROP TRIGGER IF EXISTS payments_status_update")
+    conn.execute("""
+        CREATE TRIGGER payments_status_update AFTER UPDATE OF status ON payments
+        WHEN OLD.status = 'succeeded' AND NEW.status IS NOT 'succeeded'
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'user_status';
+        END
+    """)
+
+
+def m014_payment_last_checked(conn: sqlite3.Connection) -> None:
+    """
+    Время последней сверки платежа pending с YooKassa: сверка берет сначала непроверенные
+    и давно проверенные платежи, чтобы при большом числе pending очередь доходила до всех.
+    """
+    _add_column(conn, 'payments', 'last_checked_at', 'TIMESTAMP')
+    _add_column(conn, 'payment_attempts', 'last_checked_at', 'TIMESTAMP')
+
+
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    m001_base_schema,
+    m002_service_tables,
+    m003_tasks_primary_key,
+    m004_hot_path_indexes,
+    m005_cache_versions,
+    m006_broadcasts,
+    m007_lesson_schedule,
+    m008_promo_version,
+    m009_promo_usage,
+    m010_user_status_version,
+    m011_canonical_contacts,
+    m012_payment_attempts,
+    m013_user_status_paid_revoked,
+    m014_payment_last_checked,
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает итоговую версию схемы."""
+    version = schema_version(conn)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Воркеры запускаются одновременно: миграцию мог уже применить другой процесс
+            if schema_version(conn) >= number:
+                conn.rollback()
+                version = number
+                continue
+            logging.info(f"Применение миграции {number}: {migration.__name__}")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    return version
@@ -0,0 +1,126 @@
+import time
+import random
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+import requests
+from yookassa import Payment
+from yookassa.domain.exceptions import ApiError, ResponseProcessingError, TooManyRequestsError
+from metrics import YOOKASSA_LATENCY
+
+T = TypeVar('T')
+
+
+class PaymentGatewayUnavailable(Exception):
+    """YooKassa недоступна: circuit breaker разомкнут или исчерпаны повторные попытки."""
+
+
+class CircuitBreaker:
+    """
+    Простой circuit breaker: после failure_threshold ошибок подряд вызовы отклоняются
+    на reset_timeout секунд, затем пропускается одна пробная попытка.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_progress = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_progress:
+            return False
+        # Полуоткрытое состояние: одна пробная попытка
+        self._trial_in_progress = True
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    def release_trial(self) -> None:
+        """Пробная попытка прервана (отмена задачи) без ответа YooKassa: следующий вызов снова может быть пробным."""
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_progress = False
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.warning(f"YooKassa: {self.failures} ошибок подряд, запросы приостановлены на {self.reset_timeout} с")
+            self.opened_at = time.monotonic()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Временные ошибки: таймауты, сетевые сбои, 429, 202 (запрос в обработке) и 5xx."""
+    if isinstance(error, (asyncio.TimeoutError, requests.RequestException, TooManyRequestsError, ResponseProcessingError)):
+        return True
+    # Ошибки 5xx SDK выбрасывает как базовый ApiError, остальные 4xx — как его наследников
+    return type(error) is ApiError
+
+
+class PaymentGateway:
+    """
+    Обертка над синхронным SDK YooKassa: вызовы выполняются в отдельном пуле потоков
+    с ограничением параллельности, таймаутом, повторами с джиттером и circuit breaker.
+    """
+
+    def __init__(self, max_workers: int = 4, timeout: float = 15.0, attempts: int = 3,
+                 backoff: float = 0.5, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='yookassa')
+        self._semaphore = asyncio.Semaphore(max_workers)
+
+    async def _call(self, name: str, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            if not self.breaker.allow():
+                YOOKASSA_LATENCY.observe(0.0, method=name, outcome='rejected')
+                raise PaymentGatewayUnavailable(f"YooKassa временно недоступна ({name})")
+            started = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    result = await asyncio.wait_for(
+                        loop.run_in_executor(self._executor, partial(func, *args)), self.timeout
+                    )
+                YOOKASSA_LATENCY.observe(time.perf_counter() - started, method=name, outcome='ok')
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                YOOKASSA_LATENCY.observe(time.perf_counter() - started, method=name,
+                                         outcome='retryable' if is_retryable(e) else 'error')
+                if not is_retryable(e):
+                    # Ошибка запроса (400/401/403/404) — повтор не поможет, и сервис при этом доступен
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                logging.warning(f"YooKassa {name}: попытка {attempt}/{self.attempts} не удалась: {e!r}")
+                if attempt == self.attempts:
+                    raise PaymentGatewayUnavailable(f"YooKassa {name}: исчерпаны попытки") from e
+            except BaseException:
+                # Отмена (CancelledError) или остановка процесса: иначе пробная попытка
+                # полуоткрытого breaker осталась бы занятой навсегда
+                self.breaker.release_trial()
+                raise
+            # Экспоненциальная задержка с полным джиттером
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+        raise PaymentGatewayUnavailable(name)  # недостижимо при attempts >= 1
+
+    async def create_payment(self, params: dict, idempotency_key: str):
+        """Payment.create; повторы используют тот же ключ идемпотентности, поэтому дубль не создается."""
+        return await self._call('Payment.create', Payment.create, params, idempotency_key)
+
+    async def find_payment(self, payment_id: str):
+        return await self._call('Payment.find_one', Payment.find_one, payment_id)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,161 @@
+import pickle
+import asyncio
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, Any, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Маркер удаления записи в очереди на запись
+_DELETED = object()
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранение context.user_data, chat_data, bot_data и состояний ConversationHandler
+    в sales_in_stories.db, чтобы перезапуск бота не сбрасывал регистрацию и навигацию по урокам.
+
+    Запись отложенная: Application вызывает update_* раз в update_interval секунд,
+    изменения копятся в памяти и записываются одной транзакцией.
+    """
+
+    def __init__(self, db: 'Database', update_interval: float = 10,
+                 store_data: Optional[PersistenceInput] = None) -> None:
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.db = db
+        self._user_data: dict[int, Any] = {}
+        self._chat_data: dict[int, Any] = {}
+        self._kv: dict[str, Any] = {}
+        self._conversations: dict[tuple[str, bytes], Any] = {}
+        self._stored_kv: dict[str, bytes] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    # --- Загрузка при старте ---
+
+    async def get_user_data(self) -> dict[int, dict]:
+        rows = await self.db.fetchall("SELECT user_id, data FROM persistence_user_data")
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        rows = await self.db.fetchall("SELECT chat_id, data FROM persistence_chat_data")
+        return {chat_id: pickle.loads(data) for chat_id, data in rows}
+
+    async def _get_kv(self, key: str) -> Any:
+        data = await self.db.fetchval("SELECT data FROM persistence_kv WHERE key = ?", (key,))
+        if data is None:
+            return None
+        self._stored_kv[key] = data
+        return pickle.loads(data)
+
+    async def get_bot_data(self) -> dict:
+        return await self._get_kv('bot_data') or {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return await self._get_kv('callback_data')
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self.db.fetchall(
+            "SELECT conv_key, state FROM persistence_conversations WHERE name = ?", (name,)
+        )
+        return {tuple(pickle.loads(key)): pickle.loads(state) for key, state in rows}
+
+    # --- Изменения (копятся до следующей записи) ---
+
+    def _schedule_write(self) -> None:
+        # Все update_* одного цикла Application.update_persistence попадают в одну транзакцию
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._user_data[user_id] = pickle.dumps(data)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data[user_id] = _DELETED
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._chat_data[chat_id] = pickle.dumps(data)
+        self._schedule_write()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._chat_data[chat_id] = _DELETED
+        self._schedule_write()
+
+    def _update_kv(self, key: str, value: Any) -> None:
+        data = pickle.dumps(value)
+        if self._stored_kv.get(key) == data:
+            return  # bot_data передается каждый цикл, неизмененные данные не перезаписываем
+        self._kv[key] = data
+        self._schedule_write()
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._update_kv('bot_data', data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._update_kv('callback_data', data)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        conv_key = pickle.dumps(tuple(key))
+        self._conversations[(name, conv_key)] = _DELETED if new_state is None else pickle.dumps(new_state)
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # --- Запись ---
+
+    def _write(self, conn: sqlite3.Connection, user_data: dict, chat_data: dict, kv: dict, conversations: dict) -> None:
+        with conn:
+            for table, column, pending in (('persistence_user_data', 'user_id', user_data),
+                                           ('persistence_chat_data', 'chat_id', chat_data)):
+                deleted = [(key,) for key, data in pending.items() if data is _DELETED]
+                updated = [(key, data) for key, data in pending.items() if data is not _DELETED]
+                if deleted:
+                    conn.executemany(f"DELETE FROM {table} WHERE {column} = ?", deleted)
+                if updated:
+                    conn.executemany(f"INSERT OR REPLACE INTO {table} ({column}, data) VALUES (?, ?)", updated)
+            if kv:
+                conn.executemany("INSERT OR REPLACE INTO persistence_kv (key, data) VALUES (?, ?)", kv.items())
+            for (name, conv_key), state in conversations.items():
+                if state is _DELETED:
+                    conn.execute("DELETE FROM persistence_conversations WHERE name = ? AND conv_key = ?", (name, conv_key))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO persistence_conversations (name, conv_key, state) VALUES (?, ?, ?)",
+                        (name, conv_key, state)
+                    )
+
+    async def _write_pending(self) -> None:
+        await asyncio.sleep(0)  # дать остальным update_* текущего цикла добавить свои изменения
+        while self._user_data or self._chat_data or self._kv or self._conversations:
+            user_data, self._user_data = self._user_data, {}
+            chat_data, self._chat_data = self._chat_data, {}
+            kv, self._kv = self._kv, {}
+            conversations, self._conversations = self._conversations, {}
+            try:
+                await self.db.run(self._write, user_data, chat_data, kv, conversations)
+            except Exception as e:
+                logging.error(f"Ошибка записи persistence: {e}")
+                # Вернуть несохраненные изменения в очередь (более новые значения не затираем)
+                self._user_data = {**user_data, **self._user_data}
+                self._chat_data = {**chat_data, **self._chat_data}
+                self._kv = {**kv, **self._kv}
+                self._conversations = {**conversations, **self._conversations}
+                return
+            self._stored_kv.update(kv)
+            logging.debug(f"Persistence: сохранено {len(user_data)} user_data, {len(chat_data)} chat_data")
+
+    async def flush(self) -> None:
+        """Вызывается при остановке бота: дожидается записи всех накопленных изменений."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Формат хранения периода промокода в БД (местное время сервера)
+PROMO_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Форматы, в которых администратор может ввести дату
+PROMO_INPUT_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M')
+PROMO_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+
+class Promo(NamedTuple):
+    promo_id: int
+    key: str
+    price: float
+    start: datetime
+    end: datetime
+    max_uses: Optional[int]
+
+    def is_active(self, now: datetime) -> bool:
+        return self.start <= now <= self.end
+
+
+def parse_promo_time(text: str, end_of_day: bool = False) -> Optional[datetime]:
+    """
+    Разбирает дату периода промокода. Дата без времени означает начало дня
+    (или конец дня, если end_of_day). Возвращает None, если формат не распознан.
+    """
+    text = ' '.join(text.split())
+    for fmt in PROMO_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    for fmt in PROMO_DATE_FORMATS:
+        try:
+            day = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return day + timedelta(days=1, seconds=-1) if end_of_day else day
+    return None
+
+
+def format_promo_time(value: datetime) -> str:
+    return value.strftime(PROMO_TIME_FORMAT)
+
+
+def _promo_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = 'promo'").fetchone()
+    return row[0] if row else 0
+
+
+def _load(conn: sqlite3.Connection) -> tuple[int, list[tuple]]:
+    with conn:
+        conn.execute("BEGIN")
+        version = _promo_version(conn)
+        rows = conn.execute("""
+            SELECT promo_id, promo_key, promo_price, promo_start_period, promo_end_period, max_uses FROM promo
+        """).fetchall()
+    return version, rows
+
+
+def _create(conn: sqlite3.Connection, key: str, price: float, start: str, end: str,
+            max_uses: Optional[int]) -> Optional[int]:
+    try:
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO promo (promo_key, promo_price, promo_start_period, promo_end_period, max_uses)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, price, start, end, max_uses))
+    except sqlite3.IntegrityError:
+        return None  # Промокод с таким названием уже есть
+    return cursor.lastrowid
+
+
+def _delete(conn: sqlite3.Connection, promo_id: int) -> Optional[str]:
+    with conn:
+        row = conn.execute("SELECT promo_key FROM promo WHERE promo_id = ?", (promo_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM promo WHERE promo_id = ?", (promo_id,))
+    return row[0]
+
+
+def _redeem(conn: sqlite3.Connection, promo_id: int, chat_id: int, key: str) -> bool:
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT promo_key FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is not None and row[0] == key:
+            return True  # Повторный ввод того же промокода не расходует лимит
+        # Проверка лимита и увеличение счетчика — одна атомарная операция
+        cursor = conn.execute("""
+            UPDATE promo SET used_count = used_count + 1
+            WHERE promo_id = ? AND (max_uses IS NULL OR used_count < max_uses)
+        """, (promo_id,))
+    return cursor.rowcount == 1
+
+
+def _list_all(conn: sqlite3.Connection) -> list[tuple]:
+    return conn.execute("""
+        SELECT promo_id, promo_key, promo_price, promo_start_period, promo_end_period, max_uses, used_count
+        FROM promo ORDER BY promo_start_period DESC
+    """).fetchall()
+
+
+class PromoService:
+    """
+    Промокоды в памяти: проверка кода при регистрации — поиск в dict без запроса к БД.
+    Период разбирается в datetime при создании промокода и при загрузке кэша.
+    Кэш перечитывается после добавления и удаления промокода и при изменении счетчика
+    cache_versions('promo') (изменения из других воркеров или вручную в БД).
+    Счетчик использований в кэш не входит: лимит проверяется атомарным UPDATE в БД.
+    """
+
+    def __init__(self, db: 'Database') -> None:
+        self.db = db
+        self.promos: dict[str, Promo] = {}
+        self.version: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    async def reload(self) -> int:
+        async with self._lock:
+            version, rows = await self.db.run(_load)
+            promos: dict[str, Promo] = {}
+            for promo_id, key, price, start_text, end_text, max_uses in rows:
+                start = parse_promo_time(start_text or '')
+                end = parse_promo_time(end_text or '', end_of_day=True)
+                if start is None or end is None:
+                    logging.warning(f"Промокод {key}: некорректный период '{start_text}' — '{end_text}', пропущен")
+                    continue
+                promos[key] = Promo(promo_id, key, price, start, end, max_uses)
+            self.promos = promos
+            self.version = version
+        logging.info(f"Промокоды загружены: {len(promos)}, версия {version}")
+        return len(promos)
+
+    async def refresh_if_changed(self, version: Optional[int] = None) -> bool:
+        if version is None:
+            version = await self.db.run(_promo_version)
+        if version == self.version:
+            return False
+        await self.reload()
+        return True
+
+    def get_active(self, key: str, now: Optional[datetime] = None) -> Optional[Promo]:
+        promo = self.promos.get(key)
+        if promo is None or not promo.is_active(now or datetime.now()):
+            return None
+        return promo
+
+    def active(self, now: Optional[datetime] = None) -> list[Promo]:
+        now = now or datetime.now()
+        return sorted((promo for promo in self.promos.values() if promo.is_active(now)), key=lambda promo: promo.start)
+
+    def exists(self, key: str) -> bool:
+        return key in self.promos
+
+    async def redeem(self, key: str, chat_id: int) -> Optional[Promo]:
+        """Применяет промокод пользователем: None, если код не действует или лимит исчерпан."""
+        promo = self.get_active(key)
+        if promo is None:
+            return None
+        if not await self.db.run(_redeem, promo.promo_id, chat_id, key):
+            return None
+        return promo
+
+    async def create(self, key: str, price: float, start: datetime, end: datetime,
+                     max_uses: Optional[int] = None) -> Optional[int]:
+        """Добавляет промокод. Возвращает promo_id или None, если такое название уже есть."""
+        if end < start:
+            raise ValueError("Окончание действия промокода раньше начала")
+        promo_id = await self.db.run(_create, key, price, format_promo_time(start), format_promo_time(end), max_uses)
+        if promo_id is not None:
+            await self.reload()
+        return promo_id
+
+    async def delete(self, promo_id: int) -> Optional[str]:
+        """Удаляет промокод. Возвращает его название или None, если промокода нет."""
+        key = await self.db.run(_delete, promo_id)
+        if key is not None:
+            await self.reload()
+        return key
+
+    async def list_all(self) -> list[tuple]:
+        return await self.db.run(_list_all)
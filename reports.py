@@ -0,0 +1,127 @@
+import os
+import csv
+import gzip
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from typing import Optional
+
+try:
+    from openpyxl import Workbook  # Необязательная зависимость для отчета в XLSX
+except ImportError:
+    Workbook = None
+
+REPORT_COLUMNS = [
+    "Номер п/п", "Фамилия", "Имя", "Номер телефона", "email",
+    "Дата заявки", "Дата оплаты", "Бюджет", "Оплата", "Промокод",
+]
+
+REPORT_FORMATS = ('csv', 'gz', 'xlsx')
+
+
+def available_report_formats() -> tuple[str, ...]:
+    """Форматы, которые можно выгрузить в текущем окружении (XLSX — только с openpyxl)."""
+    return tuple(fmt for fmt in REPORT_FORMATS if fmt != 'xlsx' or Workbook is not None)
+
+# Номер п/п считается при записи, чтобы SQLite не материализовал оконную функцию по всей выборке
+REPORT_QUERY = """
+    SELECT
+        u.last_name,
+        u.first_name,
+        u.phone,
+        u.email,
+        u.created_at,
+        p.paid_at,
+        p.amount,
+        CASE WHEN p.status = 'succeeded' THEN 'Оплачено' ELSE 'Не оплачено' END,
+        COALESCE(u.promo_key, 'Нет')
+    FROM users u
+    LEFT JOIN payments p ON u.chat_id = p.chat_id
+    WHERE (? IS NULL OR u.created_at >= ? OR p.paid_at >= ?)
+      AND (? IS NULL OR u.created_at < ?)
+    ORDER BY u.created_at
+"""
+
+
+class ReportFormatUnavailable(Exception):
+    """Формат отчета не поддерживается (например, не установлен openpyxl для XLSX)."""
+
+
+def last_report_time(conn: sqlite3.Connection) -> Optional[str]:
+    """Время последней выгрузки в формате CURRENT_TIMESTAMP (UTC) или None."""
+    row = conn.execute("SELECT MAX(created_at) FROM report_runs").fetchone()
+    return row[0] if row else None
+
+
+def report_timestamp() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP (UTC), как в report_runs.created_at."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def record_report_run(conn: sqlite3.Connection, created_at: str, fmt: str, since: Optional[str],
+                      until: Optional[str], rows: int) -> None:
+    """
+    Фиксирует выгрузку после успешной отправки: отчет "новые с прошлого отчета" начинается с created_at.
+    created_at — время начала выборки, поэтому строки, добавленные во время выгрузки, попадут в следующий отчет.
+    """
+    with conn:
+        conn.execute(
+            "INSERT INTO report_runs (created_at, since, until, format, rows) VALUES (?, ?, ?, ?, ?)",
+            (created_at, since, until, fmt, rows)
+        )
+
+
+def _iter_rows(conn: sqlite3.Connection, since: Optional[str], until: Optional[str], batch_size: int):
+    cur = conn.execute(REPORT_QUERY, (since, since, since, until, until))
+    number = 0
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            return
+        for row in batch:
+            number += 1
+            yield (number, *row)
+
+
+def write_report(conn: sqlite3.Connection, fmt: str = 'csv', since: Optional[str] = None,
+                 until: Optional[str] = None, batch_size: int = 1000) -> tuple[str, int]:
+    """
+    Записывает отчет во временный файл, читая строки из курсора порциями (fetchmany),
+    и возвращает (путь к файлу, количество строк). Выполняется в потоке БД.
+    Файл удаляет вызывающий код после отправки, затем фиксирует выгрузку через record_report_run.
+    """
+    if fmt not in REPORT_FORMATS:
+        raise ReportFormatUnavailable(f"Неизвестный формат отчета: {fmt}")
+    if fmt == 'xlsx' and Workbook is None:
+        raise ReportFormatUnavailable("Для отчета в XLSX установите openpyxl")
+
+    suffix = {'csv': '.csv', 'gz': '.csv.gz', 'xlsx': '.xlsx'}[fmt]
+    fd, path = tempfile.mkstemp(prefix='report_', suffix=suffix)
+    os.close(fd)
+    rows = 0
+    try:
+        if fmt == 'xlsx':
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet("Отчет")
+            sheet.append(REPORT_COLUMNS)
+            for row in _iter_rows(conn, since, until, batch_size):
+                sheet.append(row)
+                rows += 1
+            workbook.save(path)
+        else:
+            opener = gzip.open if fmt == 'gz' else open
+            with opener(path, 'wt', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(REPORT_COLUMNS)
+                for row in _iter_rows(conn, since, until, batch_size):
+                    writer.writerow(row)
+                    rows += 1
+    except Exception:
+        os.remove(path)
+        raise
+    return path, rows
+
+
+def report_filename(fmt: str) -> str:
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    return f"report_{timestamp}" + {'csv': '.csv', 'gz': '.csv.gz', 'xlsx': '.xlsx'}[fmt]
@@ -0,0 +1,43 @@
+import hmac
+import json
+import logging
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+if TYPE_CHECKING:
+    from workers import WorkerRouter
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_telegram_webhook_handler(application: Application, secret_token: Optional[str] = None,
+                                    router: Optional['WorkerRouter'] = None,
+                                    secret_header: str = SECRET_TOKEN_HEADER) -> Callable[[web.Request], Awaitable[web.Response]]:
+    """
+    Обработчик входящих update от Telegram для встроенного HTTP сервера.
+    Update ставится в очередь Application и обрабатывается так же, как при polling;
+    Telegram получает ответ сразу, не дожидаясь обработки.
+    Если задан router, update чужих чатов пересылаются воркеру-владельцу.
+    """
+
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token and not hmac.compare_digest(request.headers.get(secret_header, ''), secret_token):
+            logging.warning(f"Webhook Telegram с неверным secret token от {request.remote} отклонен")
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logging.warning(f"Некорректный update Telegram: {e}")
+            return web.Response(status=400)
+        if router is not None:
+            chat_id = update.effective_chat.id if update.effective_chat else (
+                update.effective_user.id if update.effective_user else None)
+            if not router.is_local(chat_id):
+                return web.Response(status=await router.forward(chat_id, body))
+        await application.update_queue.put(update)
+        return web.Response(status=200)
+
+    return handle
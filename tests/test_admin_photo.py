@@ -0,0 +1,30 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from telegram import InputFile
+from admin_photo import AdminPhotoCache
+
+
+def test_first_upload_is_single_flight():
+    cache = AdminPhotoCache('1')
+    cache.photo_bytes = b'jpeg'
+    cache.checked_at = time.monotonic()
+    sent = []
+
+    async def send_photo(photo):
+        sent.append(photo)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id='photo-file-id')])
+
+    async def greet():
+        photo = await cache.get(None)
+        return await cache.send(photo, send_photo)
+
+    async def run():
+        return await asyncio.gather(*(greet() for _ in range(5)))
+
+    asyncio.run(run())
+    # Файл загружается один раз, остальные приветствия отправляются по file_id
+    assert sum(isinstance(photo, InputFile) for photo in sent) == 1
+    assert sent[1:] == ['photo-file-id'] * 4
+    assert cache.file_id == 'photo-file-id' and cache.photo_bytes is None
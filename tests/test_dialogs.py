@@ -0,0 +1,68 @@
+import pytest
+from dialogs import ADMIN_PROMO, REGISTRATION, InputError, normalize_phone, validate_email, validate_phone
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('+7 (999) 123-45-67', '+79991234567'),
+    ('+79991234567', '+79991234567'),
+    ('8 999 123 45 67', '+79991234567'),
+    ('8-999-123-45-67', '+79991234567'),
+    ('79991234567', '+79991234567'),
+    ('(999) 123.45.67', '+79991234567'),
+    ('  9991234567 ', '+79991234567'),
+    ('+44 20 7946 0958', '+442079460958'),
+    ('+1-202-555-0143', '+12025550143'),
+])
+def test_phone_is_normalized_to_e164(text, expected):
+    assert normalize_phone(text) == expected
+    assert validate_phone(text)
+
+
+@pytest.mark.parametrize('text', [
+    '', '123', '12345', '+7 999 abc 45 67', '++79991234567', '7+9991234567',
+    '0000000000', '+0 999 123 45 67', '+1234567890123456', 'телефон',
+])
+def test_invalid_phone_is_rejected(text):
+    assert normalize_phone(text) is None
+    assert not validate_phone(text)
+
+
+def test_same_number_in_different_notation_is_one_phone():
+    variants = ['+7 (999) 123-45-67', '8 999 1234567', '9991234567']
+    assert len({normalize_phone(text) for text in variants}) == 1
+
+
+@pytest.mark.parametrize('text', ['ivan@mail.ru', 'Ivan.Petrov+course@Example-Mail.ru', 'a_b-c@x.co.uk'])
+def test_valid_email(text):
+    assert validate_email(text)
+
+
+@pytest.mark.parametrize('text', ['', 'ivan', 'ivan@', '@mail.ru', 'ivan@mail', '1ivan@mail.ru',
+                                  'ivan@mail.ru\n', 'ivan petrov@mail.ru', 'ivan@@mail.ru'])
+def test_invalid_email(text):
+    assert not validate_email(text)
+
+
+def test_email_step_lower_cases_and_strips():
+    transition = REGISTRATION.handle('email', '  Ivan.Petrov@Mail.RU ')
+    assert transition.field == 'email'
+    assert transition.value == 'ivan.petrov@mail.ru'
+    assert transition.next == 'phone'
+    assert transition.prompt == REGISTRATION.steps['phone'].prompt
+
+
+def test_phone_step_stores_e164():
+    assert REGISTRATION.handle('phone', '8 (999) 123-45-67').value == '+79991234567'
+
+
+@pytest.mark.parametrize('state, text', [('email', 'not-an-email'), ('phone', '12-34'), ('name', 'A'), ('name', 'Иван1')])
+def test_invalid_registration_input_raises(state, text):
+    with pytest.raises(InputError):
+        REGISTRATION.handle(state, text)
+
+
+def test_promo_end_before_start_is_rejected():
+    values = {'pending_promo_start': ADMIN_PROMO.handle('promo_start', '2025-02-01').value}
+    with pytest.raises(InputError):
+        ADMIN_PROMO.handle('promo_end', '2025-01-01', values)
+    assert ADMIN_PROMO.handle('promo_end', '2025-02-01', values).value == '2025-02-01 23:59:59'
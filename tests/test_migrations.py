@@ -0,0 +1,51 @@
+import sqlite3
+from migrations import MIGRATIONS, m011_canonical_contacts, migrate
+
+
+def test_m011_normalizes_stored_contacts():
+    conn = sqlite3.connect(':memory:')
+    for migration in MIGRATIONS[:MIGRATIONS.index(m011_canonical_contacts)]:
+        migration(conn)
+    conn.executemany("INSERT INTO users (chat_id, phone, email) VALUES (?, ?, ?)", [
+        (1, '8 (999) 123-45-67', 'Ivan@Mail.ru'),
+        (2, 'не телефон', 'ivan@MAIL.ru'),  # тот же email в нижнем регистре уже занят — не меняется
+        (3, None, 'petr@mail.ru'),
+    ])
+    conn.execute(f"PRAGMA user_version = {MIGRATIONS.index(m011_canonical_contacts)}")
+    conn.commit()
+
+    migrate(conn)
+
+    rows = conn.execute("SELECT chat_id, phone, email FROM users ORDER BY chat_id").fetchall()
+    assert rows == [
+        (1, '+79991234567', 'ivan@mail.ru'),
+        (2, 'не телефон', 'ivan@MAIL.ru'),
+        (3, None, 'petr@mail.ru'),
+    ]
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(users)")}
+    assert 'idx_users_phone' in indexes
+
+
+def _user_status_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT version FROM cache_versions WHERE name = 'user_status'").fetchone()[0]
+
+
+def test_user_status_version_changes_only_when_paid_status_is_lost():
+    conn = sqlite3.connect(':memory:')
+    migrate(conn)
+    with conn:
+        conn.execute("INSERT INTO payments (chat_id, yookassa_payment_id, status) VALUES (1, 'pay-1', 'pending')")
+    version = _user_status_version(conn)
+
+    with conn:
+        # Новый платеж поверх прежнего (нажатие "Купить курс") и подтверждение оплаты кэш не сбрасывают
+        conn.execute("""
+            INSERT INTO payments (chat_id, yookassa_payment_id, status) VALUES (1, 'pay-2', 'pending')
+            ON CONFLICT (chat_id) DO UPDATE SET yookassa_payment_id = excluded.yookassa_payment_id, status = 'pending'
+        """)
+        conn.execute("UPDATE payments SET status = 'succeeded' WHERE chat_id = 1")
+    assert _user_status_version(conn) == version
+
+    with conn:
+        conn.execute("UPDATE payments SET status = 'canceled' WHERE chat_id = 1")
+    assert _user_status_version(conn) == version + 1
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import pytest
+import requests
+from payment_gateway import PaymentGateway, PaymentGatewayUnavailable
+
+
+def fail() -> None:
+    raise requests.ConnectionError('YooKassa недоступна')
+
+
+def test_cancelled_trial_does_not_block_gateway():
+    gateway = PaymentGateway(max_workers=2, timeout=5, attempts=1, failure_threshold=1, reset_timeout=0)
+    release = threading.Event()
+
+    async def run() -> None:
+        with pytest.raises(PaymentGatewayUnavailable):
+            await gateway._call('fail', fail)
+        assert gateway.breaker.opened_at is not None
+
+        # Пробная попытка полуоткрытого breaker отменяется, не дождавшись ответа
+        trial = asyncio.create_task(gateway._call('hang', release.wait, 5))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        release.set()
+
+        # Следующий вызов снова пропускается как пробный и закрывает breaker
+        assert await gateway._call('ok', lambda: 'ok') == 'ok'
+        assert gateway.breaker.opened_at is None
+
+    try:
+        asyncio.run(run())
+    finally:
+        gateway.close()
+
+
+def test_breaker_rejects_calls_while_trial_is_running():
+    gateway = PaymentGateway(max_workers=2, timeout=5, attempts=1, failure_threshold=1, reset_timeout=0)
+    release = threading.Event()
+
+    async def run() -> None:
+        with pytest.raises(PaymentGatewayUnavailable):
+            await gateway._call('fail', fail)
+        trial = asyncio.create_task(gateway._call('slow', release.wait, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(PaymentGatewayUnavailable):
+            await gateway._call('ok', lambda: 'ok')
+        release.set()
+        assert await trial is True
+
+    try:
+        asyncio.run(run())
+    finally:
+        gateway.close()
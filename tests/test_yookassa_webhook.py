@@ -0,0 +1,108 @@
+import asyncio
+from contextlib import closing
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from db import Database
+from migrations import migrate
+from yookassa_webhook import create_yookassa_webhook_handler, reconcile_pending_payments
+
+YOOKASSA_IP = '185.71.76.1'  # Из диапазона адресов уведомлений YooKassa
+ATTACKER_IP = '203.0.113.5'
+
+
+def notification(event: str = 'payment.succeeded', payment_id: str = 'pay-1') -> dict:
+    return {
+        'type': 'notification',
+        'event': event,
+        'object': {
+            'id': payment_id, 'status': event.split('.')[1], 'paid': True,
+            'amount': {'value': '1990.00', 'currency': 'RUB'},
+            'created_at': '2024-01-01T00:00:00.000Z', 'test': True,
+            'recipient': {'account_id': '1', 'gateway_id': '1'},
+        },
+    }
+
+
+def post(body: dict, headers: dict, api_status: str = 'succeeded', trust_proxy: bool = True) -> tuple[int, list]:
+    """Отправляет уведомление в обработчик; возвращает HTTP статус и вызовы on_status."""
+    applied = []
+
+    async def on_status(payment_id: str, status: str) -> None:
+        applied.append((payment_id, status))
+
+    async def fetch_status(payment_id: str) -> str:
+        return api_status
+
+    async def run() -> int:
+        app = web.Application()
+        app.router.add_post('/yookassa', create_yookassa_webhook_handler(
+            on_status, fetch_status, verify_ip=True, trust_proxy=trust_proxy))
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post('/yookassa', json=body, headers=headers)
+            return response.status
+
+    return asyncio.run(run()), applied
+
+
+def test_forged_forwarded_for_is_rejected():
+    # Клиент подставил адрес YooKassa первым, proxy дописал настоящий адрес в конец
+    status, applied = post(notification(), {'X-Forwarded-For': f'{YOOKASSA_IP}, {ATTACKER_IP}'})
+    assert status == 403
+    assert applied == []
+
+
+def test_direct_request_without_proxy_ignores_forwarded_for():
+    status, applied = post(notification(), {'X-Forwarded-For': YOOKASSA_IP}, trust_proxy=False)
+    assert status == 403
+    assert applied == []
+
+
+def test_forged_status_is_not_applied():
+    # Уведомление с доверенного адреса, но в YooKassa платеж еще не оплачен
+    status, applied = post(notification(), {'X-Forwarded-For': YOOKASSA_IP}, api_status='pending')
+    assert status == 200
+    assert applied == []
+
+
+def test_status_is_taken_from_api():
+    status, applied = post(notification('payment.succeeded'), {'X-Forwarded-For': f'{ATTACKER_IP}, {YOOKASSA_IP}'},
+                           api_status='canceled')
+    assert status == 200
+    assert applied == [('pay-1', 'canceled')]
+
+
+def test_succeeded_payment_is_applied():
+    status, applied = post(notification(), {'X-Forwarded-For': YOOKASSA_IP})
+    assert status == 200
+    assert applied == [('pay-1', 'succeeded')]
+
+
+def test_reconcile_reaches_payments_beyond_batch(tmp_path):
+    db = Database(str(tmp_path / 'payments.db'), workers=1)
+    with closing(db.connect()) as conn:
+        migrate(conn)
+        with conn:
+            conn.executemany("""
+                INSERT INTO payments (chat_id, yookassa_payment_id, status, created_at)
+                VALUES (?, ?, 'pending', datetime('now', '-1 hour', ?))
+            """, [(chat_id, f'pay-{chat_id}', f'+{chat_id} seconds') for chat_id in range(120)])
+    checked = []
+
+    async def fetch_status(payment_id: str) -> str:
+        checked.append(payment_id)
+        return 'pending'
+
+    async def on_status(payment_id: str, status: str) -> None:
+        pass
+
+    async def run() -> None:
+        for _ in range(3):
+            await reconcile_pending_payments(db, fetch_status, on_status, batch_size=50)
+
+    try:
+        asyncio.run(run())
+    finally:
+        db.close()
+    # Первые три запуска проверяют все 120 платежей, а не трижды одни и те же 50 самых старых
+    assert len(set(checked[:100])) == 100
+    assert {f'pay-{chat_id}' for chat_id in range(120)} <= set(checked)
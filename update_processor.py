@@ -0,0 +1,56 @@
+import asyncio
+import sys
+from typing import Any, Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка update разных чатов (не более max_concurrent_updates одновременно),
+    при этом update одного чата обрабатываются строго по очереди: регистрация, оплата и
+    навигация по урокам пользователя не перемешиваются.
+    Update без чата (например, poll) обрабатываются без очереди.
+
+    Семафор BaseUpdateProcessor.process_update берется до do_process_update, то есть до очереди чата:
+    update, ожидающие свой чат, занимали бы общие слоты, и один чат с длинной очередью (повторные
+    нажатия во время загрузки видео) останавливал бы остальных. Поэтому общий семафор не ограничивает,
+    а слот из собственного семафора берется только после блокировки чата.
+    """
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должен быть положительным")
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiting: dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        chat_id = chat.id
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._waiting[chat_id] = self._waiting.get(chat_id, 0) + 1
+        try:
+            # asyncio.Lock выдается в порядке ожидания, поэтому порядок update чата сохраняется
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._waiting[chat_id] -= 1
+            if not self._waiting[chat_id]:
+                # Блокировки неактивных чатов не накапливаются
+                del self._waiting[chat_id]
+                del self._locks[chat_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, NamedTuple, Optional
+from metrics import cache_result
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Колонки users, которые можно менять через репозиторий (имена подставляются в SQL)
+USER_FIELDS = frozenset({
+    'first_name', 'last_name', 'username', 'phone', 'email',
+    'consent_agreed', 'registered', 'link_clicked', 'promo_key', 'promo_price',
+})
+
+# (chat_id, {поле: значение}, future вызывающего)
+PendingWrite = tuple[int, dict[str, Any], asyncio.Future]
+
+
+class UserStatus(NamedTuple):
+    """Флаги пользователя, которые проверяются при каждом действии."""
+    exists: bool
+    consent_agreed: bool
+    registered: bool
+    paid: bool
+    promo_price: Optional[float]
+
+    @property
+    def consent_and_registered(self) -> bool:
+        return self.consent_agreed and self.registered
+
+
+# Поля users, которые входят в UserStatus
+STATUS_FIELDS = frozenset({'consent_agreed', 'registered', 'promo_price'})
+
+
+@lru_cache(maxsize=128)
+def upsert_sql(fields: tuple[str, ...]) -> str:
+    """Один запрос на создание пользователя и обновление полей (текст кэшируется по набору полей)."""
+    unknown = set(fields) - USER_FIELDS
+    if unknown:
+        raise ValueError(f"Неизвестные поля пользователя: {', '.join(sorted(unknown))}")
+    if not fields:
+        return "INSERT INTO users (chat_id) VALUES (?) ON CONFLICT (chat_id) DO NOTHING"
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' * (len(fields) + 1))
+    assignments = ', '.join(f"{field} = excluded.{field}" for field in fields)
+    return f"INSERT INTO users (chat_id, {columns}) VALUES ({placeholders}) ON CONFLICT (chat_id) DO UPDATE SET {assignments}"
+
+
+def _upsert(conn: sqlite3.Connection, chat_id: int, fields: dict[str, Any]) -> None:
+    conn.execute(upsert_sql(tuple(fields)), (chat_id, *fields.values()))
+
+
+def _write_batch(conn: sqlite3.Connection, batch: list[tuple[int, dict[str, Any]]]) -> list[Optional[Exception]]:
+    """
+    Записывает пачку изменений одной транзакцией (один fsync). Каждая запись — в своем SAVEPOINT:
+    ошибка одной записи (например, занятый email) откатывает только ее. Возвращает ошибки по записям.
+    """
+    errors: list[Optional[Exception]] = []
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for chat_id, fields in batch:
+            conn.execute("SAVEPOINT user_write")
+            try:
+                _upsert(conn, chat_id, fields)
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO user_write")
+                errors.append(e)
+            else:
+                errors.append(None)
+            conn.execute("RELEASE user_write")
+    return errors
+
+
+def _get(conn: sqlite3.Connection, chat_id: int) -> Optional[dict]:
+    cursor = conn.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([desc[0] for desc in cursor.description], row))
+
+
+def _is_paid(conn: sqlite3.Connection, chat_id: int) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM payments WHERE chat_id = ? AND status = 'succeeded'", (chat_id,)
+    ).fetchone() is not None
+
+
+def _load_status(conn: sqlite3.Connection, chat_id: int) -> UserStatus:
+    row = conn.execute(
+        "SELECT consent_agreed, registered, promo_price FROM users WHERE chat_id = ?", (chat_id,)
+    ).fetchone()
+    paid = _is_paid(conn, chat_id)
+    if row is None:
+        return UserStatus(False, False, False, paid, None)
+    consent_agreed, registered, promo_price = row
+    return UserStatus(True, consent_agreed == 1, registered == 1, paid, promo_price)
+
+
+class UserRepository:
+    """
+    Данные пользователей. Изменения из обработчиков разных пользователей собираются
+    в течение flush_interval и фиксируются одной транзакцией (group commit):
+    при всплеске регистраций число fsync не растет с числом пользователей.
+    update() возвращается после фиксации, поэтому последующий get() видит изменения.
+
+    Статусы пользователей (UserStatus) хранятся в LRU на status_cache_size записей и
+    обновляются при записи через репозиторий, поэтому проверка доступа к уроку не обращается к БД.
+    Оплата может быть подтверждена другим воркером (уведомление YooKassa приходит любому),
+    поэтому кэшируется только paid=True: неоплаченный статус всегда перепроверяется в БД
+    (и считается промахом кэша в метрике).
+    Удаление пользователя или платежа и отмена успешной оплаты сбрасывают кэш всех воркеров
+    через cache_versions('user_status').
+    """
+
+    def __init__(self, db: 'Database', flush_interval: float = 0.005, max_batch: int = 256,
+                 status_cache_size: int = 10000) -> None:
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.status_cache_size = status_cache_size
+        self.status_version: Optional[int] = None
+        self._queue: Optional[asyncio.Queue[Optional[PendingWrite]]] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._statuses: OrderedDict[int, UserStatus] = OrderedDict()
+        # Загрузки статуса, которые еще не завершились; запись пользователя делает загрузку устаревшей
+        self._loading: dict[int, object] = {}
+
+    async def get(self, chat_id: int) -> Optional[dict]:
+        return await self.db.run(_get, chat_id)
+
+    async def ensure(self, chat_id: int) -> None:
+        """Создает запись пользователя, если ее нет."""
+        status = self._statuses.get(chat_id)
+        if status is not None and status.exists:
+            return
+        await self.update(chat_id)
+
+    def _remember(self, chat_id: int, status: UserStatus) -> None:
+        self._statuses[chat_id] = status
+        self._statuses.move_to_end(chat_id)
+        while len(self._statuses) > self.status_cache_size:
+            self._statuses.popitem(last=False)
+
+    async def status(self, chat_id: int) -> UserStatus:
+        """Статус пользователя из кэша (при промахе — один запрос к БД)."""
+        status = self._statuses.get(chat_id)
+        if status is not None and status.paid:
+            self._statuses.move_to_end(chat_id)
+            cache_result('user_status', True)
+            return status
+        if status is not None:
+            # Кэшированный статус без оплаты: оплата перепроверяется запросом к БД, поэтому это промах
+            cache_result('user_status', False)
+            paid = await self.db.run(_is_paid, chat_id)
+            current = self._statuses.get(chat_id)
+            if paid and current is not None:
+                status = current._replace(paid=True)
+                self._remember(chat_id, status)
+            return status._replace(paid=paid)
+        cache_result('user_status', False)
+        token = self._loading[chat_id] = object()
+        try:
+            status = await self.db.run(_load_status, chat_id)
+        finally:
+            current_token = self._loading.get(chat_id)
+            if current_token is token:
+                del self._loading[chat_id]
+        if current_token is token:
+            self._remember(chat_id, status)
+        return status
+
+    async def is_paid(self, chat_id: int) -> bool:
+        return (await self.status(chat_id)).paid
+
+    def invalidate(self, chat_id: int) -> None:
+        """Сбрасывает статус пользователя (изменение платежа, удаление пользователя)."""
+        self._statuses.pop(chat_id, None)
+        self._loading.pop(chat_id, None)
+
+    def _apply(self, chat_id: int, fields: dict[str, Any]) -> None:
+        self._loading.pop(chat_id, None)
+        status = self._statuses.get(chat_id)
+        if status is None:
+            return
+        changes = {field: value for field, value in fields.items() if field in STATUS_FIELDS}
+        for flag in ('consent_agreed', 'registered'):
+            if flag in changes:
+                changes[flag] = changes[flag] == 1
+        self._statuses[chat_id] = status._replace(exists=True, **changes)
+
+    async def refresh_status_if_changed(self, version: int) -> bool:
+        """Подписчик cache_versions('user_status'): очищает кэш статусов при изменениях из других воркеров."""
+        if version == self.status_version:
+            return False
+        if self.status_version is not None:
+            self._statuses.clear()
+            self._loading.clear()
+        self.status_version = version
+        return True
+
+    async def update(self, chat_id: int, **fields: Any) -> None:
+        """Создает пользователя или обновляет его поля; ждет фиксации транзакции."""
+        upsert_sql(tuple(fields))  # Неизвестные поля — ошибка вызывающего, а не всей пачки
+        if self._writer is None or self._writer.done():
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, fields, future))
+        await future
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if self.flush_interval:
+                # Окно сбора: записи других пользователей попадают в ту же транзакцию
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[PendingWrite]) -> None:
+        try:
+            errors = await self.db.run(_write_batch, [(chat_id, fields) for chat_id, fields, _ in batch])
+        except Exception as e:
+            logging.error(f"Ошибка записи пользователей ({len(batch)}): {e}")
+            errors = [e] * len(batch)
+        for (chat_id, fields, future), error in zip(batch, errors):
+            if error is None:
+                self._apply(chat_id, fields)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def close(self) -> None:
+        """Записывает накопленные изменения и останавливает фоновую запись."""
+        if self._writer is None or self._queue is None:
+            return
+        await self._queue.put(None)
+        await self._writer
+        self._writer = None
@@ -0,0 +1,114 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import subprocess
+from typing import TYPE_CHECKING, NamedTuple, Optional
+from metrics import cache_result
+
+if TYPE_CHECKING:
+    from db import Database
+
+
+class VideoProbe(NamedTuple):
+    """Параметры видео файла, полученные от ffprobe."""
+    width: int
+    height: int
+    duration: Optional[int]
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+
+
+DEFAULT_PROBE = VideoProbe(640, 360, None, None, None)
+
+FFPROBE_ARGS = [
+    'ffprobe', '-v', 'error',
+    '-show_entries', 'stream=codec_type,codec_name,width,height:format=duration',
+    '-of', 'json',
+]
+
+
+def parse_ffprobe_output(output: str) -> Optional[VideoProbe]:
+    """Разбирает JSON-вывод ffprobe в VideoProbe."""
+    try:
+        data = json.loads(output)
+    except ValueError:
+        return None
+    streams = data.get('streams') or []
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if not video or not video.get('width') or not video.get('height'):
+        return None
+    try:
+        duration = round(float(data.get('format', {}).get('duration')))
+    except (TypeError, ValueError):
+        duration = None
+    return VideoProbe(
+        width=int(video['width']),
+        height=int(video['height']),
+        duration=duration,
+        video_codec=video.get('codec_name'),
+        audio_codec=audio.get('codec_name') if audio else None,
+    )
+
+
+def get_cached_probe(conn: sqlite3.Connection, path: str) -> Optional[VideoProbe]:
+    """Возвращает сохраненный результат probe, если файл не менялся (mtime и размер совпадают)."""
+    st = os.stat(path)
+    row = conn.execute("""
+        SELECT width, height, duration, video_codec, audio_codec FROM video_probe
+        WHERE path = ? AND file_mtime_ns = ? AND file_size = ?
+    """, (path, st.st_mtime_ns, st.st_size)).fetchone()
+    return VideoProbe(*row) if row else None
+
+
+def save_probe(conn: sqlite3.Connection, path: str, probe: VideoProbe) -> None:
+    """Сохраняет результат probe вместе с mtime и размером файла."""
+    st = os.stat(path)
+    conn.execute("""
+        INSERT OR REPLACE INTO video_probe
+            (path, file_mtime_ns, file_size, width, height, duration, video_codec, audio_codec)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (path, st.st_mtime_ns, st.st_size, *probe))
+    conn.commit()
+
+
+def run_ffprobe(path: str) -> Optional[VideoProbe]:
+    """Синхронный запуск ffprobe без обращения к БД (для потоков скачивания)."""
+    try:
+        result = subprocess.run(FFPROBE_ARGS + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except FileNotFoundError:
+        logging.warning("ffprobe не найден, размеры видео не определены")
+        return None
+    if result.returncode != 0:
+        logging.warning(f"ffprobe завершился с ошибкой для {path}: {result.stderr.strip()}")
+        return None
+    return parse_ffprobe_output(result.stdout)
+
+
+async def probe_video(db: 'Database', path: str) -> Optional[VideoProbe]:
+    """
+    Асинхронный probe: сначала ищет результат в video_probe, при промахе запускает ffprobe
+    через asyncio.create_subprocess_exec, не блокируя event loop.
+    """
+    cached = await db.run(get_cached_probe, path)
+    cache_result('video_probe', cached is not None)
+    if cached:
+        return cached
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *FFPROBE_ARGS, path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        logging.warning("ffprobe не найден, размеры видео не определены")
+        return None
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        logging.warning(f"ffprobe завершился с ошибкой для {path}: {stderr.decode(errors='replace').strip()}")
+        return None
+    probe = parse_ffprobe_output(stdout.decode(errors='replace'))
+    if probe:
+        await db.run(save_probe, path, probe)
+    return probe
@@ -0,0 +1,46 @@
+import logging
+from typing import Awaitable, Callable, Optional
+from aiohttp import web
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class WebServer:
+    """
+    Встроенный HTTP сервер (aiohttp), работающий в том же event loop, что и бот.
+    Используется для входящих уведомлений внешних сервисов.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self._runner: Optional[web.AppRunner] = None
+
+    def add_route(self, method: str, path: str, handler: Handler) -> None:
+        self.app.router.add_route(method, path, handler)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logging.info(f"HTTP сервер запущен на {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logging.info("HTTP сервер остановлен")
+
+
+def client_ip(request: web.Request, trust_proxy: bool = False) -> Optional[str]:
+    """
+    IP клиента; за reverse proxy берется последний адрес из X-Forwarded-For — его добавил сам proxy.
+    Первые адреса списка передает клиент, и им нельзя доверять.
+    """
+    if trust_proxy:
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(',')[-1].strip() or None
+    return request.remote
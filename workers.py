@@ -0,0 +1,82 @@
+import bisect
+import hashlib
+import logging
+from typing import Optional
+import aiohttp
+
+# Заголовок с общим секретом для update, пересылаемых между воркерами
+FORWARD_SECRET_HEADER = 'X-Worker-Secret'
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Консистентное хеширование chat_id по воркерам: при изменении числа воркеров
+    переезжает только ~1/N чатов. replicas — число виртуальных узлов на воркер.
+    """
+
+    def __init__(self, nodes: int, replicas: int = 100) -> None:
+        self.nodes = nodes
+        points = sorted((_hash(f"worker-{node}#{replica}"), node)
+                        for node in range(nodes) for replica in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, chat_id: int) -> int:
+        index = bisect.bisect(self._keys, _hash(str(chat_id))) % len(self._keys)
+        return self._nodes[index]
+
+
+class WorkerRouter:
+    """
+    Маршрутизация update между воркерами в режиме webhook.
+    Telegram (через балансировщик) присылает update любому воркеру; если чат принадлежит
+    другому воркеру, update пересылается ему, чтобы update одного пользователя всегда
+    обрабатывал один процесс (порядок и user_data в памяти этого процесса).
+    """
+
+    def __init__(self, worker_id: int, worker_urls: list[str], secret: str,
+                 forward_path: str = '/internal/update', timeout: float = 10.0) -> None:
+        if not 0 <= worker_id < len(worker_urls):
+            raise ValueError(f"WORKER_ID {worker_id} вне диапазона WORKER_URLS ({len(worker_urls)})")
+        self.worker_id = worker_id
+        self.worker_urls = [url.rstrip('/') for url in worker_urls]
+        self.secret = secret
+        self.forward_path = forward_path
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.ring = HashRing(len(worker_urls))
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def workers(self) -> int:
+        return len(self.worker_urls)
+
+    def owner(self, chat_id: int) -> int:
+        return self.ring.owner(chat_id)
+
+    def is_local(self, chat_id: Optional[int]) -> bool:
+        return chat_id is None or self.owner(chat_id) == self.worker_id
+
+    async def forward(self, chat_id: int, body: bytes) -> int:
+        """Пересылает update воркеру-владельцу чата. Возвращает HTTP статус для Telegram."""
+        owner = self.owner(chat_id)
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        try:
+            async with self._session.post(
+                self.worker_urls[owner] + self.forward_path, data=body,
+                headers={FORWARD_SECRET_HEADER: self.secret, 'Content-Type': 'application/json'}
+            ) as response:
+                return response.status
+        except (aiohttp.ClientError, TimeoutError) as e:
+            # Ошибка вернется Telegram, и он повторит отправку update позже
+            logging.error(f"Не удалось переслать update чата {chat_id} воркеру {owner}: {e!r}")
+            return 502
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
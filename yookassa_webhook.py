@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+from aiohttp import web
+from yookassa.domain.common import SecurityHelper
+from yookassa.domain.notification import WebhookNotificationFactory
+from web_server import client_ip
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Итоговые статусы платежа, которые фиксируются в таблице payments
+FINAL_PAYMENT_STATUSES = ('succeeded', 'canceled')
+
+PAYMENT_EVENTS = {
+    'payment.succeeded': 'succeeded',
+    'payment.canceled': 'canceled',
+}
+
+# (payment_id, status) -> None
+OnPaymentStatus = Callable[[str, str], Awaitable[object]]
+# payment_id -> текущий статус платежа в YooKassa
+FetchPaymentStatus = Callable[[str], Awaitable[Optional[str]]]
+
+
+def create_yookassa_webhook_handler(on_status: OnPaymentStatus, fetch_status: FetchPaymentStatus,
+                                    verify_ip: bool = True,
+                                    trust_proxy: bool = False) -> Callable[[web.Request], Awaitable[web.Response]]:
+    """
+    Обработчик HTTP уведомлений YooKassa (payment.succeeded / payment.canceled).
+    Уведомления принимаются только с IP адресов YooKassa (если verify_ip включен).
+    Статус из тела уведомления не используется: платеж запрашивается в API YooKassa (fetch_status),
+    поэтому поддельное уведомление не может открыть доступ к курсу.
+    """
+    security = SecurityHelper()
+    factory = WebhookNotificationFactory()
+
+    async def handle(request: web.Request) -> web.Response:
+        ip = client_ip(request, trust_proxy)
+        if verify_ip and (not ip or not security.is_ip_trusted(ip)):
+            logging.warning(f"Уведомление YooKassa с недоверенного IP {ip} отклонено")
+            return web.Response(status=403)
+        try:
+            notification = factory.create(await request.json())
+        except Exception as e:
+            logging.warning(f"Некорректное уведомление YooKassa: {e}")
+            return web.Response(status=400)
+
+        if notification.event not in PAYMENT_EVENTS:
+            # Остальные события (refund, deal, payout) бот не обрабатывает
+            return web.Response(status=200)
+
+        payment_id = notification.object.id
+        logging.info(f"Уведомление YooKassa {notification.event} для платежа {payment_id}")
+        # Ошибка здесь вернет 500, и YooKassa повторит отправку уведомления
+        status = await fetch_status(payment_id)
+        if status not in FINAL_PAYMENT_STATUSES:
+            logging.warning(f"Уведомление {notification.event} для платежа {payment_id}, статус в YooKassa: {status}")
+            return web.Response(status=200)
+        await on_status(payment_id, status)
+        return web.Response(status=200)
+
+    return handle
+
+
+def _mark_checked(conn: sqlite3.Connection, payment_ids: list[str]) -> None:
+    """Отмечает время сверки: платеж уходит в конец очереди сверки, даже если YooKassa ответила ошибкой."""
+    params = [(payment_id,) for payment_id in payment_ids]
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("UPDATE payments SET last_checked_at = CURRENT_TIMESTAMP WHERE yookassa_payment_id = ?", params)
+        conn.executemany(
+            "UPDATE payment_attempts SET last_checked_at = CURRENT_TIMESTAMP WHERE yookassa_payment_id = ?", params)
+
+
+async def reconcile_pending_payments(db: 'Database', fetch_status: FetchPaymentStatus, on_status: OnPaymentStatus,
+                                     batch_size: int = 50, concurrency: int = 5,
+                                     min_age_seconds: int = 60, max_age_hours: int = 48) -> int:
+    """
+    Сверка платежей в статусе pending с YooKassa на случай потерянных уведомлений.
+    Проверяются только платежи старше min_age_seconds (свежие обычно подтверждаются уведомлением).
+    Возвращает количество платежей, получивших итоговый статус.
+    """
+    # Прежние платежи из payment_attempts тоже сверяются: их ссылку могли оплатить после замены.
+    # Сначала непроверенные (NULL идут первыми), затем давно проверенные: если pending больше batch_size,
+    # следующие запуски берут остальные платежи, а не снова самые старые.
+    window = (f'-{min_age_seconds} seconds', f'-{max_age_hours} hours')
+    rows = await db.fetchall("""
+        SELECT yookassa_payment_id, last_checked_at, created_at FROM payments
+        WHERE status = 'pending' AND yookassa_payment_id IS NOT NULL
+          AND created_at <= datetime('now', ?) AND created_at >= datetime('now', ?)
+        UNION ALL
+        SELECT yookassa_payment_id, last_checked_at, created_at FROM payment_attempts
+        WHERE status = 'pending'
+          AND created_at <= datetime('now', ?) AND created_at >= datetime('now', ?)
+        ORDER BY last_checked_at, created_at
+        LIMIT ?
+    """, (*window, *window, batch_size))
+    if not rows:
+        return 0
+    payment_ids = [row[0] for row in rows]
+    await db.run(_mark_checked, payment_ids)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def reconcile(payment_id: str) -> bool:
+        async with semaphore:
+            try:
+                status = await fetch_status(payment_id)
+                if status in FINAL_PAYMENT_STATUSES:
+                    await on_status(payment_id, status)
+                    return True
+            except Exception as e:
+                logging.error(f"Ошибка сверки платежа {payment_id}: {e}")
+            return False
+
+    results = await asyncio.gather(*(reconcile(payment_id) for payment_id in payment_ids))
+    resolved = sum(results)
+    logging.info(f"Сверка платежей: проверено {len(rows)}, обновлено {resolved}")
+    return resolved